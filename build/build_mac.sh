@@ -1 +1,2 @@
+python3.10 -m modules.layout_pack
 sudo python3.10 -m nuitka main.py --onefile --enable-plugin=pyside6 --disable-console --include-data-dir=resources=resources --macos-create-app-bundle --macos-app-icon=resources/app.ico --macos-signed-app-name="com.Okcu.UltraFlasher" --macos-app-name="ELRS FLASHER" --company-name="okcu" --macos-app-version=1 --output-filename="UltraFlasher" --noinclude-data-files=".git/**" --noinclude-data-files=".github/**" --noinclude-data-files=".vscode/**" --company-name="okcu" --product-name="UltraFlasher" --file-version=1 --noinclude-data-files="build/**" --noinclude-data-files="venv/**" --disable-cache=all --clean-cache=all --debug --output-dir=build_results --assume-yes-for-downloads
\ No newline at end of file
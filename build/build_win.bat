@@ -1 +1,2 @@
+python -m modules.layout_pack
 nuitka main.py --onefile --plugin-enable=pyside6 --disable-console --include-data-dir=resources=resources --windows-icon-from-ico=resources/app.ico --windows-uac-admin --product-name="ELRS FLASHER" --company-name="okcu" --product-version=1 --output-filename="UltraFlasher" --noinclude-data-files=.git/** --noinclude-data-files=.github/** --noinclude-data-files=.vscode/** --file-version=1 --output-dir=build_results --assume-yes-for-downloads
\ No newline at end of file
@@ -72,6 +72,7 @@ from .util import FatalError, NotImplementedInROMError, flash_size_bytes
 def main(
     argv=None,
     esp=None,
+    progress=None,
 ):
     """
     Main function for esptool
@@ -83,6 +84,9 @@ def main(
 
     esp - Optional override of the connected device previously
     returned by get_default_connected_device()
+
+    progress - Optional callback(done, total) called after each block written
+    by write_flash, replacing the per-block progress output (ELRS)
     """
 
     external_esp = esp is not None
@@ -387,6 +391,13 @@ def main(
         help="Erase all regions of flash (not just write areas) before programming",
         action="store_true",
     )
+    # ELRS vvv
+    parser_write_flash.add_argument(
+        "--skip-unchanged",
+        help="Skip files whose MD5 already matches the data in flash",
+        action="store_true",
+    )
+    # ELRS ^^^
 
     add_spi_flash_subparsers(
         parser_write_flash,
@@ -802,6 +813,7 @@ def main(
     argv = expand_file_arguments(argv or sys.argv[1:])
 
     args = parser.parse_args(argv)
+    args.progress = progress  # ELRS
     print("esptool.py v%s" % __version__)
 
     # operation function can take 1 arg (args), 2 args (esp, arg)
@@ -71,31 +71,57 @@ def LoadFirmwareImage(
         "",
         chip.lower(),
     )
+    # ELRS vvv a file object (e.g. io.BytesIO over an image in memory) is
+    # read from its current position
+    if not isinstance(
+        filename,
+        str,
+    ):
+        return _load_firmware_image(
+            chip,
+            filename,
+        )
+    # ELRS ^^^
     with open(
         filename,
         "rb",
     ) as f:
-        if chip != "esp8266":
-            return {
-                "esp32": ESP32FirmwareImage,
-                "esp32s2": ESP32S2FirmwareImage,
-                "esp32s3beta2": ESP32S3BETA2FirmwareImage,
-                "esp32s3": ESP32S3FirmwareImage,
-                "esp32c3": ESP32C3FirmwareImage,
-                "esp32c6beta": ESP32C6BETAFirmwareImage,
-                "esp32h2beta1": ESP32H2BETA1FirmwareImage,
-                "esp32h2beta2": ESP32H2BETA2FirmwareImage,
-                "esp32c2": ESP32C2FirmwareImage,
-            }[chip](f)
-        else:  # Otherwise, ESP8266 so look at magic to determine the image type
-            magic = ord(f.read(1))
-            f.seek(0)
-            if magic == ESPLoader.ESP_IMAGE_MAGIC:
-                return ESP8266ROMFirmwareImage(f)
-            elif magic == ESPBOOTLOADER.IMAGE_V2_MAGIC:
-                return ESP8266V2FirmwareImage(f)
-            else:
-                raise FatalError("Invalid image magic number: %d" % magic)
+        return _load_firmware_image(  # ELRS
+            chip,
+            f,
+        )
+
+
+# ELRS vvv
+def _load_firmware_image(
+    chip,
+    f,
+):
+    # ELRS ^^^
+    if chip != "esp8266":
+        return {
+            "esp32": ESP32FirmwareImage,
+            "esp32s2": ESP32S2FirmwareImage,
+            "esp32s3beta2": ESP32S3BETA2FirmwareImage,
+            "esp32s3": ESP32S3FirmwareImage,
+            "esp32c3": ESP32C3FirmwareImage,
+            "esp32c6beta": ESP32C6BETAFirmwareImage,
+            "esp32h2beta1": ESP32H2BETA1FirmwareImage,
+            "esp32h2beta2": ESP32H2BETA2FirmwareImage,
+            "esp32c2": ESP32C2FirmwareImage,
+        }[chip](f)
+    else:  # Otherwise, ESP8266 so look at magic to determine the image type
+        # ELRS vvv
+        start = f.tell()
+        magic = ord(f.read(1))
+        f.seek(start)
+        # ELRS ^^^
+        if magic == ESPLoader.ESP_IMAGE_MAGIC:
+            return ESP8266ROMFirmwareImage(f)
+        elif magic == ESPBOOTLOADER.IMAGE_V2_MAGIC:
+            return ESP8266V2FirmwareImage(f)
+        else:
+            raise FatalError("Invalid image magic number: %d" % magic)
 
 
 class ImageSegment(object):
@@ -3,11 +3,13 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import collections
 import hashlib
 import io
 import os
 import struct
 import sys
+import threading
 import time
 import zlib
 
@@ -48,6 +50,77 @@ from .util import (
     print_overwrite,
 )
 
+# ELRS vvv
+# Deflate streams of recently written images, keyed by the image MD5, so the
+# same image flashed to many devices is compressed once
+COMPRESSED_CACHE_SIZE = 8
+
+
+class CompressedImage(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = None
+        self._block_sizes = {}
+
+    def compress(self, image):
+        with self.lock:
+            if self.data is None:
+                self.data = zlib.compress(image, 9)
+        return self.data
+
+    def block_sizes(self, write_size):
+        """Uncompressed size of every write_size block of the deflate stream"""
+        with self.lock:
+            sizes = self._block_sizes.get(write_size)
+            if sizes is None:
+                decompress = zlib.decompressobj()
+                sizes = [
+                    len(decompress.decompress(self.data[i : i + write_size]))
+                    for i in range(0, len(self.data), write_size)
+                ]
+                self._block_sizes[write_size] = sizes
+            return sizes
+
+
+# Padding between merged images is written from this block, not allocated
+# for the whole gap (up to the flash size with --fill-flash-size)
+_PAD_BLOCK = memoryview(b"\xFF" * 0x10000)
+
+_compressed_cache = collections.OrderedDict()
+_compressed_cache_lock = threading.Lock()
+
+
+def _cache_entry(md5):
+    with _compressed_cache_lock:
+        entry = _compressed_cache.get(md5)
+        if entry is None:
+            entry = _compressed_cache[md5] = CompressedImage()
+            while len(_compressed_cache) > COMPRESSED_CACHE_SIZE:
+                _compressed_cache.popitem(last=False)
+        else:
+            _compressed_cache.move_to_end(md5)
+    return entry
+
+
+def get_compressed_image(image, md5):
+    entry = _cache_entry(md5)
+    # Compressed outside the cache lock: other images are not held up
+    entry.compress(image)
+    return entry
+
+
+def put_compressed_image(md5, data):
+    """Add a deflate stream compressed elsewhere, e.g. in another process
+    (any buffer: bytes or an mmap of the stream)"""
+    entry = _cache_entry(md5)
+    with entry.lock:
+        if entry.data is None:
+            entry.data = data
+    return entry
+
+
+# ELRS ^^^
+
 DETECTED_FLASH_SIZES = {
     0x12: "256KB",
     0x13: "512KB",
@@ -661,6 +734,22 @@ def write_flash(
             key=lambda x: x[0],
         )
 
+    # ELRS vvv
+    # The stub ACKs a block once it starts writing the previous one and
+    # decompresses straight from its two receive buffers, so only one block can
+    # be sent ahead and every block costs a round trip on top of its transfer
+    rtt = None
+    if esp.IS_STUB:
+        rtt = esp.tune_latency()
+        print(
+            "Round trip %.1f ms, %d byte blocks"
+            % (
+                rtt * 1000,
+                esp.FLASH_WRITE_SIZE,
+            )
+        )
+    # ELRS ^^^
+
     for (
         address,
         argfile,
@@ -691,15 +780,40 @@ def write_flash(
         )
         calcmd5 = hashlib.md5(image).hexdigest()
         uncsize = len(image)
+        # ELRS vvv
+        if (
+            args.skip_unchanged
+            and not args.erase_all
+            and not encrypted
+            and not esp.secure_download_mode
+        ):
+            try:
+                if (
+                    esp.flash_md5sum(
+                        address,
+                        uncsize,
+                    )
+                    == calcmd5
+                ):
+                    print(
+                        "Data at 0x%08x already matches %s, skipping"
+                        % (
+                            address,
+                            argfile.name,
+                        )
+                    )
+                    continue
+            except NotImplementedInROMError:
+                pass
+        # ELRS ^^^
         if compress:
-            uncimage = image
-            image = zlib.compress(
-                uncimage,
-                9,
-            )
-            # Decompress the compressed binary a block at a time,
-            # to dynamically calculate the timeout based on the real write size
-            decompress = zlib.decompressobj()
+            # ELRS vvv
+            # The uncompressed size of each block sets its write timeout,
+            # cached with the deflate stream instead of decompressing it again
+            compressed = get_compressed_image(image, calcmd5)
+            image = compressed.data
+            block_sizes = compressed.block_sizes(esp.FLASH_WRITE_SIZE)
+            # ELRS ^^^
             blocks = esp.flash_defl_begin(
                 uncsize,
                 len(image),
@@ -719,20 +833,27 @@ def write_flash(
 
         timeout = DEFAULT_TIMEOUT
 
-        while len(image) > 0:
-            print_overwrite(
-                "Writing at 0x%08x... (%d %%)"
-                % (
-                    address + bytes_written,
-                    100 * (seq + 1) // blocks,
+        # ELRS vvv blocks are views into the image, nothing is copied per block
+        view = memoryview(image)
+        pos = 0
+        progress = getattr(args, "progress", None)
+        if progress is not None:
+            progress(0, uncsize)
+        port_timeout = esp.set_port_timeout(timeout)
+        while pos < len(view):
+            if progress is None:
+                print_overwrite(
+                    "Writing at 0x%08x... (%d %%)"
+                    % (
+                        address + bytes_written,
+                        100 * (seq + 1) // blocks,
+                    )
                 )
-            )
-            sys.stdout.flush()
-            block = image[0 : esp.FLASH_WRITE_SIZE]
+                sys.stdout.flush()
+            block = view[pos : pos + esp.FLASH_WRITE_SIZE]
+            # ELRS ^^^
             if compress:
-                # feeding each compressed block into the decompressor lets us
-                # see block-by-block how much will be written
-                block_uncompressed = len(decompress.decompress(block))
+                block_uncompressed = block_sizes[seq]  # ELRS
                 bytes_written += block_uncompressed
                 block_timeout = max(
                     DEFAULT_TIMEOUT,
@@ -756,7 +877,8 @@ def write_flash(
                     timeout = block_timeout
             else:
                 # Pad the last block
-                block = block + b"\xff" * (esp.FLASH_WRITE_SIZE - len(block))
+                if len(block) < esp.FLASH_WRITE_SIZE:  # ELRS
+                    block = bytes(block) + b"\xff" * (esp.FLASH_WRITE_SIZE - len(block))
                 if encrypted:
                     esp.flash_encrypt_block(
                         block,
@@ -769,8 +891,12 @@ def write_flash(
                     )
                 bytes_written += len(block)
             bytes_sent += len(block)
-            image = image[esp.FLASH_WRITE_SIZE :]
             seq += 1
+            # ELRS vvv
+            pos += esp.FLASH_WRITE_SIZE
+            if progress is not None:
+                progress(min(bytes_written, uncsize), uncsize)
+            # ELRS ^^^
 
         if esp.IS_STUB:
             # Stub only writes each block to flash after 'ack'ing the receive,
@@ -780,12 +906,18 @@ def write_flash(
                 ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR,
                 timeout=timeout,
             )
+        esp.set_port_timeout(port_timeout)  # ELRS
 
         t = time.time() - t
         speed_msg = ""
         if compress:
             if t > 0.0:
-                speed_msg = " (effective %.1f kbit/s)" % (uncsize / t * 8 / 1000)
+                # ELRS vvv
+                speed_msg = " (effective %.1f kbit/s, %.1f kbit/s on the wire)" % (
+                    uncsize / t * 8 / 1000,
+                    bytes_sent / t * 8 / 1000,
+                )
+                # ELRS ^^^
             print_overwrite(
                 "Wrote %d bytes (%d compressed) at 0x%08x in %.1f seconds%s..."
                 % (
@@ -810,6 +942,16 @@ def write_flash(
                 ),
                 last_line=True,
             )
+        # ELRS vvv
+        if rtt and t > 0.0:
+            print(
+                "Round trips took %d%% of the write (%d blocks)"
+                % (
+                    min(100, 100 * seq * rtt / t),
+                    seq,
+                )
+            )
+        # ELRS ^^^
 
         if not encrypted and not esp.secure_download_mode:
             try:
@@ -1348,27 +1490,29 @@ def read_flash(
             sys.stdout.flush()
 
     t = time.time()
-    data = esp.read_flash(
-        args.address,
-        args.size,
-        flash_progress,
-    )
+    # ELRS vvv blocks go straight to the file instead of a buffer of args.size
+    with open(
+        args.filename,
+        "wb",
+    ) as f:
+        esp.read_flash(
+            args.address,
+            args.size,
+            flash_progress,
+            output=f.write,
+        )
+    # ELRS ^^^
     t = time.time() - t
-    speed_msg = " ({:.1f} kbit/s)".format(len(data) / t * 8 / 1000) if t > 0.0 else ""
+    speed_msg = " ({:.1f} kbit/s)".format(args.size / t * 8 / 1000) if t > 0.0 else ""
     print_overwrite(
         "Read {:d} bytes at {:#010x} in {:.1f} seconds{}...".format(
-            len(data),
+            args.size,
             args.address,
             t,
             speed_msg,
         ),
         last_line=True,
     )
-    with open(
-        args.filename,
-        "wb",
-    ) as f:
-        f.write(data)
 
 
 def verify_flash(
@@ -1542,7 +1686,13 @@ def merge_bin(
             flash_offs,
         ):
             # account for output file offset if there is any
-            of.write(b"\xFF" * (flash_offs - args.target_offset - of.tell()))
+            # ELRS vvv
+            remaining = flash_offs - args.target_offset - of.tell()
+            while remaining > 0:
+                chunk = min(remaining, len(_PAD_BLOCK))
+                of.write(_PAD_BLOCK[:chunk])
+                remaining -= chunk
+            # ELRS ^^^
 
         for (
             addr,
@@ -83,6 +83,8 @@ ERASE_WRITE_TIMEOUT_PER_MB = 40
 MEM_END_ROM_TIMEOUT = 0.05  # short timeout for ESP_MEM_END, as it may never respond
 DEFAULT_SERIAL_WRITE_TIMEOUT = 10  # timeout for serial port write
 DEFAULT_CONNECT_ATTEMPTS = 7  # default number of times to try connection
+# ELRS: round trip above which the serial driver's low latency mode is tried
+LOW_LATENCY_RTT = 0.004
 
 STUBS_DIR = os.path.join(
     os.path.dirname(__file__),
@@ -584,6 +586,67 @@ class ESPLoader(object):
             # (this is used by read_reg)
             return val
 
+    # ELRS vvv
+    def set_port_timeout(
+        self,
+        timeout,
+    ):
+        """Set the read timeout of the port, returns the previous one.
+
+        command() restores the timeout after every request, which reconfigures
+        the port twice per block (and sends USB control transfers on many
+        USB-serial drivers) unless it already matches the request timeout.
+        """
+        previous = self._port.timeout
+        if timeout != previous:
+            self._port.timeout = timeout
+        return previous
+
+    def measure_rtt(
+        self,
+        count=5,
+    ):
+        """Median round trip of a register read, in seconds"""
+        times = []
+        for _ in range(count):
+            t = time.perf_counter()
+            self.read_reg(self.CHIP_DETECT_MAGIC_REG_ADDR)
+            times.append(time.perf_counter() - t)
+        times.sort()
+        return times[len(times) // 2]
+
+    def tune_latency(
+        self,
+    ):
+        """Measure the round trip and, if it is long, try the low latency mode
+        of the serial driver (FTDI adapters hold replies for up to 16 ms).
+
+        Returns the round trip in seconds.
+        """
+        rtt = self.measure_rtt()
+        set_low_latency = getattr(self._port, "set_low_latency_mode", None)
+        if rtt < LOW_LATENCY_RTT or set_low_latency is None:
+            return rtt
+        try:
+            set_low_latency(True)
+            low_rtt = self.measure_rtt()
+            if low_rtt >= rtt:
+                set_low_latency(False)
+                return rtt
+        except (OSError, ValueError, NotImplementedError):
+            # Not a serial port with TIOCSSERIAL (Windows, RFC2217, pty)
+            return rtt
+        print(
+            "Low latency mode: round trip %.1f ms -> %.1f ms"
+            % (
+                rtt * 1000,
+                low_rtt * 1000,
+            )
+        )
+        return low_rtt
+
+    # ELRS ^^^
+
     def flush_input(
         self,
     ):
@@ -1581,13 +1644,22 @@ class ESPLoader(object):
         offset,
         length,
         progress_fn=None,
+        output=None,
     ):
+        # ELRS vvv
+        """Read flash into a preallocated buffer and return it, or pass each
+        block to output(block) (e.g. a file's write) and return None.
+        The MD5 check is updated block by block in both cases."""
         if not self.IS_STUB:
-            return self.read_flash_slow(
+            data = self.read_flash_slow(
                 offset,
                 length,
                 progress_fn,
             )  # ROM-only routine
+            if output is None:
+                return data
+            output(data)
+            return None
 
         # issue a standard bootloader command to trigger the read
         self.check_command(
@@ -1602,11 +1674,20 @@ class ESPLoader(object):
             ),
         )
         # now we expect (length // block_size) SLIP frames with the data
-        data = b""
-        while len(data) < length:
+        data = bytearray(length) if output is None else None
+        md5 = hashlib.md5()
+        received = 0
+        while received < length:
             p = self.read()
-            data += p
-            if len(data) < length and len(p) < self.FLASH_SECTOR_SIZE:
+            if received + len(p) > length:
+                raise FatalError("Read more than expected")
+            if output is None:
+                data[received : received + len(p)] = p
+            else:
+                output(p)
+            md5.update(p)
+            received += len(p)
+            if received < length and len(p) < self.FLASH_SECTOR_SIZE:
                 raise FatalError(
                     "Corrupt data, expected 0x%x bytes but received 0x%x bytes"
                     % (
@@ -1617,27 +1698,25 @@ class ESPLoader(object):
             self.write(
                 struct.pack(
                     "<I",
-                    len(data),
+                    received,
                 )
             )
-            if progress_fn and (len(data) % 1024 == 0 or len(data) == length):
+            if progress_fn and (received % 1024 == 0 or received == length):
                 progress_fn(
-                    len(data),
+                    received,
                     length,
                 )
         if progress_fn:
             progress_fn(
-                len(data),
+                received,
                 length,
             )
-        if len(data) > length:
-            raise FatalError("Read more than expected")
 
         digest_frame = self.read()
         if len(digest_frame) != 16:
             raise FatalError("Expected digest, got: %s" % hexify(digest_frame))
         expected_digest = hexify(digest_frame).upper()
-        digest = hashlib.md5(data).hexdigest().upper()
+        digest = md5.hexdigest().upper()
         if digest != expected_digest:
             raise FatalError(
                 "Digest mismatch: expected %s, got %s"
@@ -1647,6 +1726,7 @@ class ESPLoader(object):
                 )
             )
         return data
+        # ELRS ^^^
 
     def flash_spi_attach(
         self,
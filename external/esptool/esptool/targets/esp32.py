@@ -442,18 +442,20 @@ class ESP32ROM(ESPLoader):
         # ROM read limit per command (this limit is why it's so slow)
         BLOCK_LEN = 64
 
-        data = b""
-        while len(data) < length:
+        # ELRS vvv preallocated instead of growing with +=
+        data = bytearray(length)
+        received = 0
+        while received < length:
             block_len = min(
                 BLOCK_LEN,
-                length - len(data),
+                length - received,
             )
             r = self.check_command(
                 "read flash block",
                 self.ESP_READ_FLASH_SLOW,
                 struct.pack(
                     "<II",
-                    offset + len(data),
+                    offset + received,
                     block_len,
                 ),
             )
@@ -467,12 +469,14 @@ class ESP32ROM(ESPLoader):
                 )
             # command always returns 64 byte buffer,
             # regardless of how many bytes were actually read from flash
-            data += r[:block_len]
-            if progress_fn and (len(data) % 1024 == 0 or len(data) == length):
+            data[received : received + block_len] = r[:block_len]
+            received += block_len
+            if progress_fn and (received % 1024 == 0 or received == length):
                 progress_fn(
-                    len(data),
+                    received,
                     length,
                 )
+        # ELRS ^^^
         return data
 
 
@@ -1,4 +1,6 @@
+import contextlib
 import re
+import time
 
 import usb.core
 import usb.util
@@ -93,6 +95,8 @@ class StlinkUsbConnector:
         self._dbg = dbg
         self._dev_type = None
         self._xfer_counter = 0
+        self._round_trips = 0
+        self._stats = {}
         devices = usb.core.find(find_all=True)
         multiple_devices = False
         self._dev = None
@@ -156,6 +160,48 @@ class StlinkUsbConnector:
     ):
         return self._xfer_counter
 
+    @property
+    def round_trips(
+        self,
+    ):
+        return self._round_trips
+
+    @property
+    def stats(
+        self,
+    ):
+        """{operation: (calls, round_trips, seconds)}"""
+        return dict(self._stats)
+
+    def reset_stats(
+        self,
+    ):
+        self._stats = {}
+
+    @contextlib.contextmanager
+    def operation(
+        self,
+        name,
+    ):
+        """Count USB round trips and time spent in an operation.
+
+        Operations may nest, each one counts everything done inside it."""
+        round_trips = self._round_trips
+        start = time.time()
+        try:
+            yield
+        finally:
+            (
+                calls,
+                trips,
+                seconds,
+            ) = self._stats.get(name, (0, 0, 0.0))
+            self._stats[name] = (
+                calls + 1,
+                trips + self._round_trips - round_trips,
+                seconds + time.time() - start,
+            )
+
     def _write(
         self,
         data,
@@ -205,6 +251,7 @@ class StlinkUsbConnector:
         tout=200,
     ):
         while True:
+            self._round_trips += 1
             try:
                 if len(cmd) > self.STLINK_CMD_SIZE_V2:
                     raise stlinkex.StlinkException(
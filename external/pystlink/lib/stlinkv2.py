@@ -459,6 +459,65 @@ class Stlink:
             byteorder="little",
         )
 
+    def set_debugregs32(
+        self,
+        addr,
+        values,
+    ):
+        """Write adjacent 32-bit registers in one USB round trip"""
+        data = []
+        for value in values:
+            data.extend(
+                value.to_bytes(
+                    4,
+                    byteorder="little",
+                )
+            )
+        self.set_mem32(
+            addr,
+            data,
+        )
+
+    def get_debugregs32(
+        self,
+        addr,
+        count,
+    ):
+        """Read adjacent 32-bit registers in one USB round trip"""
+        rx = self.get_mem32(
+            addr,
+            count * 4,
+        )
+        return [
+            int.from_bytes(
+                rx[i : i + 4],
+                byteorder="little",
+            )
+            for i in range(0, count * 4, 4)
+        ]
+
+    def batch(
+        self,
+    ):
+        return RegisterBatch(self)
+
+    def operation(
+        self,
+        name,
+    ):
+        return self._connector.operation(name)
+
+    @property
+    def stats(
+        self,
+    ):
+        return self._connector.stats
+
+    def reset_stats(
+        self,
+    ):
+        self._connector.reset_stats()
+
     def get_debugreg16(
         self,
         addr,
@@ -776,3 +835,69 @@ class Stlink:
             ],
             rx_len=2,
         )
+
+
+class RegisterBatch:
+    """Queued register writes, sent with as few USB round trips as possible.
+
+    The ST-Link protocol has no multi-register debug command, so runs of
+    writes to adjacent registers are merged into one WRITEMEM_32BIT transfer.
+    Writes are sent in order when the batch is flushed or the `with` block
+    exits without an exception.
+    """
+
+    def __init__(
+        self,
+        stlink,
+    ):
+        self._stlink = stlink
+        self._writes = []
+
+    def set(
+        self,
+        addr,
+        value,
+    ):
+        self._writes.append((addr, value))
+
+    def flush(
+        self,
+    ):
+        runs = []
+        for (
+            addr,
+            value,
+        ) in self._writes:
+            if runs and addr == runs[-1][0] + 4 * len(runs[-1][1]):
+                runs[-1][1].append(value)
+            else:
+                runs.append((addr, [value]))
+        self._writes = []
+        for (
+            addr,
+            values,
+        ) in runs:
+            if len(values) == 1:
+                self._stlink.set_debugreg32(
+                    addr,
+                    values[0],
+                )
+            else:
+                self._stlink.set_debugregs32(
+                    addr,
+                    values,
+                )
+
+    def __enter__(
+        self,
+    ):
+        return self
+
+    def __exit__(
+        self,
+        exc_type,
+        exc_value,
+        traceback,
+    ):
+        if exc_type is None:
+            self.flush()
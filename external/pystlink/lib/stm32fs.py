@@ -32,6 +32,12 @@ class Flash:
         FLASH_SR_WRPERR | FLASH_SR_PGAERR | FLASH_SR_PGPERR | FLASH_SR_ERSERR
     )
 
+    # wait_busy polling as shares of the maximum operation time: typical
+    # erase time is about half of the maximum
+    FIRST_POLL = 0.4
+    MIN_POLL = 1 / 64
+    MAX_POLL = 1 / 8
+
     VOLTAGE_DEPENDEND_PARAMS = [
         {
             "min_voltage": 2.7,
@@ -165,15 +171,12 @@ class Flash:
         flash_cr_value |= self._params["FLASH_CR_PSIZE"] | (
             sector << Flash.FLASH_CR_SNB_BITINDEX
         )
-        self._stlink.set_debugreg32(
-            Flash.FLASH_CR_REG,
-            flash_cr_value,
-        )
+        # SER, SNB and STRT may be set by one write (as OpenOCD does)
         self._stlink.set_debugreg32(
             Flash.FLASH_CR_REG,
             flash_cr_value | Flash.FLASH_CR_STRT_BIT,
         )
-        self.wait_busy(self._params["max_erase_time"][erase_size / 1024])
+        self.wait_busy(self._params["max_erase_time"][erase_size // 1024])
 
     def erase_sectors(
         self,
@@ -208,23 +211,37 @@ class Flash:
         wait_time,
         bargraph_msg=None,
     ):
-        end_time = time.time() + wait_time * 1.5
+        """Poll FLASH_SR until the operation ends.
+
+        wait_time is the datasheet maximum. The first poll comes after the
+        typical time, then the poll interval grows exponentially, so a long
+        erase costs a handful of USB round trips instead of one every
+        wait_time / 20."""
+        start = time.time()
+        end_time = start + wait_time * 1.5
         if bargraph_msg:
             self._dbg.bargraph_start(
                 bargraph_msg,
-                value_min=time.time(),
-                value_max=time.time() + wait_time,
+                value_min=start,
+                value_max=start + wait_time,
             )
-        while time.time() < end_time:
-            if bargraph_msg:
-                self._dbg.bargraph_update(value=time.time())
-            status = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
-            if not status & Flash.FLASH_SR_BSY:
-                self.end_of_operation(status)
+        delay = wait_time * Flash.FIRST_POLL
+        interval = wait_time * Flash.MIN_POLL
+        with self._stlink.operation("wait_busy"):
+            while True:
+                time.sleep(max(0, min(delay, end_time - time.time())))
                 if bargraph_msg:
-                    self._dbg.bargraph_done()
-                return
-            time.sleep(wait_time / 20)
+                    self._dbg.bargraph_update(value=time.time())
+                status = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
+                if not status & Flash.FLASH_SR_BSY:
+                    self.end_of_operation(status)
+                    if bargraph_msg:
+                        self._dbg.bargraph_done()
+                    return
+                if time.time() >= end_time:
+                    break
+                delay = interval
+                interval = min(interval * 2, wait_time * Flash.MAX_POLL)
         raise stlinkex.StlinkException("Operation timeout")
 
     def wait_for_breakpoint(
@@ -301,22 +318,27 @@ class Stm32FS(stm32.Stm32):
                 )
             else:
                 flash.erase_all()
+        # Already read by Flash(), reading again costs a USB round trip
+        params = flash._params
+        print("Align %d" % params["align"])
         status = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
-        if status & Flash.FLASH_SR_ERROR_MASK:
-            # Try to clear errors
-            self._stlink.set_debugreg32(
-                Flash.FLASH_SR_REG,
-                Flash.FLASH_SR_ERROR_MASK,
+        # FLASH_SR and FLASH_CR are adjacent: clearing errors and enabling
+        # programming go out in one transfer
+        with self._stlink.batch() as batch:
+            if status & Flash.FLASH_SR_ERROR_MASK:
+                # Try to clear errors
+                batch.set(
+                    Flash.FLASH_SR_REG,
+                    Flash.FLASH_SR_ERROR_MASK,
+                )
+            batch.set(
+                Flash.FLASH_CR_REG,
+                Flash.FLASH_CR_PG_BIT | params["FLASH_CR_PSIZE"],
             )
+        if status & Flash.FLASH_SR_ERROR_MASK:
             status = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
             if status & Flash.FLASH_SR_ERROR_MASK:
                 raise stlinkex.StlinkException("FLASH state error : %08x\n" % status)
-        params = Flash.get_voltage_dependend_params(self)
-        print("Align %d" % params["align"])
-        self._stlink.set_debugreg32(
-            Flash.FLASH_CR_REG,
-            Flash.FLASH_CR_PG_BIT | params["FLASH_CR_PSIZE"],
-        )
         self._dbg.bargraph_start(
             "Writing FLASH",
             value_min=addr,
@@ -117,6 +117,7 @@ __copyright__ = [
 __license__ = "MIT"
 __version__ = "0.4.5"
 
+import binascii
 import logging
 import platform
 import sys
@@ -1026,10 +1027,11 @@ class XMODEM(object):
             '0x4ab3'
 
         """
-        for char in bytearray(data):
-            crctbl_idx = ((crc >> 8) ^ char) & 0xFF
-            crc = ((crc << 8) ^ self.crctable[crctbl_idx]) & 0xFFFF
-        return crc & 0xFFFF
+        # CRC-16/XMODEM is CRC-CCITT with a zero seed, binascii computes it
+        # in C instead of a per-byte table lookup loop
+        if isinstance(data, str):
+            data = data.encode()
+        return binascii.crc_hqx(data, crc)
 
 
 XMODEM1k = partial(
@@ -0,0 +1,148 @@
+"""Адресация DFU-устройств по vid:pid, серийному номеру и пути USB-порта.
+
+Формат адреса: ``[vid]:[pid][:serial][@path]``, где пустое поле совпадает с
+любым устройством, ``vid`` и ``pid`` задаются в hex, а ``path`` имеет вид
+``bus-port.port...`` (как в sysfs Linux), например ``0483:df11@1-2.3``.
+"""
+
+import dataclasses
+import logging
+from typing import Optional
+
+import usb
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class DfuAddress:
+    """Filter identifying one or more DFU devices."""
+
+    vid: Optional[int] = None
+    pid: Optional[int] = None
+    serial: Optional[str] = None
+    path: Optional[str] = None
+
+    def matches(
+        self,
+        device: usb.core.Device,
+    ) -> bool:
+        """Check whether a USB device matches this address.
+
+        Args:
+            device: USB device.
+
+        Returns:
+            True if every field which is set matches the device.
+        """
+        if self.vid is not None and self.vid != device.idVendor:
+            return False
+        if self.pid is not None and self.pid != device.idProduct:
+            return False
+        if self.path is not None and self.path != get_port_path(device):
+            return False
+        if self.serial is not None and self.serial != get_serial_number(device):
+            return False
+        return True
+
+    def __str__(self) -> str:
+        text = "{}:{}".format(
+            "" if self.vid is None else f"{self.vid:04x}",
+            "" if self.pid is None else f"{self.pid:04x}",
+        )
+        if self.serial is not None:
+            text += f":{self.serial}"
+        if self.path is not None:
+            text += f"@{self.path}"
+        return text
+
+
+def parse_address(
+    text: str,
+) -> DfuAddress:
+    """Parse a device address string.
+
+    Args:
+        text: Address in ``[vid]:[pid][:serial][@path]`` format.
+
+    Returns:
+        `DfuAddress` for the string.
+
+    Raises:
+        ValueError: Malformed address.
+    """
+    path = None
+    if "@" in text:
+        text, path = text.split("@", 1)
+
+    fields = text.split(":", 2) if text else []
+    if len(fields) == 1:
+        raise ValueError(f"Invalid DFU address '{text}', expected vid:pid")
+
+    vid = int(fields[0], 16) if fields and fields[0] else None
+    pid = int(fields[1], 16) if len(fields) > 1 and fields[1] else None
+    serial = fields[2] if len(fields) > 2 and fields[2] else None
+
+    return DfuAddress(
+        vid=vid,
+        pid=pid,
+        serial=serial,
+        path=path or None,
+    )
+
+
+def get_port_path(
+    device: usb.core.Device,
+) -> str:
+    """Get the USB port path of a device.
+
+    Args:
+        device: USB device.
+
+    Returns:
+        Port path in ``bus-port.port...`` format.
+    """
+    ports = device.port_numbers or ()
+    if not ports:
+        return str(device.bus)
+    return "{}-{}".format(
+        device.bus,
+        ".".join(str(port) for port in ports),
+    )
+
+
+def get_serial_number(
+    device: usb.core.Device,
+) -> Optional[str]:
+    """Get the serial number string of a device.
+
+    Args:
+        device: USB device.
+
+    Returns:
+        Serial number or None if the device does not report one.
+    """
+    try:
+        return device.serial_number
+    except (ValueError, usb.core.USBError):
+        logger.warning("Failed to read serial number of %s", get_port_path(device))
+        return None
+
+
+def get_address(
+    device: usb.core.Device,
+) -> DfuAddress:
+    """Get the full address of a device.
+
+    Args:
+        device: USB device.
+
+    Returns:
+        `DfuAddress` with all fields set which the device reports.
+    """
+    return DfuAddress(
+        vid=device.idVendor,
+        pid=device.idProduct,
+        serial=get_serial_number(device),
+        path=get_port_path(device),
+    )
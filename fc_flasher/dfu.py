@@ -11,12 +11,15 @@ _TIMEOUT_MS = 5000
 # DFU states
 _DFU_STATE_DFU_IDLE = 0x02
 _DFU_STATE_DFU_DOWNLOAD_IDLE = 0x05
+_DFU_STATE_DFU_UPLOAD_IDLE = 0x09
 _DFU_STATE_DFU_ERROR = 0x0A
 
 # DFU commands
 _DFU_CMD_DOWNLOAD = 1
+_DFU_CMD_UPLOAD = 2
 _DFU_CMD_GETSTATUS = 3
 _DFU_CMD_CLRSTATUS = 4
+_DFU_CMD_ABORT = 6
 _DFU_STATE_LEN = 6
 
 # USB request types
@@ -121,6 +124,59 @@ def download(
         pass
 
 
+def upload(
+    dev: usb.core.Device,
+    interface: int,
+    transaction: int,
+    length: int,
+    timeout_ms: int = _TIMEOUT_MS,
+) -> bytes:
+    """Upload (read back) data.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+        transaction: Transaction counter (block number).
+        length: Number of bytes to request.
+        timeout_ms: Timeout in milliseconds for USB control transfer.
+
+    Returns:
+        Data returned by the device. A short block marks the end of upload.
+    """
+    return bytes(
+        dev.ctrl_transfer(
+            bmRequestType=_USB_REQUEST_TYPE_RECV,
+            bRequest=_DFU_CMD_UPLOAD,
+            wValue=transaction,
+            wIndex=interface,
+            data_or_wLength=length,
+            timeout=timeout_ms,
+        )
+    )
+
+
+def abort(
+    dev: usb.core.Device,
+    interface: int,
+    timeout_ms: int = _TIMEOUT_MS,
+) -> None:
+    """Abort the current operation and return the device to idle state.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+        timeout_ms: Timeout in milliseconds for USB control transfer.
+    """
+    dev.ctrl_transfer(
+        bmRequestType=_USB_REQUEST_TYPE_SEND,
+        bRequest=_DFU_CMD_ABORT,
+        wValue=0,
+        wIndex=interface,
+        data_or_wLength=None,
+        timeout=timeout_ms,
+    )
+
+
 def claim_interface(
     dev: usb.core.Device,
     interface: int,
@@ -3,10 +3,11 @@
 
 import logging
 import struct
+from typing import Iterator
 
 import usb
 
-from .dfu import download
+from .dfu import abort, download, upload
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +16,9 @@ _DFUSE_CMD_ERASE = 0x41
 
 DFUSE_VERSION_NUMBER = 0x11A
 
+# Mass erase of 2 MB flash takes up to 32 s at low supply voltage
+_MASS_ERASE_TIMEOUT_MS = 40000
+
 
 def set_address(
     dev: usb.core.Device,
@@ -62,3 +66,85 @@ def page_erase(
             address,
         ),
     )
+
+
+def mass_erase(
+    dev: usb.core.Device,
+    interface: int,
+) -> None:
+    """Erases the whole device memory.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+    """
+    download(
+        dev,
+        interface,
+        0,
+        struct.pack(
+            "<B",
+            _DFUSE_CMD_ERASE,
+        ),
+        timeout_ms=_MASS_ERASE_TIMEOUT_MS,
+    )
+
+
+def read_memory(
+    dev: usb.core.Device,
+    interface: int,
+    address: int,
+    length: int,
+    xfer_size: int,
+) -> Iterator[bytes]:
+    """Read device memory block by block.
+
+    Blocks are yielded as they arrive so callers can hash or store them without
+    keeping the whole memory in RAM.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+        address: Start address in device memory.
+        length: Number of bytes to read.
+        xfer_size: Transfer size per UPLOAD request.
+
+    Yields:
+        Blocks of at most `xfer_size` bytes, `length` bytes in total.
+    """
+    set_address(
+        dev,
+        interface,
+        address,
+    )
+    # UPLOAD is only accepted from dfuIDLE
+    abort(
+        dev,
+        interface,
+    )
+
+    # DfuSe block numbers start at 2 and block N reads from
+    # address + (N - 2) * wLength, so every request must use the same length
+    # and the last block is trimmed instead.
+    block_num = 2
+    bytes_read = 0
+    try:
+        while bytes_read < length:
+            block = upload(
+                dev,
+                interface,
+                block_num,
+                xfer_size,
+            )
+            if not block:
+                break
+            block = block[: length - bytes_read]
+            yield block
+            bytes_read += len(block)
+            block_num += 1
+    finally:
+        # Also runs when the caller stops reading early
+        abort(
+            dev,
+            interface,
+        )
@@ -0,0 +1,287 @@
+"""Планировщик стирания flash, общий для DFU и ST-Link.
+
+По карте секторов устройства и разреженным сегментам образа вычисляет
+минимальный набор секторов, пропускает уже чистые сектора (проверка чтением) и
+выбирает между стиранием по секторам и полным стиранием по оценке времени.
+На F4/F7 с секторами по 128 КБ стирание занимает большую часть времени прошивки.
+"""
+
+import dataclasses
+import logging
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Typical erase time in seconds by sector size in KB (STM32F1/F4/F7 datasheets)
+_TYPICAL_ERASE_TIME = {
+    1: 0.03,
+    2: 0.03,
+    16: 0.25,
+    32: 0.5,
+    64: 0.55,
+    128: 1.0,
+    256: 2.0,
+}
+
+# Fallback for sector sizes missing from the table
+_ERASE_TIME_PER_KB = 0.008
+
+# USB round trips needed to start one sector erase and poll it to completion
+SECTOR_OVERHEAD = 0.01
+
+# Called with a sector, returns True if it reads back as erased
+BlankCheck = Callable[["Sector"], bool]
+
+# Erase time estimate in seconds for a sector
+EraseTime = Callable[["Sector"], float]
+
+
+@dataclasses.dataclass(frozen=True)
+class Sector:
+    """Smallest erasable unit of flash."""
+
+    index: int
+    addr: int
+    size: int
+
+    @property
+    def end(self) -> int:
+        return self.addr + self.size
+
+
+@dataclasses.dataclass
+class ErasePlan:
+    """Sectors to erase and the chosen erase method."""
+
+    sectors: List[Sector]
+    mass_erase: bool = False
+    blank: List[Sector] = dataclasses.field(default_factory=list)
+    skipped: List[Sector] = dataclasses.field(default_factory=list)
+    estimate: float = 0.0
+
+    def __str__(self) -> str:
+        if self.mass_erase:
+            text = "полное стирание"
+        else:
+            text = f"стирание {len(self.sectors)} секторов"
+        if self.blank:
+            text += f", чистых секторов пропущено: {len(self.blank)}"
+        if self.skipped:
+            text += f", записанных ранее пропущено: {len(self.skipped)}"
+        return text + f", оценка {self.estimate:.1f} с"
+
+
+def typical_erase_time(
+    sector: Sector,
+) -> float:
+    """Estimate sector erase time from its size.
+
+    Args:
+        sector: Flash sector.
+
+    Returns:
+        Typical erase time in seconds.
+    """
+    size_kb = sector.size // 1024
+    return _TYPICAL_ERASE_TIME.get(size_kb, size_kb * _ERASE_TIME_PER_KB)
+
+
+def mass_erase_estimate(
+    sectors: Sequence[Sector],
+    erase_time: EraseTime = typical_erase_time,
+) -> float:
+    """Estimate mass erase time for devices without a datasheet figure.
+
+    Mass erase takes about as long as erasing every sector, minus the USB
+    round trips per sector.
+
+    Args:
+        sectors: Sector map of the whole flash.
+        erase_time: Erase time estimate for a sector.
+
+    Returns:
+        Mass erase time in seconds.
+    """
+    return sum(erase_time(s) for s in sectors)
+
+
+def sectors_from_layout(
+    layout: Iterable,
+) -> List[Sector]:
+    """Build a sector map from a DfuSe memory layout.
+
+    Args:
+        layout: `descriptor.DfuSeMemoryLayout` segments.
+
+    Returns:
+        Sectors in address order.
+    """
+    sectors = []
+    for segment in layout:
+        for page_num in range(segment.num_pages):
+            sectors.append(
+                Sector(
+                    index=len(sectors),
+                    addr=segment.addr + page_num * segment.page_size,
+                    size=segment.page_size,
+                )
+            )
+    return sectors
+
+
+def sectors_from_sizes(
+    flash_start: int,
+    erase_sizes: Sequence[int],
+    flash_size: int,
+) -> List[Sector]:
+    """Build a sector map from a pystlink ``erase_sizes`` table.
+
+    The table is repeated until the flash size is reached, the same way
+    ``stm32fs.Flash.erase_sectors`` walks it.
+
+    Args:
+        flash_start: Address of the first sector.
+        erase_sizes: Sector sizes in bytes.
+        flash_size: Flash size in bytes.
+
+    Returns:
+        Sectors in address order.
+    """
+    sectors: List[Sector] = []
+    addr = flash_start
+    end = flash_start + flash_size
+    while addr < end:
+        for size in erase_sizes:
+            if addr >= end:
+                break
+            sectors.append(
+                Sector(
+                    index=len(sectors),
+                    addr=addr,
+                    size=size,
+                )
+            )
+            addr += size
+    return sectors
+
+
+def touched_sectors(
+    sectors: Sequence[Sector],
+    segments: Iterable[Tuple[int, int]],
+) -> List[Sector]:
+    """Find the sectors overlapped by image segments.
+
+    Args:
+        sectors: Sector map in address order.
+        segments: Image segments as (address, length).
+
+    Returns:
+        Each overlapped sector once, in address order.
+
+    Raises:
+        ValueError: A segment lies outside the sector map.
+    """
+    touched = {}
+    for addr, length in segments:
+        if not length:
+            continue
+        end = addr + length
+        found = [s for s in sectors if s.addr < end and addr < s.end]
+        if not found or found[0].addr > addr or found[-1].end < end:
+            raise ValueError(
+                f"Сегмент 0x{addr:08x}..0x{end:08x} вне карты секторов flash"
+            )
+        for sector in found:
+            touched[sector.index] = sector
+    return [touched[index] for index in sorted(touched)]
+
+
+def _is_done(
+    sector: Sector,
+    segments: Sequence[Tuple[int, int]],
+    done: Sequence[Tuple[int, int]],
+) -> bool:
+    for addr, length in segments:
+        start = max(sector.addr, addr)
+        end = min(sector.end, addr + length)
+        if start < end and not any(lo <= start and end <= hi for lo, hi in done):
+            return False
+    return True
+
+
+def plan_erase(
+    sectors: Sequence[Sector],
+    segments: Iterable[Tuple[int, int]],
+    erase_time: EraseTime = typical_erase_time,
+    mass_erase_time: Optional[float] = None,
+    is_blank: Optional[BlankCheck] = None,
+    done: Sequence[Tuple[int, int]] = (),
+    overhead: float = SECTOR_OVERHEAD,
+) -> ErasePlan:
+    """Plan the erase needed to write image segments.
+
+    Args:
+        sectors: Sector map of the device.
+        segments: Image segments as (address, length).
+        erase_time: Erase time estimate for a sector.
+        mass_erase_time: Mass erase time estimate, or None if mass erase must
+            not be used (e.g. it would destroy data outside the image).
+        is_blank: Blank-check read. Sectors it reports as erased are reused.
+        done: Merged (start, end) intervals already written by an interrupted
+            job. Sectors whose image data lies fully inside them are kept.
+
+    Returns:
+        `ErasePlan`.
+
+    Raises:
+        ValueError: A segment lies outside the sector map.
+    """
+    segments = list(segments)
+    plan = ErasePlan(sectors=[])
+    for sector in touched_sectors(sectors, segments):
+        if done and _is_done(sector, segments, done):
+            plan.skipped.append(sector)
+        else:
+            plan.sectors.append(sector)
+
+    if is_blank is not None:
+        # Blank check reads stop at the first programmed byte, so sectors
+        # holding old firmware cost a single read
+        dirty = []
+        for sector in plan.sectors:
+            if is_blank(sector):
+                plan.blank.append(sector)
+            else:
+                dirty.append(sector)
+        plan.sectors = dirty
+
+    plan.estimate = sum(erase_time(s) + overhead for s in plan.sectors)
+    if (
+        mass_erase_time is not None
+        and not plan.skipped
+        and mass_erase_time + overhead < plan.estimate
+    ):
+        plan.mass_erase = True
+        plan.estimate = mass_erase_time + overhead
+
+    logger.debug("Erase plan: %s", plan)
+    return plan
+
+
+def is_erased(
+    blocks: Iterable[bytes],
+) -> bool:
+    """Check streamed read-back for the erased state.
+
+    Consumes blocks only until the first programmed byte.
+
+    Args:
+        blocks: Memory blocks in address order.
+
+    Returns:
+        True if every byte is 0xFF.
+    """
+    for block in blocks:
+        if block.count(0xFF) != len(block):
+            return False
+    return True
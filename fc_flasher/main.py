@@ -6,58 +6,167 @@
 - Загрузить двоичные файлы в DFU-устройства с помощью команды `download`. Если в устройстве реализован
   протокол DfuSe (например, STM32), необходимо указать `адрес`, который является началом двоичного файла в устройстве.
   началом двоичного файла в памяти устройства.
+- Прошить несколько DFU-устройств параллельно с помощью `download_many`. Устройства
+  задаются адресами `vid:pid:serial@path` (см. `address`), прогресс каждого устройства
+  публикуется в общей `ProgressModel`.
+- Проверить записанную прошивку чтением (DFU UPLOAD) с помощью `verify` или параметра
+  `verify` у `download`, сохранить текущую прошивку в файл с помощью `backup`.
 """
+import contextlib
+import dataclasses
+import hashlib
 import logging
 import tempfile
-from typing import List, Optional
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import usb
 from intelhex import IntelHex
-from rich.progress import Progress, TaskID
 
-from . import descriptor, dfu, dfuse
+from . import descriptor, dfu, dfuse, erase
+from .address import DfuAddress, get_address
+from .progress import ProgressModel, print_listener
 
 _BYTES_PER_KILOBYTE = 1024
 
+# Called with (address, length, crc32) after each chunk is written
+WrittenCallback = Callable[[int, int, int], None]
+
 logger = logging.getLogger(__name__)
 
 
-def _make_progress_bar(
-    progress: Progress,
-    total: int,
-) -> Optional[TaskID]:
-    """Create task for rich progress bar, but only if logging level is not
-    DEBUG since they would conflict on the output.
+@dataclasses.dataclass
+class DownloadResult:
+    """Result of downloading to a single device."""
+
+    address: str
+    success: bool
+    error: Optional[str] = None
+    elapsed: float = 0.0
+
+
+@dataclasses.dataclass
+class ImageDigest:
+    """Size and checksums of a firmware image."""
+
+    size: int
+    crc32: int
+    sha256: str
+
+
+class VerifyError(RuntimeError):
+    """Read-back data does not match the downloaded image."""
+
+
+def _stream_digest(
+    blocks: Iterable[bytes],
+    expected: Optional[bytes] = None,
+    start_address: int = 0,
+) -> ImageDigest:
+    """Compute checksums of streamed blocks, optionally comparing them with an
+    expected image on the way.
+
+    Blocks are hashed incrementally and dropped, so the stream is never
+    materialized in memory.
 
     Args:
-        progress: rich progress bar.
+        blocks: Data blocks in address order.
+        expected: Expected image; a mismatching block stops the stream.
+        start_address: Device address of the first block, for error messages.
 
     Returns:
-        Task for rich progress bar or None if logging level is DEBUG.
+        `ImageDigest` of the streamed data.
+
+    Raises:
+        VerifyError: A block does not match the expected image.
     """
-    if logger.getEffectiveLevel() != logging.DEBUG:
-        return progress.add_task(
-            "[blue]Прошивка загружена",
-            total=total,
-            start_task=False,
-        )
+    view = memoryview(expected) if expected is not None else None
+    crc = 0
+    sha = hashlib.sha256()
+    size = 0
+    for block in blocks:
+        if view is not None and block != view[size : size + len(block)]:
+            raise VerifyError(
+                f"Ошибка верификации в блоке 0x{start_address + size:08x}"
+            )
+        crc = zlib.crc32(block, crc)
+        sha.update(block)
+        size += len(block)
+    return ImageDigest(
+        size=size,
+        crc32=crc,
+        sha256=sha.hexdigest(),
+    )
+
+
+def _merge_ranges(
+    ranges: Iterable[Tuple[int, int]],
+) -> List[Tuple[int, int]]:
+    """Merge (address, length) ranges into sorted, non-overlapping
+    (start, end) intervals.
+
+    Args:
+        ranges: Address ranges as (address, length).
+
+    Returns:
+        Sorted list of (start, end) intervals, end exclusive.
+    """
+    merged: List[Tuple[int, int]] = []
+    for start, length in sorted(ranges):
+        end = start + length
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (
+                merged[-1][0],
+                max(merged[-1][1], end),
+            )
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _is_covered(
+    merged: List[Tuple[int, int]],
+    start: int,
+    end: int,
+) -> bool:
+    """Check whether [start, end) lies inside one merged interval.
 
-    return None
+    Args:
+        merged: Intervals from `_merge_ranges`.
+        start: Start address.
+        end: End address, exclusive.
+
+    Returns:
+        True if the whole range is covered.
+    """
+    return any(lo <= start and end <= hi for lo, hi in merged)
 
 
 def _get_dfu_devices(
     vid: Optional[int] = None,
     pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    path: Optional[str] = None,
 ) -> List[usb.core.Device]:
     """Get USB devices in DFU mode.
 
     Args:
         vid: Filter by VID if provided.
         pid: Filter by PID if provided.
+        serial: Filter by serial number if provided.
+        path: Filter by USB port path if provided.
 
     Returns:
         List of USB devices which are currently in DFU mode.
     """
+    address = DfuAddress(
+        vid=vid,
+        pid=pid,
+        serial=serial,
+        path=path,
+    )
 
     class FilterDFU:  # pylint: disable=too-few-public-methods
         """Identify devices which are in DFU mode."""
@@ -66,15 +175,13 @@ def _get_dfu_devices(
             self,
             device: usb.core.Device,
         ) -> bool:
-            if vid is None or vid == device.idVendor:
-                if pid is None or pid == device.idProduct:
-                    for cfg in device:
-                        for intf in cfg:
-                            if (
-                                intf.bInterfaceClass == 0xFE
-                                and intf.bInterfaceSubClass == 1
-                            ):
-                                return True
+            for cfg in device:
+                for intf in cfg:
+                    if (
+                        intf.bInterfaceClass == 0xFE
+                        and intf.bInterfaceSubClass == 1
+                    ):
+                        return address.matches(device)
             return False
 
     return list(
@@ -91,6 +198,11 @@ def _dfuse_download(
     data: bytes,
     xfer_size: int,
     start_address: int,
+    progress: ProgressModel,
+    key: str,
+    verify: bool = False,
+    resume: Sequence[Tuple[int, int]] = (),
+    on_written: Optional[WrittenCallback] = None,
 ) -> None:
     """Download data to DfuSe device.
 
@@ -100,6 +212,16 @@ def _dfuse_download(
         data: Binary data to download.
         xfer_size: Transfer size to use when downloading.
         start_address: Start address of data in device memory.
+        progress: Shared progress model.
+        key: Device address in the progress model.
+        verify: Read the written range back and compare it before leaving DFU.
+        resume: (address, length) ranges already written by an interrupted
+            download. Pages fully covered by them are neither erased nor
+            written again. Pages which read back blank are not erased.
+        on_written: Called after each chunk is written.
+
+    Raises:
+        VerifyError: Read-back does not match the data.
     """
     # Clear status, possibly leftover from previous transaction
     dfu.clear_status(
@@ -107,51 +229,100 @@ def _dfuse_download(
         interface,
     )
 
-    for (
-        segment_num,
-        segment,
-    ) in enumerate(
+    written = _merge_ranges(resume)
+    sectors = erase.sectors_from_layout(
         descriptor.get_memory_layout(
             dev,
             interface,
         )
-    ):
-        for page_num in range(segment.num_pages):
-            page_addr = segment.addr + page_num * segment.page_size
-            if start_address <= page_addr <= start_address + len(data):
-                print(
-                    f"Стирание страницы 0x{page_addr} размером {segment.page_size} в сегменте {segment_num}",
-                )
+    )
 
-                dfuse.page_erase(
+    def is_blank(
+        sector: erase.Sector,
+    ) -> bool:
+        try:
+            with contextlib.closing(
+                dfuse.read_memory(
                     dev,
                     interface,
-                    page_addr,
+                    sector.addr,
+                    sector.size,
+                    xfer_size,
                 )
+            ) as blocks:
+                return erase.is_erased(blocks)
+        except (usb.core.USBError, RuntimeError):
+            # Read protected: erase as usual
+            dfu.clear_status(
+                dev,
+                interface,
+            )
+            return False
+
+    plan = erase.plan_erase(
+        sectors,
+        [(start_address, len(data))],
+        # Mass erase would also wipe everything in front of the image
+        mass_erase_time=(
+            erase.mass_erase_estimate(sectors)
+            if not written and sectors and sectors[0].addr == start_address
+            else None
+        ),
+        is_blank=is_blank,
+        done=written,
+    )
+    print(f"[{key}] План стирания: {plan}")
+
+    if plan.mass_erase:
+        print(f"[{key}] Полное стирание flash")
+        dfuse.mass_erase(
+            dev,
+            interface,
+        )
+    else:
+        for sector in plan.sectors:
+            print(
+                f"[{key}] Стирание страницы 0x{sector.addr:08x} размером {sector.size}",
+            )
+            dfuse.page_erase(
+                dev,
+                interface,
+                sector.addr,
+            )
+
+    done_pages = [(sector.addr, sector.size) for sector in plan.skipped]
+    done = _merge_ranges(done_pages)
+    if done:
+        print(
+            f"[{key}] Продолжаем прерванную загрузку, "
+            f"пропущено страниц: {len(done_pages)}"
+        )
 
     # Download data
-    with Progress() as progress:
-        task = _make_progress_bar(
-            progress,
-            len(data),
+    progress.start(
+        key,
+        len(data),
+    )
+
+    bytes_downloaded = 0
+    while bytes_downloaded < len(data):
+        chunk_size = min(
+            xfer_size,
+            len(data) - bytes_downloaded,
         )
+        chunk_address = start_address + bytes_downloaded
 
-        bytes_downloaded = 0
-        while bytes_downloaded < len(data):
-            chunk_size = min(
-                xfer_size,
-                len(data) - bytes_downloaded,
-            )
+        if not done or not _is_covered(
+            done,
+            chunk_address,
+            chunk_address + chunk_size,
+        ):
             chunk = data[bytes_downloaded : bytes_downloaded + chunk_size]
 
             dfuse.set_address(
                 dev,
                 interface,
-                start_address + bytes_downloaded,
-            )
-
-            print(
-                f"Загрузка {chunk_size} байт (всего: {bytes_downloaded} байт)",
+                chunk_address,
             )
 
             # Unclear why 2 is needed for DfuSe vs. a counter for DFU
@@ -162,13 +333,37 @@ def _dfuse_download(
                 chunk,
             )
 
-            bytes_downloaded += chunk_size
-            if task is not None:
-                progress.update(
-                    task,
-                    advance=chunk_size,
+            if on_written is not None:
+                on_written(
+                    chunk_address,
+                    chunk_size,
+                    zlib.crc32(chunk),
                 )
 
+        bytes_downloaded += chunk_size
+        progress.advance(
+            key,
+            chunk_size,
+        )
+
+    if verify:
+        digest = _stream_digest(
+            dfuse.read_memory(
+                dev,
+                interface,
+                start_address,
+                len(data),
+                xfer_size,
+            ),
+            expected=data,
+            start_address=start_address,
+        )
+        if digest.size != len(data):
+            raise VerifyError(
+                f"[{key}] Прочитано {digest.size} из {len(data)} байт"
+            )
+        print(f"[{key}] Прошивка верифицирована")
+
     # Set jump address
     dfuse.set_address(
         dev,
@@ -193,6 +388,8 @@ def _dfu_download(
     interface: int,
     data: bytes,
     xfer_size: int,
+    progress: ProgressModel,
+    key: str,
 ) -> None:
     """Download data to DFU device.
 
@@ -201,41 +398,37 @@ def _dfu_download(
         interface: USB device interface.
         data: Binary data to download.
         xfer_size: Transfer size to use when downloading.
+        progress: Shared progress model.
+        key: Device address in the progress model.
     """
     # Download data
-    with Progress() as progress:
-        task = _make_progress_bar(
-            progress,
-            len(data),
-        )
-
-        transaction = 0
-        bytes_downloaded = 0
-        while bytes_downloaded < len(data):
-            chunk_size = min(
-                xfer_size,
-                len(data) - bytes_downloaded,
-            )
-            chunk = data[bytes_downloaded : bytes_downloaded + chunk_size]
+    progress.start(
+        key,
+        len(data),
+    )
 
-            print(
-                f"Downloading {chunk_size} bytes (total: {bytes_downloaded} bytes)",
-            )
+    transaction = 0
+    bytes_downloaded = 0
+    while bytes_downloaded < len(data):
+        chunk_size = min(
+            xfer_size,
+            len(data) - bytes_downloaded,
+        )
+        chunk = data[bytes_downloaded : bytes_downloaded + chunk_size]
 
-            dfu.download(
-                dev,
-                interface,
-                transaction,
-                chunk,
-            )
+        dfu.download(
+            dev,
+            interface,
+            transaction,
+            chunk,
+        )
 
-            transaction += 1
-            bytes_downloaded += chunk_size
-            if task is not None:
-                progress.update(
-                    task,
-                    advance=chunk_size,
-                )
+        transaction += 1
+        bytes_downloaded += chunk_size
+        progress.advance(
+            key,
+            chunk_size,
+        )
 
     # End with empty download
     try:
@@ -264,6 +457,7 @@ def list_devices(
         vid=vid,
         pid=pid,
     ):
+        print(get_address(device))
         for cfg in device:
             for intf in cfg:
                 for segment in descriptor.get_memory_layout(
@@ -288,18 +482,18 @@ def list_devices(
                     )
 
 
-def download(
+def _load_image(
     filename: str,
-    interface: int = 0,
-    vid: Optional[int] = None,
-    pid: Optional[int] = None,
-    address: Optional[int] = 0x8000000,
-) -> None:
-    """... (Текущая документация)"""
-    print(
-        "Downloading binary file: %s",
-        filename,
-    )
+) -> bytes:
+    """Read a firmware image, converting Intel HEX to binary if needed.
+
+    Args:
+        filename: Path to .bin or .hex file.
+
+    Returns:
+        Binary image data.
+    """
+    print(f"Downloading binary file: {filename}")
 
     # Определение расширения файла
     ext = filename.lower().split(".")[-1]
@@ -327,11 +521,64 @@ def download(
         filename,
         "rb",
     ) as fin:
-        data = fin.read()
+        return fin.read()
+
+
+@contextlib.contextmanager
+def _claimed(
+    dev: usb.core.Device,
+    interface: int,
+) -> Iterator[descriptor.DfuDescriptor]:
+    """Claim the DFU interface of a device for the duration of the block.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+
+    Yields:
+        DFU descriptor of the device.
+    """
+    dev.set_configuration(1)
+    try:
+        dfu.claim_interface(
+            dev,
+            interface,
+        )
 
+        dfu_desc = descriptor.get_dfu_descriptor(dev)
+        if dfu_desc is None:
+            raise ValueError("No DFU descriptor, is this a valid DFU device?")
+
+        yield dfu_desc
+    finally:
+        dfu.release_interface(dev)
+
+
+def _find_device(
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    path: Optional[str] = None,
+) -> usb.core.Device:
+    """Find exactly one device in DFU mode.
+
+    Args:
+        vid: Filter by VID if provided.
+        pid: Filter by PID if provided.
+        serial: Filter by serial number if provided.
+        path: Filter by USB port path if provided.
+
+    Returns:
+        The matching USB device.
+
+    Raises:
+        RuntimeError: None or more than one device matched.
+    """
     devices = _get_dfu_devices(
         vid=vid,
         pid=pid,
+        serial=serial,
+        path=path,
     )
 
     if not devices:
@@ -339,38 +586,468 @@ def download(
 
     if len(devices) > 1:
         raise RuntimeError(
-            f"Too many devices in DFU mode ({len(devices)}). List devices for "
-            "more info and specify vid:pid to filter."
+            f"Too many devices in DFU mode ({len(devices)}): "
+            + ", ".join(str(get_address(dev)) for dev in devices)
+            + ". Specify serial or port path to filter, or use download_many."
         )
 
-    dev = devices[0]
-    dev.set_configuration(1)
-    try:
-        dfu.claim_interface(
+    return devices[0]
+
+
+def _flash_size(
+    dev: usb.core.Device,
+    interface: int,
+    address: int,
+) -> int:
+    """Get the size of device memory from `address` to the end of the memory
+    layout which contains it.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        address: Start address in device memory.
+
+    Returns:
+        Number of bytes.
+
+    Raises:
+        ValueError: Address is outside of the memory layout.
+    """
+    layout = descriptor.get_memory_layout(
+        dev,
+        interface,
+    )
+    for segment in layout:
+        if segment.addr <= address <= segment.last_addr:
+            return layout[-1].last_addr + 1 - address
+    raise ValueError(f"Address 0x{address:08x} is outside of device memory")
+
+
+def _backup_device(
+    dev: usb.core.Device,
+    interface: int,
+    dfu_desc: descriptor.DfuDescriptor,
+    filename: str,
+    address: int,
+    length: Optional[int],
+    xfer_size: Optional[int],
+) -> ImageDigest:
+    """Dump device memory to a file, streaming block by block.
+
+    Args:
+        dev: USB device with claimed DFU interface.
+        interface: USB device interface.
+        dfu_desc: DFU descriptor of the device.
+        filename: Output file.
+        address: Start address in device memory.
+        length: Number of bytes, up to the end of flash if None.
+        xfer_size: UPLOAD transfer size, descriptor wTransferSize if None.
+
+    Returns:
+        `ImageDigest` of the dumped data.
+    """
+    if dfu_desc.bcdDFUVersion != dfuse.DFUSE_VERSION_NUMBER:
+        raise ValueError("Read-back is only supported for DfuSe devices")
+
+    if length is None:
+        length = _flash_size(
             dev,
             interface,
+            address,
         )
 
-        dfu_desc = descriptor.get_dfu_descriptor(dev)
-        if dfu_desc is None:
-            raise ValueError("No DFU descriptor, is this a valid DFU device?")
+    dfu.clear_status(
+        dev,
+        interface,
+    )
+
+    with open(
+        filename,
+        "wb",
+    ) as fout:
+
+        def blocks() -> Iterator[bytes]:
+            for block in dfuse.read_memory(
+                dev,
+                interface,
+                address,
+                length,
+                xfer_size or dfu_desc.wTransferSize,
+            ):
+                fout.write(block)
+                yield block
+
+        digest = _stream_digest(blocks())
+
+    print(
+        f"Сохранено {digest.size} байт с 0x{address:08x} в {filename} "
+        f"(CRC32 {digest.crc32:08x})"
+    )
+    return digest
+
+
+def _download_device(
+    dev: usb.core.Device,
+    interface: int,
+    data: bytes,
+    address: Optional[int],
+    progress: ProgressModel,
+    key: str,
+    verify: bool = False,
+    backup_file: Optional[str] = None,
+    resume: Sequence[Tuple[int, int]] = (),
+    on_written: Optional[WrittenCallback] = None,
+) -> None:
+    """Claim the DFU interface of one device and download data to it.
 
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        data: Binary data to download.
+        address: Start address of data in device memory (DfuSe only).
+        progress: Shared progress model.
+        key: Device address in the progress model.
+        verify: Read back and compare the written range (DfuSe only).
+        backup_file: Dump the current flash to this file before erasing
+            (DfuSe only).
+        resume: Ranges already written by an interrupted download (DfuSe
+            only).
+        on_written: Called with (address, length, crc32) after each chunk is
+            written (DfuSe only).
+    """
+    with _claimed(
+        dev,
+        interface,
+    ) as dfu_desc:
         if dfu_desc.bcdDFUVersion == dfuse.DFUSE_VERSION_NUMBER:
             if address is None:
                 raise ValueError("Must provide address for DfuSe")
+            if backup_file is not None and not resume:
+                _backup_device(
+                    dev,
+                    interface,
+                    dfu_desc,
+                    backup_file,
+                    address,
+                    None,
+                    None,
+                )
             _dfuse_download(
                 dev,
                 interface,
                 data,
                 dfu_desc.wTransferSize,
                 address,
+                progress,
+                key,
+                verify,
+                resume,
+                on_written,
             )
         else:
+            if verify or backup_file is not None:
+                raise ValueError("Read-back is only supported for DfuSe devices")
             _dfu_download(
                 dev,
                 interface,
                 data,
                 dfu_desc.wTransferSize,
+                progress,
+                key,
             )
-    finally:
-        dfu.release_interface(dev)
+
+
+def download(
+    filename: str,
+    interface: int = 0,
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    address: Optional[int] = 0x8000000,
+    serial: Optional[str] = None,
+    path: Optional[str] = None,
+    progress: Optional[ProgressModel] = None,
+    verify: bool = False,
+    backup_file: Optional[str] = None,
+    resume: Sequence[Tuple[int, int]] = (),
+    on_written: Optional[WrittenCallback] = None,
+) -> None:
+    """Download a binary file to a single DFU device.
+
+    Args:
+        filename: Path to .bin or .hex file.
+        interface: USB device interface.
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        address: Start address of data in device memory (DfuSe only).
+        serial: Serial number to narrow the search for DFU devices.
+        path: USB port path to narrow the search for DFU devices.
+        progress: Shared progress model. If None, a private one prints
+            throttled progress lines.
+        verify: Read back and compare the written range (DfuSe only).
+        backup_file: Dump the current flash to this file before erasing
+            (DfuSe only). Skipped when resuming.
+        resume: (address, length) ranges already written by an interrupted
+            download of the same image (DfuSe only).
+        on_written: Called with (address, length, crc32) after each chunk is
+            written, e.g. to journal progress (DfuSe only).
+
+    Raises:
+        RuntimeError: None or more than one device matched.
+        VerifyError: Read-back does not match the image.
+    """
+    data = _load_image(filename)
+
+    dev = _find_device(
+        vid=vid,
+        pid=pid,
+        serial=serial,
+        path=path,
+    )
+    key = str(get_address(dev))
+    if progress is None:
+        progress = ProgressModel()
+        progress.add_listener(print_listener())
+    progress.add_device(key)
+
+    try:
+        _download_device(
+            dev,
+            interface,
+            data,
+            address,
+            progress,
+            key,
+            verify,
+            backup_file,
+            resume,
+            on_written,
+        )
+    except Exception as ex:
+        progress.finish(
+            key,
+            str(ex),
+        )
+        raise
+    progress.finish(key)
+
+
+def verify(
+    filename: str,
+    interface: int = 0,
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    address: int = 0x8000000,
+    serial: Optional[str] = None,
+    path: Optional[str] = None,
+    xfer_size: Optional[int] = None,
+) -> ImageDigest:
+    """Compare the flash of a DfuSe device with a binary file.
+
+    The read-back is streamed through CRC32/SHA-256 and compared block by
+    block, so it stops at the first mismatching block.
+
+    Args:
+        filename: Path to .bin or .hex file.
+        interface: USB device interface.
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        address: Start address of data in device memory.
+        serial: Serial number to narrow the search for DFU devices.
+        path: USB port path to narrow the search for DFU devices.
+        xfer_size: UPLOAD transfer size, descriptor wTransferSize if None.
+
+    Returns:
+        `ImageDigest` of the read-back, equal to the one of the file.
+
+    Raises:
+        VerifyError: Read-back does not match the image.
+    """
+    data = _load_image(filename)
+
+    dev = _find_device(
+        vid=vid,
+        pid=pid,
+        serial=serial,
+        path=path,
+    )
+    with _claimed(
+        dev,
+        interface,
+    ) as dfu_desc:
+        if dfu_desc.bcdDFUVersion != dfuse.DFUSE_VERSION_NUMBER:
+            raise ValueError("Read-back is only supported for DfuSe devices")
+
+        dfu.clear_status(
+            dev,
+            interface,
+        )
+        digest = _stream_digest(
+            dfuse.read_memory(
+                dev,
+                interface,
+                address,
+                len(data),
+                xfer_size or dfu_desc.wTransferSize,
+            ),
+            expected=data,
+            start_address=address,
+        )
+
+    if digest.size != len(data):
+        raise VerifyError(f"Прочитано {digest.size} из {len(data)} байт")
+    print(f"Прошивка совпадает (SHA-256 {digest.sha256})")
+    return digest
+
+
+def backup(
+    filename: str,
+    length: Optional[int] = None,
+    interface: int = 0,
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    address: int = 0x8000000,
+    serial: Optional[str] = None,
+    path: Optional[str] = None,
+    xfer_size: Optional[int] = None,
+) -> ImageDigest:
+    """Dump the flash of a DfuSe device to a binary file.
+
+    Args:
+        filename: Output file.
+        length: Number of bytes, up to the end of flash if None.
+        interface: USB device interface.
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        address: Start address in device memory.
+        serial: Serial number to narrow the search for DFU devices.
+        path: USB port path to narrow the search for DFU devices.
+        xfer_size: UPLOAD transfer size, descriptor wTransferSize if None.
+
+    Returns:
+        `ImageDigest` of the dumped data.
+    """
+    dev = _find_device(
+        vid=vid,
+        pid=pid,
+        serial=serial,
+        path=path,
+    )
+    with _claimed(
+        dev,
+        interface,
+    ) as dfu_desc:
+        return _backup_device(
+            dev,
+            interface,
+            dfu_desc,
+            filename,
+            address,
+            length,
+            xfer_size,
+        )
+
+
+def download_many(
+    filename: str,
+    addresses: Optional[Sequence[DfuAddress]] = None,
+    interface: int = 0,
+    address: Optional[int] = 0x8000000,
+    progress: Optional[ProgressModel] = None,
+    verify: bool = False,
+) -> Dict[str, DownloadResult]:
+    """Download a binary file to several DFU devices concurrently.
+
+    Every device is flashed from its own thread with its own claimed
+    interface. A failure on one device does not stop the others.
+
+    Args:
+        filename: Path to .bin or .hex file.
+        addresses: Devices to flash, all devices in DFU mode if None. An
+            address may match several devices.
+        interface: USB device interface.
+        address: Start address of data in device memory (DfuSe only).
+        progress: Shared progress model. If None, a private one prints
+            throttled progress lines.
+        verify: Read back and compare the written range (DfuSe only).
+
+    Returns:
+        `DownloadResult` for every device, keyed by device address.
+
+    Raises:
+        RuntimeError: No devices found in DFU mode.
+    """
+    data = _load_image(filename)
+
+    if progress is None:
+        progress = ProgressModel()
+        progress.add_listener(print_listener())
+
+    devices: Dict[str, usb.core.Device] = {}
+    for dfu_address in addresses or [DfuAddress()]:
+        for dev in _get_dfu_devices(
+            vid=dfu_address.vid,
+            pid=dfu_address.pid,
+            serial=dfu_address.serial,
+            path=dfu_address.path,
+        ):
+            devices.setdefault(
+                str(get_address(dev)),
+                dev,
+            )
+
+    if not devices:
+        raise RuntimeError("No devices found in DFU mode")
+
+    results: Dict[str, DownloadResult] = {}
+    results_lock = threading.Lock()
+
+    def worker(
+        key: str,
+        dev: usb.core.Device,
+    ) -> None:
+        start = time.monotonic()
+        error = None
+        try:
+            _download_device(
+                dev,
+                interface,
+                data,
+                address,
+                progress,
+                key,
+                verify,
+            )
+        except Exception as ex:  # pylint: disable=broad-except
+            error = str(ex)
+            print(f"[{key}] Ошибка прошивки: {ex}")
+        progress.finish(
+            key,
+            error,
+        )
+        with results_lock:
+            results[key] = DownloadResult(
+                address=key,
+                success=error is None,
+                error=error,
+                elapsed=time.monotonic() - start,
+            )
+
+    threads = []
+    for key, dev in devices.items():
+        progress.add_device(key)
+        thread = threading.Thread(
+            target=worker,
+            args=(
+                key,
+                dev,
+            ),
+            name=f"dfu-{key}",
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
@@ -0,0 +1,311 @@
+"""Общая модель прогресса для прошивки нескольких устройств.
+
+Ей пользуются DFU, esptool и заливка конфига. Источники сообщают о каждом
+блоке, а до окна и журнала задач обновления доходят через `ThrottledListener`
+не чаще `UI_REFRESH_HZ` раз в секунду.
+"""
+
+import dataclasses
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+# Device states
+STATE_PENDING = "pending"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+# Progress updates per second forwarded to the UI
+UI_REFRESH_HZ = 10
+
+
+@dataclasses.dataclass
+class DeviceProgress:
+    """Progress of a single device."""
+
+    address: str
+    total: int = 0
+    done: int = 0
+    state: str = STATE_PENDING
+    error: Optional[str] = None
+    started: float = 0.0
+    finished: float = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        if not self.started:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        """Average speed in bytes per second."""
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds left at the average speed, None until it is known."""
+        if self.state != STATE_RUNNING or not self.rate:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+    def as_dict(self) -> dict:
+        """Snapshot for JSON consumers (job status, HTTP service)."""
+        eta = self.eta
+        return {
+            "device": self.address,
+            "done": self.done,
+            "total": self.total,
+            "state": self.state,
+            "rate": round(self.rate),
+            "eta": None if eta is None else round(eta, 1),
+        }
+
+    def __str__(self) -> str:
+        percent = 100 * self.done // self.total if self.total else 0
+        text = f"[{self.address}] {percent}% {self.done}/{self.total}"
+        if self.rate:
+            text += f", {self.rate / 1024:.1f} КБ/с"
+        if self.eta is not None:
+            text += f", осталось {self.eta:.0f} с"
+        return text
+
+
+ProgressListener = Callable[[DeviceProgress], None]
+
+
+class ProgressModel:
+    """Thread-safe progress shared by all download workers.
+
+    Every worker reports against its own device address. Listeners are called
+    with a copy of the device progress after each change, from the worker
+    thread which made the change.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._devices: Dict[str, DeviceProgress] = {}
+        self._listeners: List[ProgressListener] = []
+
+    def add_listener(
+        self,
+        listener: ProgressListener,
+    ) -> None:
+        """Subscribe to progress changes.
+
+        Args:
+            listener: Callable receiving a `DeviceProgress` snapshot.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def add_device(
+        self,
+        address: str,
+    ) -> None:
+        """Register a device before its worker starts.
+
+        Args:
+            address: Device address string.
+        """
+        with self._lock:
+            self._devices[address] = DeviceProgress(address=address)
+
+    def start(
+        self,
+        address: str,
+        total: int,
+    ) -> None:
+        """Mark device download as started.
+
+        Args:
+            address: Device address string.
+            total: Number of bytes to download.
+        """
+        self._update(
+            address,
+            total=total,
+            done=0,
+            state=STATE_RUNNING,
+            started=time.monotonic(),
+        )
+
+    def advance(
+        self,
+        address: str,
+        count: int,
+    ) -> None:
+        """Add downloaded bytes to the device progress.
+
+        Args:
+            address: Device address string.
+            count: Number of bytes downloaded since the last call.
+        """
+        with self._lock:
+            progress = self._devices[address]
+            progress.done += count
+            snapshot = dataclasses.replace(progress)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(snapshot)
+
+    def set_done(
+        self,
+        address: str,
+        done: int,
+        total: Optional[int] = None,
+    ) -> None:
+        """Set absolute progress, for sources which count bytes themselves.
+
+        Starts the device on the first call or when the total changes (e.g.
+        the next file of a multi-file write).
+
+        Args:
+            address: Device address string.
+            done: Bytes done so far.
+            total: Number of bytes to do, None to keep the current total.
+        """
+        with self._lock:
+            progress = self._devices.get(address)
+            restart = (
+                progress is None
+                or progress.state != STATE_RUNNING
+                or (total is not None and total != progress.total)
+            )
+        if restart:
+            self.start(
+                address,
+                total or 0,
+            )
+        self._update(
+            address,
+            done=done,
+        )
+
+    def reporter(
+        self,
+        address: str,
+    ) -> Callable[[int, int], None]:
+        """Callback with (done, total) arguments reporting to this model.
+
+        Args:
+            address: Device address string.
+
+        Returns:
+            Callable for loops which report absolute progress, e.g. esptool.
+        """
+        return lambda done, total: self.set_done(
+            address,
+            done,
+            total,
+        )
+
+    def finish(
+        self,
+        address: str,
+        error: Optional[str] = None,
+    ) -> None:
+        """Mark device download as finished.
+
+        Args:
+            address: Device address string.
+            error: Error description or None on success.
+        """
+        self._update(
+            address,
+            state=STATE_FAILED if error else STATE_DONE,
+            error=error,
+            finished=time.monotonic(),
+        )
+
+    def get(
+        self,
+        address: str,
+    ) -> DeviceProgress:
+        """Get a copy of the device progress.
+
+        Args:
+            address: Device address string.
+
+        Returns:
+            `DeviceProgress` snapshot.
+        """
+        with self._lock:
+            return dataclasses.replace(self._devices[address])
+
+    def snapshot(self) -> List[DeviceProgress]:
+        """Get a copy of the progress of all devices.
+
+        Returns:
+            List of `DeviceProgress`, in registration order.
+        """
+        with self._lock:
+            return [dataclasses.replace(p) for p in self._devices.values()]
+
+    def _update(
+        self,
+        address: str,
+        **changes,
+    ) -> None:
+        with self._lock:
+            progress = self._devices.setdefault(
+                address,
+                DeviceProgress(address=address),
+            )
+            for key, value in changes.items():
+                setattr(progress, key, value)
+            snapshot = dataclasses.replace(progress)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(snapshot)
+
+
+class ThrottledListener:
+    """Forward progress to a listener at most `rate` times per second.
+
+    State changes and the last block of a device are always forwarded, so the
+    listener never misses a start, a finish or 100%.
+    """
+
+    def __init__(
+        self,
+        listener: ProgressListener,
+        rate: float = UI_REFRESH_HZ,
+    ) -> None:
+        self._listener = listener
+        self._interval = 1.0 / rate
+        self._lock = threading.Lock()
+        # address -> (monotonic time, state) of the last forwarded update
+        self._last: Dict[str, tuple] = {}
+
+    def __call__(
+        self,
+        progress: DeviceProgress,
+    ) -> None:
+        now = time.monotonic()
+        with self._lock:
+            last_time, last_state = self._last.get(
+                progress.address,
+                (0.0, None),
+            )
+            if (
+                progress.state == last_state
+                and progress.done < progress.total
+                and now - last_time < self._interval
+            ):
+                return
+            self._last[progress.address] = (now, progress.state)
+        self._listener(progress)
+
+
+def print_listener(
+    rate: float = 1.0,
+) -> ThrottledListener:
+    """Listener printing one progress line per device at most `rate` times
+    per second, for console use."""
+    return ThrottledListener(
+        lambda progress: print(progress),
+        rate,
+    )
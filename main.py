@@ -7,26 +7,25 @@ from pathlib import Path
 from PySide6 import QtCore, QtGui, QtWidgets
 from PySide6.QtCore import QThread, Signal
 
-from modules import activation_ui, serial_finder, ui
-from modules.classes import ElrsUploadResult
-from modules.ELRS import ELRS
-from modules.FC import FC
+from modules import activation_ui, jobs, serial_finder, service, targets, ui
+from modules.journal import Journal
 from modules.get_path import load_file
-from modules.targets import get_targets
+from modules.target_model import setup_target_combo
 
 
 class QtTextHandler:
 
     def __init__(self):
         self.log_file_path = os.path.expanduser("~") + "/ultra_flasher.logs"
-        with open(
-            self.log_file_path, "w", encoding="utf-8"
-        ) as f:  # Очистить файл логов при каждом запуске
-            f.write("")
+        # Файл очищается при каждом запуске и остается открытым: запись
+        # идет из нескольких потоков прошивки
+        self._lock = threading.Lock()
+        self._file = open(self.log_file_path, "w", errors="ignore", encoding="utf-8")
 
     def write(self, message):
-        with open(self.log_file_path, "a", errors="ignore", encoding="utf-8") as f:
-            f.write(message)
+        with self._lock:
+            self._file.write(message)
+            self._file.flush()
 
     def isatty(self):
         return False
@@ -35,6 +34,71 @@ class QtTextHandler:
         pass
 
 
+class JobProgressBars(QtCore.QObject):
+    """Полоса прогресса на каждую задачу прошивки, обновляется из потоков
+    задач через сигнал. Правый клик по полосе отменяет задачу"""
+
+    changed = Signal(dict)
+    # Завершенные задачи остаются видны, пока полос не больше MAX_BARS
+    MAX_BARS = 3
+
+    def __init__(self, parent, geometry, cancel=None):
+        super().__init__(parent)
+        self.cancel = cancel
+        self.container = QtWidgets.QWidget(parent)
+        self.container.setGeometry(geometry)
+        self.layout = QtWidgets.QVBoxLayout(self.container)
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.layout.setSpacing(2)
+        self.bars = {}
+        self.finished = []
+        self.changed.connect(self.update_bar)
+
+    def on_job(self, job):
+        # Вызывается в потоке задачи, в окно передается снимок
+        self.changed.emit(job.status())
+
+    def update_bar(self, status):
+        bar = self.bars.get(status["id"])
+        if bar is None:
+            self.drop_finished()
+            bar = QtWidgets.QProgressBar(self.container)
+            bar.setMaximumHeight(18)
+            if self.cancel is not None:
+                bar.setContextMenuPolicy(QtCore.Qt.ContextMenuPolicy.CustomContextMenu)
+                bar.customContextMenuRequested.connect(
+                    lambda _, job_id=status["id"]: self.cancel(job_id)
+                )
+            self.layout.addWidget(bar)
+            self.bars[status["id"]] = bar
+
+        progress = status["progress"] or {}
+        bar.setMaximum(max(progress.get("total", 0), 1))
+        bar.setValue(min(progress.get("done", 0), bar.maximum()))
+        text = f"{status['port']} %p%"
+        if progress.get("rate"):
+            text += f" {progress['rate'] / 1024:.0f} КБ/с"
+        if progress.get("eta") is not None:
+            text += f" ~{progress['eta']:.0f} с"
+        if status["state"] == jobs.STATE_DONE:
+            bar.setValue(bar.maximum())
+            text = f"{status['port']} готово"
+        elif status["state"] == jobs.STATE_FAILED:
+            text = f"{status['port']} ошибка"
+        elif status["state"] == jobs.STATE_CANCELLED:
+            text = f"{status['port']} отменено"
+        bar.setFormat(text)
+        if (
+            status["state"] in jobs.FINISHED_STATES
+            and status["id"] not in self.finished
+        ):
+            self.finished.append(status["id"])
+
+    def drop_finished(self):
+        while self.finished and len(self.bars) >= self.MAX_BARS:
+            self.bars.pop(self.finished.pop(0)).deleteLater()
+
+
 class DaemonService(QThread):
     newText = Signal(str)
 
@@ -77,12 +141,37 @@ class UI(ui.Ui_Dialog):
         )
 
     def setup_misc(self):
-        targets = get_targets()
-        self.set_combo_values(self.TargetComboBox, targets, False)
+        self.target_completer = setup_target_combo(self.TargetComboBox)
         self.qt_text_handler = QtTextHandler()
+        self.journal = Journal()
         self.mainWindow.setWindowTitle("ELRS Flasher")
         sys.stdout = self.qt_text_handler
         sys.stderr = self.qt_text_handler
+        # Окно и HTTP сервис ставят задачи в одну очередь
+        self.engine = jobs.JobEngine(self.journal)
+        self.engine.install_output()
+        # Свободное место над группой ELRS
+        self.progress_bars = JobProgressBars(
+            self.flashTab,
+            QtCore.QRect(10, 10, 280, 65),
+            self.cancel_job,
+        )
+        self.engine.add_listener(self.progress_bars.on_job)
+        # Свободное место под кнопкой прошивки приемника
+        self.ElrsStlinkCheckBox = QtWidgets.QCheckBox("ST-Link", self.ElrsGroup)
+        self.ElrsStlinkCheckBox.setGeometry(QtCore.QRect(20, 130, 100, 18))
+        # Свободное место под кнопкой прошивки FC
+        self.FCStlinkCheckBox = QtWidgets.QCheckBox("ST-Link", self.FCGroup)
+        self.FCStlinkCheckBox.setGeometry(QtCore.QRect(20, 130, 100, 18))
+        self.FCForceConfigCheckBox = QtWidgets.QCheckBox(
+            "Конфиг заново", self.FCGroup
+        )
+        self.FCForceConfigCheckBox.setGeometry(QtCore.QRect(130, 130, 130, 18))
+        if os.environ.get(service.SERVICE_PORT_ENV):
+            service.start(
+                self.engine,
+                port=int(os.environ[service.SERVICE_PORT_ENV]),
+            )
 
     def setup_buttons(self):
         self.ChooseFCConfigButton.clicked.connect(self.choose_fc_config)
@@ -119,14 +208,31 @@ class UI(ui.Ui_Dialog):
             self.update_com_ports()
         elif not self.TargetComboBox.currentText():
             error_message = "Выберите таргет перед продолжением."
+        elif targets.get_table().get(self.TargetComboBox.currentText()) is None:
+            error_message = "Выберите таргет из списка."
         elif not self.BindingPhraseInput.toPlainText():
             error_message = "Введите binding-фразу перед продолжением."
+        elif (
+            self.ElrsStlinkCheckBox.isChecked()
+            and "stlink"
+            not in targets.get_table().get(self.TargetComboBox.currentText()).config
+        ):
+            error_message = "Таргет не шьется через ST-Link."
 
         if error_message:
             QtWidgets.QMessageBox.warning(self.mainWindow, "Ошибка", error_message)
             return
 
-        threading.Thread(target=self.flash_elrs, daemon=True).start()
+        self.submit_job(
+            "elrs",
+            {
+                "target": self.TargetComboBox.currentText(),
+                "phrase": self.BindingPhraseInput.toPlainText(),
+                "upload_method": (
+                    "stlink" if self.ElrsStlinkCheckBox.isChecked() else "betaflight"
+                ),
+            },
+        )
 
     def start_fc_thread(self):
 
@@ -147,49 +253,34 @@ class UI(ui.Ui_Dialog):
             QtWidgets.QMessageBox.warning(self.mainWindow, "Ошибка", error_message)
             return
 
-        threading.Thread(target=self.flash_fc, daemon=True).start()
-
-    def flash_fc(self):
-        com = self.PortComboBox.currentText()
-        firmwareFile = self.FCFirmwarePath.toPlainText()
-        configFile = self.FCConfigPath.toPlainText()
-
-        fc = FC(com, firmwareFile, configFile)
-
-        if not firmwareFile and configFile:
-            print("Пытаемся залить конфиг")
-            for i in reversed(range(15)):
-                print(f"{i}...")
-                time.sleep(1)
-            return fc.upload_config()
-
-        elif firmwareFile:
-            print("Пробуем перейти в DFU")
-            if fc.dfu():
-                print("Найдено DFU устройство")
-                fc.flash()
-                if configFile:
-                    print("Пробуем залить конфиг")
-                    for i in reversed(range(15)):
-                        print(f"{i}...")
-                        time.sleep(1)
-                    fc.upload_config()
-
-    def flash_elrs(self):
-        target = self.TargetComboBox.currentText()
-        binding_phrase = self.BindingPhraseInput.toPlainText()
-        com = self.PortComboBox.currentText()
-
-        elrs = ELRS(
-            target=target, phrase=binding_phrase, port=com, force=True, erase=False
+        self.submit_job(
+            "fc",
+            {
+                "firmware": self.FCFirmwarePath.toPlainText(),
+                "config": self.FCConfigPath.toPlainText(),
+                "upload_method": (
+                    "stlink" if self.FCStlinkCheckBox.isChecked() else "dfu"
+                ),
+                "force_config": self.FCForceConfigCheckBox.isChecked(),
+            },
+        )
+
+    def submit_job(self, kind, params):
+        try:
+            self.engine.submit(kind, self.PortComboBox.currentText(), params)
+        except jobs.JobError as ex:
+            QtWidgets.QMessageBox.warning(self.mainWindow, "Ошибка", str(ex))
+
+    def cancel_job(self, job_id):
+        answer = QtWidgets.QMessageBox.question(
+            self.mainWindow, "Отмена", f"Отменить задачу {job_id}?"
         )
-        status = elrs.flash()
-        if status == ElrsUploadResult.Success:
-            print("Успешно")
-        elif status == ElrsUploadResult.ErrorGeneral:
-            print("Произошла ошибка при прошивке")
-        elif status == ElrsUploadResult.ErrorMismatch:
-            print("Произошла ошибка при выборе таргета")
+        if answer != QtWidgets.QMessageBox.StandardButton.Yes:
+            return
+        try:
+            self.engine.cancel(job_id)
+        except jobs.JobError as ex:
+            QtWidgets.QMessageBox.warning(self.mainWindow, "Ошибка", str(ex))
 
     def set_combo_values(self, combo_box, new_values, select_last=True):
         combo_box.clear()
@@ -21,24 +21,144 @@ class PassthroughFailed(Exception):
     pass
 
 
+# Обучающая последовательность автобода ROM загрузчика ESP
+ROM_TRAINING = b"\x07\x07\x12\x20" + 32 * b"\x55"
+SPI_RX_ERROR = "ExpressLRS SPI RX detected\n\nUpdate via betaflight to flash your RX\nhttps://www.expresslrs.org/2.0/hardware/spi-receivers/"
+
+
+def serialrx_checks(
+    half_duplex,
+):
+    """(параметр, допустимые значения, подсказка) для UART приемника"""
+    return [
+        (
+            "serialrx_provider",
+            ["GHST"] if half_duplex else ["CRSF", "ELRS"],
+            "Serial Receiver Protocol is not set to CRSF! Hint: set serialrx_provider = CRSF",
+        ),
+        (
+            "serialrx_inverted",
+            ["OFF"],
+            "Serial Receiver UART is inverted! Hint: set serialrx_inverted = OFF",
+        ),
+        (
+            "serialrx_halfduplex",
+            ["OFF", "AUTO"],
+            "Serial Receiver UART is not in full duplex! Hint: set serialrx_halfduplex = OFF",
+        ),
+    ]
+
+
+def config_matches(
+    line,
+    expected,
+):
+    """Ответ на 'get <параметр>' содержит одно из значений"""
+    return any(" = %s" % key in line for key in expected)
+
+
+def check_start(
+    start,
+):
+    """Проверить ответ FC на '#'
+
+    :raises PassthroughEnabled:
+        CLI не ответил, passthrough уже включен
+    """
+    if "CCC" in start:
+        raise PassthroughEnabled("Passthrough already enabled and bootloader active")
+    elif not start or not start.endswith("#"):
+        raise PassthroughEnabled(
+            "No CLI available. Already in passthrough mode?, If this fails reboot FC and try again!"
+        )
+
+
+def serial_check_error(
+    serial_check,
+):
+    error = "\n\n [ERROR] Invalid serial RX configuration detected:\n"
+    for err in serial_check:
+        error += "    !!! %s !!!\n" % err
+    error += "\n    Please change the configuration and try again!\n"
+    return PassthroughFailed(error)
+
+
+def serialrx_index(
+    line,
+):
+    """Номер UART из строки 'serial ...', если на нем включен Serial RX"""
+    config = re.search(
+        "serial ([0-9]+) ([0-9]+) ",
+        line,
+    )
+    if config and (int(config.group(2)) & 64 == 64):
+        return config.group(1)
+    return None
+
+
+def bootloader_init_seq(
+    half_duplex,
+    chip_type,
+):
+    if half_duplex:
+        print("  * Using half duplex (GHST)")
+        return bootloader.get_init_seq(
+            "GHST",
+            chip_type,
+        )
+    print("  * Using full duplex (CRSF)")
+    return bootloader.get_init_seq(
+        "CRSF",
+        chip_type,
+    )
+
+
+def check_rx_target(
+    rx_target,
+    target,
+    action,
+    accept,
+) -> int:
+    """Сравнить таргет, о котором сообщил приемник, с прошиваемым"""
+    if target is None:
+        return ElrsUploadResult.Success
+    flash_target = re.sub(
+        "_VIA_.*",
+        "",
+        target.upper(),
+    )
+    ignore_incorrect_target = action == "uploadforce"
+    if rx_target == "":
+        print("Cannot detect RX target, blindly flashing!")
+    elif ignore_incorrect_target:
+        print(f"Force flashing {flash_target}, detected {rx_target}")
+    elif rx_target != flash_target and rx_target != accept:
+        if True:
+            pass
+        else:
+            print(
+                "Wrong target selected your RX is '%s', trying to flash '%s'"
+                % (
+                    rx_target,
+                    flash_target,
+                )
+            )
+            return ElrsUploadResult.ErrorMismatch
+    elif flash_target != "":
+        print("Verified RX target '%s'" % (flash_target))
+    return ElrsUploadResult.Success
+
+
 def _validate_serialrx(
     rl,
     config,
     expected,
 ):
-    found = False
-    if type(expected) == str:
-        expected = [expected]
     rl.set_delimiters(["# "])
     rl.clear()
     rl.write_str("get %s" % config)
     line = rl.read_line(1.0).strip()
-    for key in expected:
-        key = " = %s" % key
-        if key in line:
-            found = True
-            break
-    return found
+    return config_matches(line, expected)
 
 
 def bf_passthrough_init(
@@ -83,65 +203,25 @@ def bf_passthrough_init(
     )
     start = rl.read_line(2.0).strip()
     # print("BF INIT: '%s'" % start.replace("\r", ""))
-    if "CCC" in start:
-        raise PassthroughEnabled("Passthrough already enabled and bootloader active")
-    elif not start or not start.endswith("#"):
-        raise PassthroughEnabled(
-            "No CLI available. Already in passthrough mode?, If this fails reboot FC and try again!"
-        )
+    check_start(start)
 
-    serial_check = []
-    if not _validate_serialrx(
-        rl,
-        "serialrx_provider",
-        [
-            [
-                "CRSF",
-                "ELRS",
-            ],
-            "GHST",
-        ][half_duplex],
-    ):
-        serial_check.append(
-            "Serial Receiver Protocol is not set to CRSF! Hint: set serialrx_provider = CRSF"
-        )
-    if not _validate_serialrx(
-        rl,
-        "serialrx_inverted",
-        "OFF",
-    ):
-        serial_check.append(
-            "Serial Receiver UART is inverted! Hint: set serialrx_inverted = OFF"
-        )
-    if not _validate_serialrx(
-        rl,
-        "serialrx_halfduplex",
-        [
-            "OFF",
-            "AUTO",
-        ],
-    ):
-        serial_check.append(
-            "Serial Receiver UART is not in full duplex! Hint: set serialrx_halfduplex = OFF"
-        )
+    serial_check = [
+        hint
+        for config, expected, hint in serialrx_checks(half_duplex)
+        if not _validate_serialrx(rl, config, expected)
+    ]
     if (
         _validate_serialrx(
             rl,
             "rx_spi_protocol",
-            "EXPRESSLRS",
+            ["EXPRESSLRS"],
         )
         and serial_check
     ):
-        serial_check = [
-            "ExpressLRS SPI RX detected\n\nUpdate via betaflight to flash your RX\nhttps://www.expresslrs.org/2.0/hardware/spi-receivers/"
-        ]
+        serial_check = [SPI_RX_ERROR]
 
     if serial_check:
-        error = "\n\n [ERROR] Invalid serial RX configuration detected:\n"
-        for err in serial_check:
-            error += "    !!! %s !!!\n" % err
-        error += "\n    Please change the configuration and try again!\n"
-        raise PassthroughFailed(error)
+        raise serial_check_error(serial_check)
 
     SerialRXindex = ""
 
@@ -160,13 +240,10 @@ def bf_passthrough_init(
         if line.startswith("serial"):
             if SCRIPT_DEBUG:
                 print("  '%s'" % line)
-            config = re.search(
-                "serial ([0-9]+) ([0-9]+) ",
-                line,
-            )
-            if config and (int(config.group(2)) & 64 == 64):
+            index = serialrx_index(line)
+            if index is not None:
                 print("    ** Serial RX config detected: '%s'" % line)
-                SerialRXindex = config.group(1)
+                SerialRXindex = index
                 if not SCRIPT_DEBUG:
                     break
 
@@ -213,49 +290,25 @@ def reset_to_bootloader(
         3.0,
     )
     rl.clear()
-    if half_duplex:
-        BootloaderInitSeq = bootloader.get_init_seq(
-            "GHST",
-            chip_type,
-        )
-        print("  * Using half duplex (GHST)")
-    else:
-        BootloaderInitSeq = bootloader.get_init_seq(
-            "CRSF",
-            chip_type,
-        )
-        print("  * Using full duplex (CRSF)")
+    BootloaderInitSeq = bootloader_init_seq(
+        half_duplex,
+        chip_type,
+    )
+    if not half_duplex:
         # this is the training sequ for the ROM bootloader, we send it here so it doesn't auto-neg to the wrong baudrate by the BootloaderInitSeq that we send to reset ELRS
-        rl.write(b"\x07\x07\x12\x20" + 32 * b"\x55")
+        rl.write(ROM_TRAINING)
         time.sleep(0.2)
     rl.write(BootloaderInitSeq)
     s.flush()
     rx_target = rl.read_line().strip().upper()
-    if target is not None:
-        flash_target = re.sub(
-            "_VIA_.*",
-            "",
-            target.upper(),
-        )
-        ignore_incorrect_target = action == "uploadforce"
-        if rx_target == "":
-            print("Cannot detect RX target, blindly flashing!")
-        elif ignore_incorrect_target:
-            print(f"Force flashing {flash_target}, detected {rx_target}")
-        elif rx_target != flash_target and rx_target != accept:
-            if True:
-                pass
-            else:
-                print(
-                    "Wrong target selected your RX is '%s', trying to flash '%s'"
-                    % (
-                        rx_target,
-                        flash_target,
-                    )
-                )
-                return ElrsUploadResult.ErrorMismatch
-        elif flash_target != "":
-            print("Verified RX target '%s'" % (flash_target))
+    result = check_rx_target(
+        rx_target,
+        target,
+        action,
+        accept,
+    )
+    if result != ElrsUploadResult.Success:
+        return result
     time.sleep(0.8)
     s.close()
 
@@ -1,30 +1,42 @@
-import hashlib
+import asyncio
+import contextlib
+import copy
 import json
-import mmap
+import os
+import shutil
 import sys
 import tempfile
-import time/
+import time
+import zlib
 from os.path import dirname
 from random import randint
 
-import jmespath
-import requests
-
 from external.esptool import esptool
-from modules import BFinitPassthrough, UnifiedConfig
+from modules import (
+    STLink,
+    UARTupload,
+    UnifiedConfig,
+    binary_configurator,
+    image_check,
+    mirror,
+    targets,
+)
+from modules import journal as job_journal
+from modules import manifest as firmware_manifest
 from modules.classes import (
     DeviceType,
     ElrsUploadResult,
-    FirmwareOptions,
     MCUType,
     RadioType,
 )
-from modules.get_path import load_file
 
 sys.path.append(dirname(__file__) + "/external/esptool")
 
 sys.path.append(dirname(__file__) + "/external")
 
+# esptool стирает flash секторами, прерванная запись продолжается с границы
+FLASH_SECTOR_SIZE = 0x1000
+
 
 class ELRS:
     def __init__(
@@ -34,81 +46,120 @@ class ELRS:
         port: str,
         force: bool = False,
         erase=True,
+        journal=None,
+        upload_method="betaflight",
+        progress=None,
+        factory=False,
+        prepared=None,
+        version=mirror.DEFAULT_VERSION,
+        flavour=mirror.FLAVOURS[0],
     ) -> None:
         self.target = target
-        self.target_json = json.loads(
-            open(
-                load_file("resources/targets.json"),
-                "r",
-            ).read()
-        )
+        # Версия и регион (FCC/LBT) прошивки на сервере и в зеркале
+        self.version = version
+        self.flavour = flavour
+        self.journal = journal
+        # fc_flasher.progress.ProgressModel, прогресс записи по self.port
+        self.progress = progress
+        self.job_id = None
+        self.upload_method = upload_method
         self.phrase = phrase
         self.port = port
         self.baud = 420000
         self.mode = "uploadforce"
         self.erase = erase
+        # Новый ESP32 приемник: все части одним образом (manifest.merged)
+        self.factory = factory
+        self.merged_manifest = None
         self.force = force
-        self.config = jmespath.search(
-            ".".join(
-                map(
-                    lambda s: f'"{s}"',
-                    self.target.split("."),
-                )
-            ),
-            self.target_json,
-        )
+        self.target_info = targets.find(self.target)
+        self.config = self.target_info.config
         self.accept = self.config.get("prior_target_name")
-        self.firmware_link = f"https://okcu.ru/elrs-web-flasher/firmware/3.2.1/FCC/{self.config.get('firmware')}/firmware.bin"
-        print(self.firmware_link)
-        self.options = FirmwareOptions(
-            self.config["platform"] != "stm32",
-            "features" in self.config and "buzzer" in self.config["features"],
-            (
-                MCUType.STM32
-                if self.config["platform"] == "stm32"
-                else (
-                    MCUType.ESP32
-                    if self.config["platform"] == "esp32"
-                    else MCUType.ESP8266
-                )
-            ),
-            DeviceType.RX if ".rx_" in self.target else DeviceType.TX,
-            RadioType.SX127X if "_900." in self.target else RadioType.SX1280,
-            self.config["lua_name"] if "lua_name" in self.config else "",
-            self.config["stlink"]["bootloader"] if "stlink" in self.config else "",
-            self.config["stlink"]["offset"] if "stlink" in self.config else 0,
-            self.config["firmware"],
-        )
-        self.file = self.download_firmware()
-        self.mm = mmap.mmap(
-            self.file.fileno(),
-            0,
-        )
-        self.pos = self.get_hardware(self.mm)
-        self.patch_firmware()
-        self.file.close()
+        if self.upload_method == "stlink" and "stlink" not in self.config:
+            raise Exception("Таргет не поддерживает прошивку через ST-Link")
+        self.options = self.target_info.options
+        self.manifest = None
+        # Части подготовленной прошивки в mmap и каталог временных файлов
+        # esptool, закрываются и удаляются в close()
+        self._mapped = []
+        self._work_dir = None
+        if prepared is not None:
+            # Образ уже собран в процессе подготовки (modules.prepare)
+            self.manifest, self.merged_manifest = prepared.load()
+            self._mapped = [
+                part.data
+                for manifest in (self.manifest, self.merged_manifest)
+                if manifest is not None
+                for part in manifest.parts
+            ]
+            self.image = self.manifest.part(firmware_manifest.FIRMWARE).data
+            self.pos = prepared.hardware_pos
+        else:
+            self.image = self.download_firmware()
+            # Поврежденный образ отбрасывается до сборки конфигурации и прошивки
+            image_check.check_manifest(self.manifest, self.options.mcuType)
+            self.pos = self.get_hardware(self.image)
+            self.patch_firmware()
+            self.manifest.replace(
+                firmware_manifest.FIRMWARE,
+                self.image,
+            )
         self.target = self.config.get("firmware")
-        self.file = self.file.name
+        self.file = (
+            self.write_firmware() if prepared is None else prepared.firmware_path
+        )
 
     def generateUID(
         self,
     ):
-        uid = [int(item) if item.isdigit() else -1 for item in self.phrase.split(",")]
-        if len(uid) == 6 and all(ele >= 0 and ele < 256 for ele in uid):
-            uid = bytes(uid)
-        else:
-            uid = hashlib.md5(
-                ('-DMY_BINDING_PHRASE="' + self.phrase + '"').encode()
-            ).digest()[0:6]
-        return uid
+        return binary_configurator.generateUID(self.phrase)
 
-    def patch_uid(
+    def with_image(
         self,
+        port,
+        image,
     ):
-        self.mm[pos] = 1
-        self.mm[pos + 1 : pos + 7] = self.generateUID()
-        pos += 7
-        return pos
+        """Копия для прошивки другого устройства уже собранным образом,
+        без повторного скачивания и сборки (см. modules.provisioning)"""
+        unit = copy.copy(self)
+        unit.port = port
+        unit.job_id = None
+        unit.image = image
+        unit.manifest = copy.copy(self.manifest)
+        unit.manifest.replace(
+            firmware_manifest.FIRMWARE,
+            image,
+        )
+        unit.merged_manifest = None
+        unit._mapped = []
+        unit._work_dir = None
+        unit.file = unit.write_firmware()
+        return unit
+
+    def work_dir(
+        self,
+        name="",
+    ):
+        """Каталог временных файлов этой прошивки, один на все попытки"""
+        if self._work_dir is None:
+            self._work_dir = tempfile.mkdtemp(prefix="elrs_job_")
+        path = os.path.join(self._work_dir, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def close(
+        self,
+    ):
+        """Закрыть отображенные части подготовленной прошивки и удалить
+        временные файлы; вызывается, когда прошивка закончена"""
+        for data in self._mapped:
+            # Буфер еще занят (memoryview) - mmap закроет сборщик мусора
+            with contextlib.suppress(BufferError):
+                data.close()
+        self._mapped = []
+        if self._work_dir is not None:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+            self._work_dir = None
 
     def patch_unified(
         self,
@@ -123,8 +174,8 @@ class ELRS:
             2**32 - 1,
         )
 
-        UnifiedConfig.doConfiguration(
-            self.file,
+        self.image = UnifiedConfig.configureTarget(
+            self.image,
             json.JSONEncoder().encode(json_flags),
             self.target,
             "tx" if self.options.deviceType is DeviceType.TX else "rx",
@@ -137,12 +188,19 @@ class ELRS:
             ),
             self.options.luaName,
         )
+        print("Прошивка собрана, начинаем прошивать")
 
     def patch_firmware(
         self,
     ):
         if self.options.mcuType is MCUType.STM32:
-            raise Exception("STM32 IS NOT SUPPORTED YET")
+            binary_configurator.patch_legacy(
+                self.options,
+                self.image,
+                self.pos,
+                binary_configurator.LegacyParams(phrase=self.phrase),
+            )
+            print("Прошивка собрана, начинаем прошивать")
         else:
             self.patch_unified()
 
@@ -156,55 +214,203 @@ class ELRS:
 
         return pos
 
+    def upload_manifest(
+        self,
+    ):
+        """Части для esptool, для factory - один склеенный образ"""
+        if not self.factory:
+            return self.manifest
+        if self.merged_manifest is None:
+            self.merged_manifest = self.manifest.merged()
+        return self.merged_manifest
+
     def download_firmware(
         self,
     ):
+        layout = (
+            firmware_manifest.ESP32_LAYOUT
+            if self.options.mcuType is MCUType.ESP32
+            else firmware_manifest.APP_LAYOUT
+        )
+        firmware_mirror = mirror.get_mirror()
+        print(
+            firmware_mirror.base_url
+            + "/"
+            + mirror.firmware_path(
+                self.version,
+                self.flavour,
+                self.options.firmware,
+                firmware_manifest.FIRMWARE,
+            )
+        )
         try:
-            with tempfile.NamedTemporaryFile(
-                prefix="elrs_firmware_",
-                suffix=".bin",
-                mode="wb",
-                delete=False,
-            ) as f:
-                path = f.name
-            response = requests.get(self.firmware_link)
-            if response.status_code == 200:
-                with open(
-                    path,
-                    "wb",
-                ) as f:
-                    f.write(response.content)
-                print("Прошивка успешно скачана")
-                return open(
-                    path,
-                    "r+b",
-                )
-            else:
-                print(response.status_code)
-                raise Exception("Ошибка при скачивании прошивки")
+            self.manifest = firmware_manifest.load(
+                lambda part, required: firmware_mirror.fetch(
+                    mirror.firmware_path(
+                        self.version,
+                        self.flavour,
+                        self.options.firmware,
+                        part,
+                    ),
+                    required,
+                ),
+                layout,
+            )
+            print("Прошивка успешно получена")
+            return bytearray(self.manifest.part(firmware_manifest.FIRMWARE).data)
         except Exception as ex:
             print(ex)
+            raise
 
-    def upload_esp8266_bf(
+    def download_bootloader(
         self,
     ):
-        retval = BFinitPassthrough.main(
-            [
-                "-p",
-                self.port,
-                "-b",
-                str(self.baud),
-                "-r",
-                self.options.firmware,
-                "-a",
-                self.mode,
-                "--accept",
-                self.accept,
-            ]
+        data = mirror.get_mirror().fetch(
+            mirror.bootloader_path(self.options.bootloader),
+            required=True,
         )
+        if data is None:
+            raise Exception("Ошибка при скачивании загрузчика")
+        return data
+
+    def write_firmware(
+        self,
+    ):
+        # esptool принимает только путь к файлу, поэтому собранный образ
+        # записывается на диск один раз
+        path = os.path.join(self.work_dir(), firmware_manifest.FIRMWARE)
+        with open(path, "wb") as f:
+            f.write(self.image)
+        return path
+
+    def reporter(
+        self,
+    ):
+        if self.progress is None:
+            return None
+        return self.progress.reporter(self.port)
+
+    def resume_part(
+        self,
+        part,
+    ):
+        """Оставшаяся часть прерванной прошивки: с первого сектора, который
+        по журналу не записан целиком
+
+        :returns:
+            (смещение, данные)
+        """
+        end = part.offset
+        if self.journal is not None and self.job_id is not None:
+            for address, length in self.journal.ranges(self.job_id):
+                if address <= end < address + length:
+                    end = address + length
+        # Последний сектор пишется всегда, чтобы esptool было что писать
+        done = min(end - part.offset, part.size - 1)
+        done -= done % FLASH_SECTOR_SIZE
+        return part.offset + done, part.data[done:]
+
+    def resume_file(
+        self,
+        data,
+    ):
+        """Оставшаяся часть прошивки во временном файле для esptool"""
+        path = os.path.join(self.work_dir("resume"), firmware_manifest.FIRMWARE)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def block_reporter(
+        self,
+        offset,
+        data,
+    ):
+        """Callback(done, total) для esptool.main: прогресс и записанные блоки
+        образа data с offset в журнал. Блоки других частей (тот же write_flash
+        для ESP32) отличаются по размеру и не записываются"""
+        report = self.reporter()
+        if self.journal is None:
+            return report
+        # write_flash дополняет образ до 4 байт
+        size = len(data) + -len(data) % 4
+        written = None
+        recorded = 0
+
+        def progress(
+            done,
+            total,
+        ):
+            nonlocal written, recorded
+            if report is not None:
+                report(done, total)
+            if total != size:
+                written = None
+                return
+            # Stub подтверждает блок до записи во flash, поэтому записанным
+            # считается только предыдущий блок
+            if written is not None and written > recorded:
+                self.journal.add_range(
+                    self.job_id,
+                    offset + recorded,
+                    written - recorded,
+                    zlib.crc32(data[recorded:written]),
+                )
+                recorded = written
+            written = done
+
+        return progress
+
+    def set_phase(
+        self,
+        phase,
+    ):
+        if self.journal is not None:
+            self.journal.set_phase(
+                self.job_id,
+                phase,
+            )
+
+    def bootloader_reset(
+        self,
+    ):
+        """Параметры BFinitPassthrough.reset_to_bootloader (кроме порта и
+        скорости) или None, если приемник шьется без passthrough"""
+        if self.options.mcuType == MCUType.STM32:
+            if self.upload_method == "stlink":
+                return None
+            return {
+                "target": self.options.firmware,
+                "action": self.mode,
+                "accept": self.accept,
+                "chip_type": None,
+            }
+        return {
+            "target": self.options.firmware,
+            "action": self.mode,
+            "accept": self.accept if self.options.mcuType == MCUType.ESP8266 else None,
+        }
+
+    def enter_bootloader(
+        self,
+    ):
+        """Passthrough и загрузчик приемника; при повторе уже пройденные
+        шаги пропускаются (sessions.enter_bootloader)"""
+        from modules import sessions
+
+        return asyncio.run(sessions.elrs_bootloader(self))
 
-        if retval != ElrsUploadResult.Success:
-            return retval
+    def upload_esp8266_bf(
+        self,
+        passthrough=True,
+    ):
+        if passthrough:
+            retval = self.enter_bootloader()
+            if retval != ElrsUploadResult.Success:
+                return retval
+        self.set_phase(job_journal.PHASE_WRITE)
+        offset, data = self.resume_part(
+            self.manifest.part(firmware_manifest.FIRMWARE)
+        )
         try:
             cmd = [
                 "--passthrough",
@@ -221,15 +427,19 @@ class ELRS:
                 "--no-stub",
                 "write_flash",
             ]
-            if self.erase:
+            # При возобновлении уже записанное начало не стирается
+            if self.erase and offset == 0:
                 cmd.append("--erase-all")
             cmd.extend(
                 [
-                    "0x0000",
-                    self.file,
+                    hex(offset),
+                    self.file if offset == 0 else self.resume_file(data),
                 ]
             )
-            esptool.main(cmd)
+            esptool.main(
+                cmd,
+                progress=self.block_reporter(offset, data),
+            )
         except Exception as ex:
             print(ex)
             return ElrsUploadResult.ErrorGeneral
@@ -237,21 +447,20 @@ class ELRS:
 
     def upload_esp32_bf(
         self,
+        passthrough=True,
     ):
-        retval = BFinitPassthrough.main(
-            [
-                "-p",
-                self.port,
-                "-b",
-                str(self.baud),
-                "-r",
-                self.options.firmware,
-                "-a",
-                self.mode,
-            ]
-        )
-        if retval != ElrsUploadResult.Success:
-            return retval
+        if passthrough:
+            retval = self.enter_bootloader()
+            if retval != ElrsUploadResult.Success:
+                return retval
+        self.set_phase(job_journal.PHASE_WRITE)
+        manifest = self.upload_manifest()
+        print(manifest)
+        files = manifest.esptool_args(self.work_dir("esptool"))
+        # Приложение (или factory.bin) - последняя и самая большая часть
+        offset, data = self.resume_part(manifest.parts[-1])
+        if offset != manifest.parts[-1].offset:
+            files[-2:] = [hex(offset), self.resume_file(data)]
         try:
             esptool.main(
                 [
@@ -268,14 +477,60 @@ class ELRS:
                     "hard_reset",
                     "write_flash",
                     "-z",
+                    "--skip-unchanged",
                     "--flash_mode",
                     "dio",
                     "--flash_freq",
                     "40m",
                     "--flash_size",
                     "detect",
-                    "0x10000",
-                    self.file,
+                    *files,
+                ],
+                progress=self.block_reporter(offset, data),
+            )
+        except Exception as ex:
+            print(ex)
+            return ElrsUploadResult.ErrorGeneral
+        return ElrsUploadResult.Success
+
+    def upload_stm32_bf(
+        self,
+        passthrough=True,
+    ):
+        if passthrough:
+            retval = self.enter_bootloader()
+            if retval != ElrsUploadResult.Success:
+                return retval
+
+        self.set_phase(job_journal.PHASE_WRITE)
+        try:
+            return UARTupload.uart_upload(
+                self.port,
+                self.image,
+                self.baud,
+                progress=self.reporter(),
+            )
+        except Exception as ex:
+            print(ex)
+            return ElrsUploadResult.ErrorGeneral
+
+    def upload_stm32_stlink(
+        self,
+    ):
+        try:
+            bootloader = self.download_bootloader()
+            self.set_phase(job_journal.PHASE_WRITE)
+            stlink = STLink.STLink(self.config["stlink"].get("cpus"))
+            stlink.program(
+                [
+                    (
+                        STLink.FLASH_START,
+                        bootloader,
+                    ),
+                    (
+                        STLink.FLASH_START + int(str(self.options.offset), 0),
+                        self.image,
+                    ),
                 ]
             )
         except Exception as ex:
@@ -283,17 +538,82 @@ class ELRS:
             return ElrsUploadResult.ErrorGeneral
         return ElrsUploadResult.Success
 
-    def flash(
+    def start(
         self,
     ):
+        """Начать прошивку в журнале
+
+        :returns:
+            True, если продолжается прерванная прошивка
+        """
         self.baud = 420000
-        for i in reversed(range(10)):
-            print(f"{i}...")
-            time.sleep(1)
+        resumed = False
+        if self.journal is not None:
+            self.job_id, resumed = self.journal.start(
+                self.port,
+                "elrs",
+                self.file,
+                job_journal.file_hash(self.file),
+            )
+        return resumed
 
+    def upload(
+        self,
+        passthrough=True,
+    ):
+        """Прошить приемник; passthrough=False - FC уже переведен в passthrough
+        и приемник в загрузчик (modules.sessions)"""
+        status = ElrsUploadResult.ErrorGeneral
         if self.options.mcuType == MCUType.ESP8266:
-            return self.upload_esp8266_bf()
+            status = self.upload_esp8266_bf(passthrough)
         elif self.options.mcuType == MCUType.ESP32:
-            return self.upload_esp32_bf()
+            status = self.upload_esp32_bf(passthrough)
+        elif self.options.mcuType == MCUType.STM32:
+            if self.upload_method == "stlink":
+                status = self.upload_stm32_stlink()
+            else:
+                status = self.upload_stm32_bf(passthrough)
+        return status
+
+    def finish(
+        self,
+        status,
+    ):
+        if status != ElrsUploadResult.Success:
+            from modules import sessions
 
-        return ElrsUploadResult.ErrorGeneral
+            # Неизвестно, в каком состоянии остался FC: при повторе
+            # passthrough проверяется заново
+            sessions.get_passthrough_cache().flash_failed(self.port)
+        if self.progress is not None:
+            self.progress.finish(
+                self.port,
+                None if status == ElrsUploadResult.Success else "upload failed",
+            )
+        if self.journal is not None:
+            if status == ElrsUploadResult.Success:
+                self.journal.finish(self.job_id)
+            elif status == ElrsUploadResult.ErrorMismatch:
+                self.journal.finish(
+                    self.job_id,
+                    "target mismatch",
+                )
+            else:
+                self.journal.interrupt(
+                    self.job_id,
+                    "upload failed",
+                )
+        return status
+
+    def flash(
+        self,
+    ):
+        resumed = self.start()
+        # Образ уже собран, при возобновлении обратный отсчет не нужен
+        if resumed:
+            print("Продолжаем прерванную прошивку")
+        else:
+            for i in reversed(range(10)):
+                print(f"{i}...")
+                time.sleep(1)
+        return self.finish(self.upload())
@@ -1,8 +1,55 @@
+import itertools
+import os
+import re
 import time
 
 import serial
+from intelhex import IntelHex
 
+from fc_flasher.address import get_address
 from fc_flasher.main import _get_dfu_devices, download
+from modules import STLink
+from modules import journal as job_journal
+
+# Попыток найти DFU устройство после команды перехода, раз в DFU_POLL секунд
+DFU_ATTEMPTS = 20
+DFU_POLL = 1
+# Пауза между командами CLI, чтобы FC успевал их разобрать
+CLI_COMMAND_DELAY = 0.1
+# Пауза после конфига: FC выполняет save и перезагружается
+CONFIG_SETTLE = 5
+
+
+def read_config_commands(
+    path,
+):
+    """Команды CLI из конфига без комментариев и dump"""
+    commands = []
+    with open(
+        path,
+        "r",
+        encoding="utf-8",
+    ) as f:
+        for line in f:
+            if not line.startswith("#") and "dump" not in line and len(line) > 1:
+                commands.append(f"{line.strip()}")
+    return commands
+
+
+def firmware_cpus(
+    path,
+):
+    """МК из имени прошивки Betaflight, например
+    betaflight_4.5.1_STM32F7X2_SPEEDYBEEF7V3.hex; X в имени - любая цифра
+
+    :returns:
+        [префикс типа МК для STLink] или [], если МК в имени нет
+    """
+    match = re.search(r"STM32[0-9A-Z]+", os.path.basename(path).upper())
+    if match is None:
+        return []
+    choices = ["0123456789" if char == "X" else char for char in match.group()]
+    return ["".join(cpu) for cpu in itertools.product(*choices)]
 
 
 class FC:
@@ -13,19 +60,19 @@ class FC:
         configFile,
         baud_rate=115200,
         timeout=20,
+        cpus=None,
     ) -> None:
         self.port = port
         self.file = file
         self.configFile = configFile
+        # Ожидаемые МК для ST-Link; по умолчанию - из имени прошивки
+        self.cpus = cpus
         self.baud_rate = baud_rate
         self.timeout = timeout
 
     def dfu(
         self,
     ):
-        MAX_ATTEMPTS = 20
-        TIMEOUT = 1
-
         if _get_dfu_devices():
             return True
 
@@ -35,7 +82,7 @@ class FC:
             timeout=self.timeout,
         ) as ser:
             ser.write("#\n".encode())
-            time.sleep(TIMEOUT)
+            time.sleep(DFU_POLL)
             ser.write("dfu\n".encode())
             try:
                 ser.write("bl\n".encode())
@@ -46,8 +93,8 @@ class FC:
             except:
                 pass
 
-        for _ in range(MAX_ATTEMPTS):
-            time.sleep(TIMEOUT)
+        for _ in range(DFU_ATTEMPTS):
+            time.sleep(DFU_POLL)
             dfu_devices = _get_dfu_devices()
 
             if dfu_devices:
@@ -57,19 +104,102 @@ class FC:
 
     def flash(
         self,
+        journal=None,
+        progress=None,
     ):
         print(
             self.file,
             "firmware",
         )
-        download(
-            filename=self.file,
+        if journal is None:
+            download(
+                filename=self.file,
+                progress=progress,
+            )
+            return
+
+        # Задача привязана к серийному номеру DFU устройства, чтобы после
+        # переподключения продолжить с последнего записанного сектора
+        devices = _get_dfu_devices()
+        address = get_address(devices[0]) if len(devices) == 1 else None
+        device = (address.serial or address.path) if address else self.port
+        job_id, resumed = journal.start(
+            device,
+            "fc_dfu",
+            self.file,
+            job_journal.file_hash(self.file),
         )
+        resume = journal.ranges(job_id) if resumed else []
+        if resume:
+            print(f"Найдена прерванная прошивка, записано блоков: {len(resume)}")
+
+        journal.set_phase(
+            job_id,
+            job_journal.PHASE_WRITE,
+        )
+        try:
+            download(
+                filename=self.file,
+                serial=address.serial if address else None,
+                path=None if address is None or address.serial else address.path,
+                progress=progress,
+                resume=resume,
+                on_written=lambda addr, length, crc: journal.add_range(
+                    job_id,
+                    addr,
+                    length,
+                    crc,
+                ),
+            )
+        except Exception as ex:
+            journal.interrupt(
+                job_id,
+                ex,
+            )
+            raise
+        journal.finish(job_id)
+
+    def flash_stlink(
+        self,
+    ):
+        """Прошить FC через ST-Link (SWD), например если DFU загрузчик поврежден.
+        МК на ST-Link сверяется с ожидаемым до стирания
+
+        :raises STLink.STLinkError:
+            МК неизвестен или на ST-Link другой МК
+        """
+        cpus = self.cpus or firmware_cpus(self.file)
+        if not cpus:
+            raise STLink.STLinkError(
+                "МК FC не указан и не найден в имени прошивки (например STM32F405)"
+            )
+        print(
+            self.file,
+            "firmware (ST-Link)",
+        )
+        if self.file.lower().endswith(".hex"):
+            hex_file = IntelHex(self.file)
+            parts = [
+                (
+                    start,
+                    hex_file.tobinstr(start, end - 1),
+                )
+                for start, end in hex_file.segments()
+            ]
+        else:
+            with open(self.file, "rb") as f:
+                parts = [
+                    (
+                        STLink.FLASH_START,
+                        f.read(),
+                    )
+                ]
+        STLink.STLink(cpus).program(parts)
 
     def upload_config(
         self,
+        progress=None,
     ):
-        commands = []
         ser = None
 
         # Пытаемся 10 раз установить серийное соединение
@@ -97,29 +227,35 @@ class FC:
             return
 
         # Загрузка команд из файла
-        with open(
-            self.configFile,
-            "r",
-            encoding="utf-8",
-        ) as f:
-            for line in f:
-                if not line.startswith("#") and "dump" not in line and len(line) > 1:
-                    commands.append(f"{line.strip()}")
+        commands = read_config_commands(self.configFile)
 
         ser.write("#\n".encode())
         time.sleep(1)
+        # Прогресс в байтах команд, как у прошивки
+        total = sum(len(command) + 1 for command in commands)
+        done = 0
         # Отправка команд
         for (
             i,
             command,
         ) in enumerate(commands):
-            print(f"Загружено команд {i+1}/{len(commands)}")
+            if progress is None:
+                print(f"Загружено команд {i+1}/{len(commands)}")
             try:
                 ser.write((f"{command}\n").encode())
-                time.sleep(0.1)
+                time.sleep(CLI_COMMAND_DELAY)
             except Exception:
                 print(f"[!] Ошибка при записи команды {command}")
+            done += len(command) + 1
+            if progress is not None:
+                progress.set_done(
+                    self.port,
+                    done,
+                    total,
+                )
 
         ser.close()
-        print("Конфиг загружен")
-        time.sleep(5)
+        if progress is not None:
+            progress.finish(self.port)
+        print(f"Конфиг загружен, команд: {len(commands)}")
+        time.sleep(CONFIG_SETTLE)
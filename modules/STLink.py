@@ -0,0 +1,261 @@
+import sys
+import time
+import zlib
+
+from fc_flasher import erase as erase_plan
+from modules.get_path import load_file
+
+# pystlink импортирует себя как пакет верхнего уровня
+sys.path.append(load_file("external"))
+
+from pystlink.lib import stlinkex, stm32fs  # noqa: E402
+from pystlink.lib.stm32 import Stm32  # noqa: E402
+from pystlink.pystlink_api import PyStlink  # noqa: E402
+
+FLASH_START = Stm32.FLASH_START
+
+
+class STLinkError(Exception):
+    pass
+
+
+class STLink:
+    """Сессия ST-Link: связь инициализируется один раз и переиспользуется
+    для всех операций (каждая повторная инициализация стоит ~0.2 с).
+    """
+
+    def __init__(
+        self,
+        expected_cpus=None,
+        verbosity=0,
+    ) -> None:
+        self.pystlink = PyStlink(verbosity=verbosity)
+        if not self.pystlink.comms_initialized:
+            # PyStlink молча игнорирует ошибку первой инициализации
+            try:
+                self.pystlink.initialize_comms()
+            except stlinkex.StlinkException as err:
+                raise STLinkError(f"ST-Link не найден или нет связи с МК: {err}")
+        if expected_cpus:
+            try:
+                self.pystlink.filter_detected_cpu(expected_cpus)
+            except stlinkex.StlinkException as err:
+                raise STLinkError(str(err))
+        print(
+            "ST-Link: %s, МК: %s, FLASH: %dKB"
+            % (
+                self.pystlink.stlink.ver_str,
+                "/".join(mcu["type"] for mcu in self.pystlink._mcus),
+                self.pystlink._flash_size,
+            )
+        )
+
+    @property
+    def driver(
+        self,
+    ):
+        return self.pystlink.driver
+
+    @property
+    def erase_sizes(
+        self,
+    ):
+        return self.pystlink._mcus_by_devid["erase_sizes"]
+
+    def write(
+        self,
+        address,
+        data,
+        erase=True,
+    ):
+        start = time.time()
+        with self.pystlink.stlink.operation("write"):
+            self.driver.flash_write(
+                address,
+                list(data),
+                erase=erase,
+                erase_sizes=self.erase_sizes,
+            )
+        print(
+            "ST-Link: записано %d байт с 0x%08x за %.1f с"
+            % (
+                len(data),
+                address,
+                time.time() - start,
+            )
+        )
+
+    def read_blocks(
+        self,
+        address,
+        length,
+    ):
+        """Читать память максимальными блоками ST-Link"""
+        block_size = self.pystlink.stlink.STLINK_MAXIMUM_TRANSFER_SIZE
+        end = address + length
+        while address < end:
+            size = min(block_size, end - address)
+            # get_mem32 читает только целые слова
+            block = bytes(
+                self.pystlink.stlink.get_mem32(
+                    address,
+                    (size + 3) & ~3,
+                )
+            )
+            yield block[:size]
+            address += size
+
+    def crc32(
+        self,
+        address,
+        length,
+    ):
+        """CRC32 области памяти"""
+        crc = 0
+        for block in self.read_blocks(
+            address,
+            length,
+        ):
+            crc = zlib.crc32(block, crc)
+        return crc
+
+    def is_blank(
+        self,
+        sector,
+    ):
+        with self.pystlink.stlink.operation("blank_check"):
+            return erase_plan.is_erased(
+                self.read_blocks(
+                    sector.addr,
+                    sector.size,
+                )
+            )
+
+    def erase_planned(
+        self,
+        parts,
+    ):
+        """Стереть только нужные сектора для частей [(address, data)].
+
+        Планировщик работает с драйвером STM32FS (F2/F4/F7), у которого есть
+        стирание отдельных секторов. Для остальных МК возвращает False, и
+        стирание остается за flash_write.
+        """
+        if not isinstance(self.driver, stm32fs.Stm32FS):
+            return False
+
+        flash = stm32fs.Flash(
+            self.driver,
+            self.pystlink.stlink,
+            self.pystlink._dbg,
+        )
+        params = flash._params
+        sectors = erase_plan.sectors_from_sizes(
+            FLASH_START,
+            self.erase_sizes,
+            self.pystlink._flash_size * 1024,
+        )
+        plan = erase_plan.plan_erase(
+            sectors,
+            [(address, len(data)) for address, data in parts],
+            erase_time=lambda sector: params["max_erase_time"][sector.size // 1024],
+            # Полное стирание затронуло бы и то, что лежит перед образом
+            mass_erase_time=(
+                params["max_mass_erase_time"]
+                if min(address for address, _ in parts) == FLASH_START
+                else None
+            ),
+            is_blank=self.is_blank,
+        )
+        print(f"ST-Link: план стирания: {plan}")
+
+        start = time.time()
+        with self.pystlink.stlink.operation("erase"):
+            if plan.mass_erase:
+                flash.erase_all()
+            else:
+                for sector in plan.sectors:
+                    flash.erase_sector(
+                        sector.index,
+                        sector.size,
+                    )
+            flash.lock()
+        print("ST-Link: стирание за %.1f с" % (time.time() - start))
+        return True
+
+    def verify(
+        self,
+        address,
+        data,
+    ):
+        expected = zlib.crc32(data)
+        with self.pystlink.stlink.operation("verify"):
+            actual = self.crc32(
+                address,
+                len(data),
+            )
+        if actual != expected:
+            raise STLinkError(
+                "Ошибка верификации с 0x%08x: CRC32 %08x, ожидалось %08x"
+                % (
+                    address,
+                    actual,
+                    expected,
+                )
+            )
+
+    def program(
+        self,
+        parts,
+        verify=True,
+    ):
+        """Записать части [(address, data)] за одну сессию и запустить МК"""
+        self.pystlink.stlink.reset_stats()
+        try:
+            self.driver.core_reset_halt()
+            # Части могут делить сектор: стирание по каждой части
+            # затерло бы уже записанные
+            erased = self.erase_planned(parts)
+            for address, data in parts:
+                self.write(
+                    address,
+                    data,
+                    erase=not erased,
+                )
+            if verify:
+                self.driver.core_halt()
+                for address, data in parts:
+                    self.verify(
+                        address,
+                        data,
+                    )
+                print("ST-Link: CRC32 совпадает")
+            self.driver.core_reset_halt()
+            self.driver.core_run()
+        except (stlinkex.StlinkException, ValueError) as err:
+            raise STLinkError(str(err))
+        finally:
+            self.print_stats()
+
+    def print_stats(
+        self,
+    ):
+        """Число обменов по USB и время по операциям с момента reset_stats"""
+        for name, (calls, round_trips, seconds) in self.pystlink.stlink.stats.items():
+            print(
+                "ST-Link: %-12s %3d раз, %5d обменов USB, %.2f с"
+                % (
+                    name,
+                    calls,
+                    round_trips,
+                    seconds,
+                )
+            )
+
+    def erase_all(
+        self,
+    ):
+        try:
+            self.pystlink.flash_erase_all()
+        except stlinkex.StlinkException as err:
+            raise STLinkError(str(err))
@@ -0,0 +1,146 @@
+import io
+import time
+
+import serial
+
+import modules.SerialHelper as SerialHelper
+from external.xmodem import XMODEM1k
+from modules.classes import ElrsUploadResult
+
+# Сколько ждать запроса 'C' от загрузчика после сброса
+BOOTLOADER_TIMEOUT = 10
+
+
+class _SerialChannel:
+    """getc/putc для XMODEM поверх открытого порта.
+
+    Таймаут порта меняется только когда меняется запрошенный: каждая смена
+    перенастраивает порт и добавляет задержку между пакетами.
+    """
+
+    def __init__(
+        self,
+        s,
+    ):
+        self.serial = s
+        self.timeout = s.timeout
+
+    def getc(
+        self,
+        size,
+        timeout=1,
+    ):
+        if timeout != self.timeout:
+            self.serial.timeout = timeout
+            self.timeout = timeout
+        data = self.serial.read(size)
+        return data or None
+
+    def putc(
+        self,
+        data,
+        timeout=1,
+    ):
+        return self.serial.write(data) or None
+
+
+def wait_for_bootloader(
+    s,
+    timeout=BOOTLOADER_TIMEOUT,
+):
+    """Дождаться 'CCC' от XMODEM загрузчика ELRS"""
+    rl = SerialHelper.SerialHelper(
+        s,
+        timeout,
+        [
+            "CCC",
+        ],
+    )
+    start = time.time()
+    while time.time() - start < timeout:
+        line = rl.read_line(timeout - (time.time() - start))
+        if "CCC" in line:
+            return True
+        if line.strip():
+            print(f"  BL: {line.strip()}")
+    return False
+
+
+def uart_upload(
+    port,
+    image,
+    baudrate,
+    timeout=BOOTLOADER_TIMEOUT,
+    progress=None,
+):
+    """Передать образ загрузчику STM32 приемника по XMODEM-1K.
+
+    Приемник уже должен быть сброшен в загрузчик
+    (BFinitPassthrough.reset_to_bootloader). progress(done, total) вызывается
+    после каждого пакета вместо вывода процентов.
+    """
+    print("======== XMODEM UPLOAD ========")
+    s = serial.Serial(
+        port=port,
+        baudrate=baudrate,
+        bytesize=8,
+        parity="N",
+        stopbits=1,
+        timeout=1,
+        xonxoff=0,
+        rtscts=0,
+    )
+    try:
+        if not wait_for_bootloader(
+            s,
+            timeout,
+        ):
+            print("[!] Загрузчик не ответил")
+            return ElrsUploadResult.ErrorGeneral
+
+        channel = _SerialChannel(s)
+        modem = XMODEM1k(
+            channel.getc,
+            channel.putc,
+        )
+        total = (len(image) + 1023) // 1024
+        last = [0]
+
+        def callback(
+            total_packets,
+            success_count,
+            error_count,
+        ):
+            if progress is not None:
+                progress(min(success_count * 1024, len(image)), len(image))
+                return
+            percent = 100 * success_count // total
+            if percent != last[0]:
+                last[0] = percent
+                print(f"Загрузка {success_count}/{total} ({percent}%)")
+
+        start = time.time()
+        # Первый 'C' уже прочитан, загрузчик повторяет его до начала передачи
+        if not modem.send(
+            io.BytesIO(image),
+            retry=16,
+            timeout=5,
+            quiet=True,
+            callback=callback,
+        ):
+            print("[!] Ошибка передачи XMODEM")
+            return ElrsUploadResult.ErrorGeneral
+
+        elapsed = time.time() - start
+        print(
+            "Передано %d байт за %.1f с (%.1f kbit/s)"
+            % (
+                len(image),
+                elapsed,
+                len(image) * 8 / 1000 / elapsed if elapsed else 0,
+            )
+        )
+    finally:
+        s.close()
+
+    return ElrsUploadResult.Success
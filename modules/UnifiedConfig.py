@@ -1,81 +1,241 @@
 #!/usr/bin/python
 
 import argparse
+import functools
 import json
 import struct
 import sys
 
 import jmespath
 
+from modules import layout_pack
 from modules.get_path import load_file
 
 
-def findFirmwareEnd(
-    f,
+PRODUCT_NAME_SIZE = 128
+DEVICE_NAME_SIZE = 16
+DEFINES_SIZE = 512
+PRIOR_TARGET_MAGIC = b"\xBE\xEF\xCA\xFE"
+
+
+def parseFirmwareEnd(
+    buf,
 ):
-    f.seek(
-        0,
-        0,
-    )
+    """Find the end of an ESP image in a buffer, where the Unified
+    configuration is appended.
+
+    The header and segment table are parsed straight from a memoryview, no
+    data is copied.
+
+    :raises ValueError:
+        If the buffer does not hold an ESP image
+    """
+    view = memoryview(buf)
+    if len(view) < 8:
+        raise ValueError("The file provided is too short for a firmware file!")
     (
         magic,
         segments,
         _,
         _,
         _,
-    ) = struct.unpack(
+    ) = struct.unpack_from(
         "<BBBBI",
-        f.read(8),
+        view,
+        0,
     )
     if magic != 0xE9:
-        sys.stderr.write(
-            "The file provided does not the right magic for a firmware file!\n"
+        raise ValueError(
+            "The file provided does not the right magic for a firmware file!"
         )
-        exit(1)
 
     is8285 = False
     if segments == 2:  # we have to assume it's an ESP8266/85
-        f.seek(
-            0x1000,
-            0,
-        )
         (
             magic,
             segments,
             _,
             _,
             _,
-        ) = struct.unpack(
+        ) = struct.unpack_from(
             "<BBBBI",
-            f.read(8),
+            view,
+            0x1000,
         )
+        pos = 0x1000 + 8
         is8285 = True
     else:
-        f.seek(
-            24,
-            0,
-        )
+        pos = 24
 
     for _ in range(segments):
         (
             _,
             size,
-        ) = struct.unpack(
+        ) = struct.unpack_from(
             "<II",
-            f.read(8),
-        )
-        f.seek(
-            size,
-            1,
+            view,
+            pos,
         )
+        pos += 8 + size
+
+    if pos > len(view):
+        raise ValueError("The firmware file is truncated!")
 
-    pos = f.tell()
     pos = (pos + 16) & ~15
     if not is8285:
         pos = pos + 32
     return pos
 
 
+def findFirmwareEnd(
+    f,
+):
+    f.seek(
+        0,
+        0,
+    )
+    try:
+        return parseFirmwareEnd(f.read())
+    except ValueError as err:
+        sys.stderr.write(f"{err}\n")
+        exit(1)
+
+
+def _packBlob(
+    path,
+):
+    pack = layout_pack.get_pack()
+    if pack is None:
+        return None
+    return pack.blob(pack.key(path))
+
+
+@functools.lru_cache(maxsize=None)
+def _loadJson(
+    path,
+):
+    blob = _packBlob(path)
+    if blob is not None:
+        return json.loads(blob)
+    with open(path) as h:
+        return json.load(h)
+
+
+@functools.lru_cache(maxsize=None)
+def _loadLayoutBlob(
+    layout_file,
+):
+    blob = _packBlob(layout_file)
+    if blob is not None:
+        return blob
+    return json.JSONEncoder().encode(_loadJson(layout_file)).encode()
+
+
+def loadLayout(
+    layout_file,
+):
+    """Decoded hardware layout, cached per file. Returns a copy which is safe
+    to update with the target overlay."""
+    return dict(_loadJson(layout_file))
+
+
+def loadTargets():
+    """Decoded targets.json, cached. Must not be modified by the caller."""
+    return _loadJson(load_file("resources/targets.json"))
+
+
+def findTarget(
+    target,
+    targets=None,
+):
+    """Config for a dotted target path, None if there is no such target.
+
+    Walks the dict directly: a jmespath expression per lookup fills the
+    parser cache, and the vendored jmespath fails to evict it on Python 3.11.
+    """
+    if targets is None:
+        targets = loadTargets()
+    node = targets
+    for key in target.split("."):
+        if not isinstance(node, dict):
+            return None
+        node = node.get(key)
+    return node
+
+
+def buildConfiguration(
+    product_name,
+    lua_name,
+    defines,
+    config,
+    layout_file,
+):
+    """Unified configuration block: product/device/defines/hardware/prior
+    target, as appended after the end of the firmware."""
+    hardware = b""
+    if layout_file is not None:
+        if "overlay" in config:
+            hardware = loadLayout(layout_file)
+            hardware.update(config["overlay"])
+            hardware = json.JSONEncoder().encode(hardware).encode()
+        else:
+            hardware = _loadLayoutBlob(layout_file)
+
+    prior = b""
+    if config is not None and "prior_target_name" in config:
+        prior = (
+            PRIOR_TARGET_MAGIC
+            + config["prior_target_name"].upper().encode()
+            + b"\0"
+        )
+
+    header_size = PRODUCT_NAME_SIZE + DEVICE_NAME_SIZE + DEFINES_SIZE
+    block = bytearray(header_size + len(hardware) + 1 + len(prior))
+    encoded = product_name.encode()[:PRODUCT_NAME_SIZE]
+    block[0 : len(encoded)] = encoded
+    pos = PRODUCT_NAME_SIZE
+    encoded = lua_name.encode()[:DEVICE_NAME_SIZE]
+    block[pos : pos + len(encoded)] = encoded
+    pos += DEVICE_NAME_SIZE
+    encoded = defines.encode()[:DEFINES_SIZE]
+    block[pos : pos + len(encoded)] = encoded
+    pos += DEFINES_SIZE
+    block[pos : pos + len(hardware)] = hardware
+    pos += len(hardware) + 1
+    block[pos : pos + len(prior)] = prior
+    return block
+
+
+def configureImage(
+    image,
+    product_name,
+    lua_name,
+    defines,
+    config,
+    layout_file,
+):
+    """Write the Unified configuration into a copy of the image.
+
+    The output is preallocated once and filled in place, nothing touches the
+    filesystem except the (cached) layout file.
+
+    :raises ValueError:
+        If the image is not an ESP firmware image
+    """
+    end = parseFirmwareEnd(image)
+    block = buildConfiguration(
+        product_name,
+        lua_name,
+        defines,
+        config,
+        layout_file,
+    )
+    out = bytearray(max(len(image), end + len(block)))
+    out[0 : len(image)] = image
+    out[end : end + len(block)] = block
+    return out
+
+
 def appendToFirmware(
     firmware_file,
     product_name,
@@ -84,61 +244,37 @@ def appendToFirmware(
     config,
     layout_file,
 ):
-    product = (product_name.encode() + (b"\0" * 128))[0:128]
-    device = (lua_name.encode() + (b"\0" * 16))[0:16]
     end = findFirmwareEnd(firmware_file)
+    try:
+        block = buildConfiguration(
+            product_name,
+            lua_name,
+            defines,
+            config,
+            layout_file,
+        )
+    except EnvironmentError:
+        sys.stderr.write(f'Error opening file "{layout_file}"\n')
+        exit(1)
     firmware_file.seek(
         end,
         0,
     )
-    firmware_file.write(product)
-    firmware_file.write(device)
-    defines = (defines.encode() + (b"\0" * 512))[0:512]
-    firmware_file.write(defines)
-    if layout_file is not None:
-        try:
-            with open(layout_file) as h:
-                hardware = json.load(h)
-                if "overlay" in config:
-                    hardware.update(config["overlay"])
-                firmware_file.write(json.JSONEncoder().encode(hardware).encode())
-        except EnvironmentError:
-            sys.stderr.write(f'Error opening file "{layout_file}"\n')
-            exit(1)
-    firmware_file.write(b"\0")
-    if config is not None and "prior_target_name" in config:
-        firmware_file.write(b"\xBE\xEF\xCA\xFE")
-        firmware_file.write(config["prior_target_name"].upper().encode())
-        firmware_file.write(b"\0")
+    firmware_file.write(block)
 
 
-def doConfiguration(
-    file,
-    defines,
+def targetConfiguration(
     config,
     moduletype,
-    frequency,
-    platform,
     device_name,
 ):
+    """(product_name, lua_name, layout_file, config) for a dotted target path"""
     product_name = "Unified"
     lua_name = "Unified"
     layout = None
 
-    targets = {}
-    with open(load_file("resources/targets.json")) as f:
-        targets = json.load(f)
     if config is not None:
-        config = ".".join(
-            map(
-                lambda s: f'"{s}"',
-                config.split("."),
-            )
-        )
-        config = jmespath.search(
-            config,
-            targets,
-        )
+        config = findTarget(config)
 
     if config is not None:
         product_name = config["product_name"]
@@ -147,6 +283,58 @@ def doConfiguration(
         layout = load_file(f"resources/{dir}/{config['layout_file']}")
 
     lua_name = lua_name if device_name is None else device_name
+    return product_name, lua_name, layout, config
+
+
+def configureTarget(
+    image,
+    defines,
+    config,
+    moduletype,
+    frequency,
+    platform,
+    device_name,
+):
+    """In-memory counterpart of `doConfiguration`, returns the configured image"""
+    (
+        product_name,
+        lua_name,
+        layout,
+        config,
+    ) = targetConfiguration(
+        config,
+        moduletype,
+        device_name,
+    )
+    return configureImage(
+        image,
+        product_name,
+        lua_name,
+        defines,
+        config,
+        layout,
+    )
+
+
+def doConfiguration(
+    file,
+    defines,
+    config,
+    moduletype,
+    frequency,
+    platform,
+    device_name,
+):
+    (
+        product_name,
+        lua_name,
+        layout,
+        config,
+    ) = targetConfiguration(
+        config,
+        moduletype,
+        device_name,
+    )
     appendToFirmware(
         file,
         product_name,
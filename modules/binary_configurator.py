@@ -18,196 +18,261 @@
 # from binary_flash import UploadMethod
 # from external import jmespath
 
-# class BuzzerMode(Enum):
-#     quiet = 'quiet'
-#     one = 'one-beep'
-#     beep = 'beep-tune'
-#     default = 'default-tune'
-#     custom = 'custom-tune'
-
-#     def __str__(self):
-#         return self.value
-
-# class RegulatoryDomain(Enum):
-#     eu_433 = 'eu_433'
-#     au_433 = 'au_433'
-#     in_866 = 'in_866'
-#     eu_868 = 'eu_868'
-#     au_915 = 'au_915'
-#     fcc_915 = 'fcc_915'
-
-#     def __str__(self):
-#         return self.value
-
-# def write32(mm, pos, val):
-#     if val != None:
-#         mm[pos + 0] = (val >> 0) & 0xFF
-#         mm[pos + 1] = (val >> 8) & 0xFF
-#         mm[pos + 2] = (val >> 16) & 0xFF
-#         mm[pos + 3] = (val >> 24) & 0xFF
-#     return pos + 4
-
-# def read32(mm, pos):
-#     val = mm[pos + 0]
-#     val += mm[pos + 1] << 8
-#     val += mm[pos + 2] << 16
-#     val += mm[pos + 3] << 24
-#     return pos + 4, val
-
-# def writeString(mm, pos, string, maxlen):
-#     if string != None:
-#         l = len(string)
-#         if l > maxlen-1:
-#             l = maxlen-1
-#         mm[pos:pos+l] = string.encode()[0,l]
-#         mm[pos+l] = 0
-#     return pos + maxlen
-
-# def readString(mm, pos, maxlen):
-#     val = mm[pos:mm.find(b'\x00', pos)].decode()
-#     return pos + maxlen, val
-
-# def generateUID(phrase):
-#     uid = [
-#         int(item) if item.isdigit() else -1
-#         for item in phrase.split(',')
-#     ]
-#     if len(uid) == 6 and all(ele >= 0 and ele < 256 for ele in uid):
-#         uid = bytes(uid)
-#     else:
-#         uid = hashlib.md5(("-DMY_BINDING_PHRASE=\""+phrase+"\"").encode()).digest()[0:6]
-#     return uid
-
-# def patch_uid(mm, pos, args):
-#     if (args.phrase):
-#         mm[pos] = 1
-#         mm[pos+1:pos + 7] = generateUID(args.phrase)
-#     pos += 7
-#     return pos
-
-# def patch_wifi(mm, pos, args):
-#     interval = None
-#     if args.no_auto_wifi:
-#         interval = -1
-#     elif args.auto_wifi:
-#         interval = args.auto_wifi * 1000
-#     pos = write32(mm, pos, interval)
-#     pos = writeString(mm, pos, args.ssid, 33)
-#     pos = writeString(mm, pos, args.password, 65)
-#     return pos
-
-# def patch_rx_params(mm, pos, args):
-#     pos = write32(mm, pos, args.rx_baud if args.airport_baud is None else args.airport_baud)
-#     val = mm[pos]
-#     val &= ~1   # unused1 - ex invert_tx
-#     if args.lock_on_first_connection != None:
-#         val &= ~2
-#         val |= (args.lock_on_first_connection << 1)
-#     val &= ~4   # unused2 - ex r9mm_mini_sbus
-#     if args.airport_baud != None:
-#         val |= ~8
-#         val |= 0 if args.airport_baud == 0 else 8
-#     mm[pos] = val
-#     return pos + 1
-
-# def patch_tx_params(mm, pos, args, options):
-#     pos = write32(mm, pos, args.tlm_report)
-#     pos = write32(mm, pos, args.fan_min_runtime)
-#     val = mm[pos]
-#     if args.uart_inverted != None:
-#         val &= ~1
-#         val |= args.uart_inverted
-#     if args.unlock_higher_power != None:
-#         val &= ~2
-#         val |= (args.unlock_higher_power << 1)
-#     if args.airport_baud != None:
-#         val |= ~4
-#         val |= 0 if args.airport_baud == 0 else 4
-#     mm[pos] = val
-#     pos += 1
-#     if options.hasBuzzer:
-#         pos = patch_buzzer(mm, pos, args)
-#     pos = write32(mm, pos, 0 if args.airport_baud is None else args.airport_baud)
-#     return pos
-
-# def patch_buzzer(mm, pos, args):
-#     melody = args.buzzer_melody
-#     if args.buzzer_mode:
-#         if args.buzzer_mode == BuzzerMode.quiet:
-#             mm[pos] = 0
-#         if args.buzzer_mode == BuzzerMode.one:
-#             mm[pos] = 1
-#         if args.buzzer_mode == BuzzerMode.beep:
-#             mm[pos] = 2
-#             melody = 'A4 20 B4 20|60|0'
-#         if args.buzzer_mode == BuzzerMode.default:
-#             mm[pos] = 2
-#             melody = 'E5 40 E5 40 C5 120 E5 40 G5 22 G4 21|20|0'
-#         if args.buzzer_mode == BuzzerMode.custom:
-#             mm[pos] = 2
-#             melody = args.buzzer_melody
-#     mode = mm[pos]
-#     pos += 1
-
-#     mpos = 0
-#     if mode == 2 and melody:
-#         melodyArray = melodyparser.parseToArray(melody)
-#         for element in melodyArray:
-#             if mpos == 32*4:
-#                 print("Melody truncated at 32 tones")
-#                 break
-#             mm[pos+mpos+0] = (int(element[0]) >> 0) & 0xFF
-#             mm[pos+mpos+1] = (int(element[0]) >> 8) & 0xFF
-#             mm[pos+mpos+2] = (int(element[1]) >> 0) & 0xFF
-#             mm[pos+mpos+3] = (int(element[1]) >> 8) & 0xFF
-#             mpos += 4
-#         # If we are short, then add a terminating 0's
-#         while(mpos < 32*4):
-#             mm[pos+mpos] = 0
-#             mpos += 1
-
-#     pos += 32*4     # 32 notes x (2 bytes tone, 2 bytes duration)
-#     return pos
-
-# def FREQ_HZ_TO_REG_VAL_SX127X(freq):
-#     return int(freq/61.03515625)
-
-# def FREQ_HZ_TO_REG_VAL_SX1280(freq):
-#     return int(freq/(52000000.0/pow(2,18)))
-
-# def generate_domain(mm, pos, count, init, step):
-#     pos = write32(mm, pos, count)
-#     val = init
-#     for x in range(count):
-#         pos = write32(mm, pos, FREQ_HZ_TO_REG_VAL_SX127X(val))
-#         val += step
-
-# def domain_number(domain):
-#     if domain == RegulatoryDomain.au_915:
-#         return 0
-#     elif domain == RegulatoryDomain.fcc_915:
-#         return 1
-#     elif domain == RegulatoryDomain.eu_868:
-#         return 2
-#     elif domain == RegulatoryDomain.in_866:
-#         return 3
-#     elif domain == RegulatoryDomain.au_433:
-#         return 4
-#     elif domain == RegulatoryDomain.eu_433:
-#         return 5
-
-# def patch_firmware(options, mm, pos, args):
-#     if options.mcuType is MCUType.STM32:
-#         if options.radioChip is RadioType.SX127X and args.domain:
-#             mm[pos] = domain_number(args.domain)
-#         pos += 1
-#         pos = patch_uid(mm, pos, args)
-#         if options.deviceType is DeviceType.TX:
-#             pos = patch_tx_params(mm, pos, args, options)
-#         elif options.deviceType is DeviceType.RX:
-#             pos = patch_rx_params(mm, pos, args)
-#     else:
-#         patch_unified(args, options)
+import functools
+import hashlib
+from enum import Enum
+from typing import NamedTuple, Optional
+
+from modules.classes import DeviceType, MCUType, RadioType
+
+
+class BuzzerMode(Enum):
+    quiet = "quiet"
+    one = "one-beep"
+    beep = "beep-tune"
+    default = "default-tune"
+    custom = "custom-tune"
+
+    def __str__(self):
+        return self.value
+
+
+class RegulatoryDomain(Enum):
+    eu_433 = "eu_433"
+    au_433 = "au_433"
+    in_866 = "in_866"
+    eu_868 = "eu_868"
+    au_915 = "au_915"
+    fcc_915 = "fcc_915"
+
+    def __str__(self):
+        return self.value
+
+
+class LegacyParams(NamedTuple):
+    """Параметры для legacy (STM32) прошивки, None - оставить как в образе"""
+
+    phrase: Optional[str] = None
+    domain: Optional[RegulatoryDomain] = None
+    rx_baud: Optional[int] = None
+    lock_on_first_connection: Optional[bool] = None
+    airport_baud: Optional[int] = None
+    tlm_report: Optional[int] = None
+    fan_min_runtime: Optional[int] = None
+    uart_inverted: Optional[bool] = None
+    unlock_higher_power: Optional[bool] = None
+    buzzer_mode: Optional[BuzzerMode] = None
+
+
+def write32(
+    mm,
+    pos,
+    val,
+):
+    if val is not None:
+        mm[pos : pos + 4] = (val & 0xFFFFFFFF).to_bytes(
+            4,
+            "little",
+        )
+    return pos + 4
+
+
+def read32(
+    mm,
+    pos,
+):
+    return pos + 4, int.from_bytes(
+        mm[pos : pos + 4],
+        "little",
+    )
+
+
+def writeString(
+    mm,
+    pos,
+    string,
+    maxlen,
+):
+    if string is not None:
+        encoded = string.encode()[: maxlen - 1]
+        mm[pos : pos + len(encoded)] = encoded
+        mm[pos + len(encoded)] = 0
+    return pos + maxlen
+
+
+def readString(
+    mm,
+    pos,
+    maxlen,
+):
+    val = mm[pos : mm.find(b"\x00", pos)].decode()
+    return pos + maxlen, val
+
+
+# Партия приемников может использовать одну фразу много раз
+@functools.lru_cache(maxsize=4096)
+def generateUID(
+    phrase,
+):
+    uid = [int(item) if item.isdigit() else -1 for item in phrase.split(",")]
+    if len(uid) == 6 and all(ele >= 0 and ele < 256 for ele in uid):
+        uid = bytes(uid)
+    else:
+        uid = hashlib.md5(('-DMY_BINDING_PHRASE="' + phrase + '"').encode()).digest()[
+            0:6
+        ]
+    return uid
+
+
+def patch_uid(
+    mm,
+    pos,
+    args,
+):
+    if args.phrase:
+        mm[pos] = 1
+        mm[pos + 1 : pos + 7] = generateUID(args.phrase)
+    pos += 7
+    return pos
+
+
+def patch_rx_params(
+    mm,
+    pos,
+    args,
+):
+    pos = write32(
+        mm,
+        pos,
+        args.rx_baud if args.airport_baud is None else args.airport_baud,
+    )
+    val = mm[pos]
+    val &= ~1  # unused1 - ex invert_tx
+    if args.lock_on_first_connection is not None:
+        val &= ~2
+        val |= args.lock_on_first_connection << 1
+    val &= ~4  # unused2 - ex r9mm_mini_sbus
+    if args.airport_baud is not None:
+        val &= ~8
+        val |= 0 if args.airport_baud == 0 else 8
+    mm[pos] = val & 0xFF
+    return pos + 1
+
+
+def patch_tx_params(
+    mm,
+    pos,
+    args,
+    options,
+):
+    pos = write32(
+        mm,
+        pos,
+        args.tlm_report,
+    )
+    pos = write32(
+        mm,
+        pos,
+        args.fan_min_runtime,
+    )
+    val = mm[pos]
+    if args.uart_inverted is not None:
+        val &= ~1
+        val |= args.uart_inverted
+    if args.unlock_higher_power is not None:
+        val &= ~2
+        val |= args.unlock_higher_power << 1
+    if args.airport_baud is not None:
+        val &= ~4
+        val |= 0 if args.airport_baud == 0 else 4
+    mm[pos] = val & 0xFF
+    pos += 1
+    if options.hasBuzzer:
+        pos = patch_buzzer(
+            mm,
+            pos,
+            args,
+        )
+    pos = write32(
+        mm,
+        pos,
+        0 if args.airport_baud is None else args.airport_baud,
+    )
+    return pos
+
+
+def patch_buzzer(
+    mm,
+    pos,
+    args,
+):
+    # Мелодии (melodyparser) не поддерживаются, для режимов с мелодией
+    # остается мелодия, записанная в образе
+    if args.buzzer_mode == BuzzerMode.quiet:
+        mm[pos] = 0
+    elif args.buzzer_mode == BuzzerMode.one:
+        mm[pos] = 1
+    elif args.buzzer_mode == BuzzerMode.custom:
+        raise ValueError("Custom buzzer melodies are not supported")
+    elif args.buzzer_mode is not None:
+        mm[pos] = 2
+    pos += 1
+    pos += 32 * 4  # 32 notes x (2 bytes tone, 2 bytes duration)
+    return pos
+
+
+def domain_number(
+    domain,
+):
+    if domain == RegulatoryDomain.au_915:
+        return 0
+    elif domain == RegulatoryDomain.fcc_915:
+        return 1
+    elif domain == RegulatoryDomain.eu_868:
+        return 2
+    elif domain == RegulatoryDomain.in_866:
+        return 3
+    elif domain == RegulatoryDomain.au_433:
+        return 4
+    elif domain == RegulatoryDomain.eu_433:
+        return 5
+
+
+def patch_legacy(
+    options,
+    mm,
+    pos,
+    args,
+):
+    """Записать параметры в legacy (STM32) образ, pos - смещение после
+    магического числа и версии (см. ELRS.get_hardware)"""
+    if options.mcuType is not MCUType.STM32:
+        raise ValueError("Legacy layout is only used by STM32 targets")
+    if pos < 0:
+        raise ValueError("Hardware config block not found in firmware image")
+    if options.radioChip is RadioType.SX127X and args.domain:
+        mm[pos] = domain_number(args.domain)
+    pos += 1
+    pos = patch_uid(
+        mm,
+        pos,
+        args,
+    )
+    if options.deviceType is DeviceType.TX:
+        pos = patch_tx_params(
+            mm,
+            pos,
+            args,
+            options,
+        )
+    elif options.deviceType is DeviceType.RX:
+        pos = patch_rx_params(
+            mm,
+            pos,
+            args,
+        )
+    return pos
+
 
 # def patch_unified(args, options):
 #     json_flags = {}
@@ -0,0 +1,176 @@
+"""Время от подключения до первого блока в esptool write_flash -z.
+
+Вместо приемника используется имитация загрузчика ESP32 (stub), которая
+принимает блоки deflate и считает MD5 распакованных данных. Замеряется
+подготовка на стороне ПК: первый вызов - с пустым кэшем сжатия, следующие -
+когда тот же образ шьется на очередной приемник.
+
+    python -m modules.esp_bench [firmware.bin] [--runs 5]
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import random
+import sys
+import time
+import zlib
+from types import SimpleNamespace
+
+from external.esptool.esptool import cmds as esptool_cmds
+
+
+class _SimulatedEsp:
+    CHIP_NAME = "ESP32"
+    IS_STUB = True
+    FLASH_WRITE_SIZE = 0x4000
+    FLASH_SECTOR_SIZE = 0x1000
+    FLASH_ENCRYPTED_WRITE_ALIGN = 32
+    BOOTLOADER_FLASH_OFFSET = 0x1000
+    CHIP_DETECT_MAGIC_REG_ADDR = 0x40001000
+    secure_download_mode = False
+
+    def __init__(
+        self,
+    ):
+        self.started = time.perf_counter()
+        self.first_block = None
+        self._decompress = None
+        self._md5 = None
+
+    def flash_defl_begin(
+        self,
+        size,
+        compsize,
+        offset,
+    ):
+        self._decompress = zlib.decompressobj()
+        self._md5 = hashlib.md5()
+        return (compsize + self.FLASH_WRITE_SIZE - 1) // self.FLASH_WRITE_SIZE
+
+    def flash_defl_block(
+        self,
+        data,
+        seq,
+        timeout=None,
+    ):
+        if self.first_block is None:
+            self.first_block = time.perf_counter() - self.started
+        self._md5.update(self._decompress.decompress(data))
+
+    def flash_md5sum(
+        self,
+        address,
+        size,
+    ):
+        return self._md5.hexdigest()
+
+    def read_reg(
+        self,
+        addr,
+        timeout=None,
+    ):
+        return 0
+
+    def flash_begin(
+        self,
+        size,
+        offset,
+        begin_rom_encrypted=False,
+    ):
+        return 0
+
+    def flash_defl_finish(
+        self,
+        reboot=False,
+    ):
+        pass
+
+    def tune_latency(
+        self,
+    ):
+        return 0.0
+
+    def set_port_timeout(
+        self,
+        timeout,
+    ):
+        return None
+
+
+def _args(
+    image,
+):
+    return SimpleNamespace(
+        compress=True,
+        no_compress=False,
+        no_stub=False,
+        force=True,
+        encrypt=False,
+        encrypt_files=None,
+        ignore_flash_encryption_efuse_setting=False,
+        flash_size="keep",
+        flash_mode="keep",
+        flash_freq="keep",
+        erase_all=False,
+        skip_unchanged=False,
+        verify=False,
+        addr_filename=[(0x10000, io.BytesIO(image))],
+    )
+
+
+def synthetic_image(
+    size=1024 * 1024,
+):
+    """Образ, который сжимается примерно как прошивка ELRS"""
+    rng = random.Random(0)
+    words = [rng.randbytes(rng.randint(2, 16)) for _ in range(4096)]
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words)
+    return bytes(data[:size])
+
+
+def first_block_time(
+    image,
+):
+    esp = _SimulatedEsp()
+    # Вывод write_flash здесь не нужен
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        esptool_cmds.write_flash(esp, _args(image))
+    finally:
+        sys.stdout = stdout
+    return esp.first_block
+
+
+def main(
+    argv=None,
+):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("firmware", nargs="?", help="Образ (по умолчанию 1 МБ)")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.firmware:
+        with open(args.firmware, "rb") as f:
+            image = f.read()
+        name = os.path.basename(args.firmware)
+    else:
+        image = synthetic_image()
+        name = "синтетический образ"
+    print(f"{name}: {len(image)} байт, {len(zlib.compress(image, 9))} сжато")
+
+    for run in range(args.runs):
+        label = "пустой кэш" if run == 0 else "из кэша"
+        print(
+            f"Прошивка {run + 1}: первый блок через "
+            f"{first_block_time(image) * 1000:.1f} мс ({label})"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
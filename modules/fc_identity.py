@@ -0,0 +1,203 @@
+"""База полетных контроллеров в SQLite, ключ - UID микроконтроллера.
+
+Одним обменом MSP (sessions.probe_fc) FC сообщает UID, прошивку, версию и
+плату; здесь к ним добавляются номер UART приемника, проверенный при
+passthrough, и отпечаток последнего залитого конфига. По ним повторный
+passthrough обходится без проверки настроек в CLI, а конфиг, который уже стоит
+на FC, не заливается заново.
+
+    python -m modules.fc_identity [путь к базе]
+"""
+
+import functools
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import NamedTuple, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fcs (
+    uid TEXT PRIMARY KEY,
+    variant TEXT,
+    version TEXT,
+    board TEXT,
+    target TEXT,
+    serialrx TEXT,
+    config_hash TEXT,
+    config_version TEXT,
+    seen REAL NOT NULL
+);
+"""
+
+_FIELDS = (
+    "uid",
+    "variant",
+    "version",
+    "board",
+    "target",
+    "serialrx",
+    "config_hash",
+    "config_version",
+    "seen",
+)
+
+
+class FcIdentity(NamedTuple):
+    uid: str
+    variant: Optional[str]
+    version: Optional[str]
+    board: Optional[str]
+    target: Optional[str]
+    # Номер UART приемника с проверенными настройками serialrx
+    serialrx: Optional[str]
+    # Отпечаток последнего залитого конфига и версия прошивки в тот момент
+    config_hash: Optional[str]
+    config_version: Optional[str]
+    seen: float
+
+    def config_applied(
+        self,
+        config_hash,
+    ):
+        """Этот конфиг уже залит на FC с текущей прошивкой"""
+        return (
+            self.config_hash == config_hash
+            and self.version is not None
+            and self.config_version == self.version
+        )
+
+
+def config_hash(
+    commands,
+):
+    """SHA-256 команд конфига (FC.read_config_commands)"""
+    return hashlib.sha256("\n".join(commands).encode()).hexdigest()
+
+
+class FcDatabase:
+    def __init__(
+        self,
+        path=None,
+    ) -> None:
+        if path is None:
+            path = os.path.expanduser("~") + "/ultra_flasher.fc.db"
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def close(
+        self,
+    ):
+        with self._lock:
+            self._db.close()
+
+    def _execute(
+        self,
+        sql,
+        params=(),
+    ):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def get(
+        self,
+        uid,
+    ) -> Optional[FcIdentity]:
+        rows = self._execute(
+            "SELECT %s FROM fcs WHERE uid = ?" % ", ".join(_FIELDS),
+            (uid,),
+        )
+        return FcIdentity(*rows[0]) if rows else None
+
+    def seen(
+        self,
+        uid,
+        variant,
+        version,
+        board,
+        target,
+    ) -> FcIdentity:
+        """Запомнить ответ FC на опрос, сохраненные настройки остаются"""
+        self._execute(
+            "INSERT INTO fcs (uid, variant, version, board, target, seen) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (uid) DO UPDATE SET "
+            "variant = excluded.variant, version = excluded.version, "
+            "board = excluded.board, target = excluded.target, seen = excluded.seen",
+            (uid, variant, version, board, target, time.time()),
+        )
+        return self.get(uid)
+
+    def set_serialrx(
+        self,
+        uid,
+        serialrx,
+    ):
+        """Номер UART приемника; None - проверить настройки заново"""
+        self._execute(
+            "UPDATE fcs SET serialrx = ? WHERE uid = ?",
+            (serialrx, uid),
+        )
+
+    def config_applied(
+        self,
+        uid,
+        config_hash,
+        version,
+    ):
+        self._execute(
+            "UPDATE fcs SET config_hash = ?, config_version = ? WHERE uid = ?",
+            (config_hash, version, uid),
+        )
+
+    def firmware_flashed(
+        self,
+        uid,
+    ):
+        """Прошивка FC сбрасывает его настройки: конфиг и UART приемника
+        неизвестны до следующего опроса"""
+        self._execute(
+            "UPDATE fcs SET version = NULL, serialrx = NULL, config_hash = NULL, "
+            "config_version = NULL WHERE uid = ?",
+            (uid,),
+        )
+
+    def all(
+        self,
+    ):
+        rows = self._execute(
+            "SELECT %s FROM fcs ORDER BY seen DESC" % ", ".join(_FIELDS)
+        )
+        return [FcIdentity(*row) for row in rows]
+
+
+@functools.lru_cache(maxsize=None)
+def get_database():
+    return FcDatabase()
+
+
+if __name__ == "__main__":
+    database = FcDatabase(sys.argv[1] if len(sys.argv) > 1 else None)
+    for fc in database.all():
+        print(
+            "%s  %s  %-4s %-8s %-4s %-20s UART %-4s конфиг %s"
+            % (
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(fc.seen)),
+                fc.uid,
+                fc.variant or "?",
+                fc.version or "?",
+                fc.board or "?",
+                fc.target or "?",
+                fc.serialrx or "-",
+                fc.config_hash[:12] if fc.config_hash else "-",
+            )
+        )
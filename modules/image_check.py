@@ -0,0 +1,449 @@
+"""Проверка образов прошивки до того, как они попадут на устройство.
+
+ESP образ разбирается esptool.bin_image прямо из памяти: заголовок, сегменты,
+контрольная сумма и SHA-256 (ESP32), затем проверяется блок Unified
+конфигурации за концом образа. В STM32 образе ищется блок конфигурации
+(магическое число BEEFBABECAFEF00D). Результат запоминается по MD5 образа,
+поэтому один и тот же образ для партии приемников проверяется один раз.
+
+Проверить все прошивки зеркала (параллельно в нескольких процессах):
+    python -m modules.image_check mirror [--version 3.2.1] [--lbt] [--drop]
+Проверить файл:
+    python -m modules.image_check file firmware.bin --kind esp32
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import struct
+import sys
+import threading
+from typing import Dict, NamedTuple, Tuple
+
+from external.esptool.esptool import bin_image
+from external.esptool.esptool.loader import ESPLoader
+from external.esptool.esptool.util import FatalError
+from modules import UnifiedConfig
+from modules import manifest as firmware_manifest
+from modules.classes import MCUType
+
+KIND_ESP32 = "esp32"
+KIND_ESP8266 = "esp8266"
+KIND_STM32 = "stm32"
+# bootloader.bin ESP32: образ без блока конфигурации
+KIND_ESP32_BOOTLOADER = "esp32-bootloader"
+KIND_PARTITIONS = "partitions"
+KINDS = (KIND_ESP32, KIND_ESP8266, KIND_STM32, KIND_ESP32_BOOTLOADER, KIND_PARTITIONS)
+
+MCU_KINDS = {
+    MCUType.ESP32: KIND_ESP32,
+    MCUType.ESP8266: KIND_ESP8266,
+    MCUType.STM32: KIND_STM32,
+}
+# Части манифеста ESP32 кроме firmware.bin; boot_app0.bin не проверяется
+PART_KINDS = {
+    "bootloader.bin": KIND_ESP32_BOOTLOADER,
+    "partitions.bin": KIND_PARTITIONS,
+}
+
+HARDWARE_MAGIC = b"\xBE\xEF\xBA\xBE\xCA\xFE\xF0\x0D"
+# Вторая копия заголовка ESP8266 (загрузчик eboot + приложение)
+ESP8266_APP_OFFSET = 0x1000
+PARTITION_MAGIC = b"\xAA\x50"
+
+VALIDATE_WORKERS = os.cpu_count() or 4
+
+
+class ImageError(Exception):
+    pass
+
+
+class ImageReport(NamedTuple):
+    kind: str
+    md5: str
+    size: int
+    # Начало блока Unified конфигурации (ESP) или блока hardware (STM32), -1
+    config_pos: int
+    errors: Tuple[str, ...]
+
+    @property
+    def ok(
+        self,
+    ):
+        return not self.errors
+
+
+def _xor_checksum(
+    data,
+    state=ESPLoader.ESP_CHECKSUM_MAGIC,
+):
+    """ESPLoader.checksum без цикла по байтам: XOR половин числа"""
+    value = int.from_bytes(data, "little")
+    size = len(data)
+    while size > 1:
+        half = size // 2
+        value = (value & ((1 << (8 * half)) - 1)) ^ (value >> (8 * half))
+        size -= half
+    return state ^ value
+
+
+def _c_string(
+    view,
+    size,
+):
+    """Строка до первого нуля в поле фиксированной длины"""
+    raw = bytes(view[:size])
+    return raw.split(b"\0", 1)[0]
+
+
+def _check_segments(
+    image,
+    errors,
+):
+    checksum = ESPLoader.ESP_CHECKSUM_MAGIC
+    for segment in image.segments:
+        if segment.include_in_checksum:
+            checksum = _xor_checksum(segment.data, checksum)
+    if checksum != image.checksum:
+        errors.append(
+            "Контрольная сумма 0x%02x, в образе 0x%02x" % (checksum, image.checksum)
+        )
+    if getattr(image, "append_digest", False):
+        if image.stored_digest != image.calc_digest:
+            errors.append("SHA-256 образа не совпадает")
+
+
+def _load(
+    view,
+    chip,
+    offset,
+    errors,
+):
+    try:
+        stream = io.BytesIO(view)
+        stream.seek(offset)
+        return bin_image.LoadFirmwareImage(chip, stream)
+    except (FatalError, struct.error, TypeError) as err:
+        # TypeError: ord() пустого остатка файла
+        errors.append(f"Образ по адресу 0x{offset:x} не разбирается: {err}")
+        return None
+
+
+def _check_unified(
+    view,
+    end,
+    errors,
+):
+    """Блок конфигурации за концом образа, если он уже записан"""
+    block = view[end:]
+    header_size = (
+        UnifiedConfig.PRODUCT_NAME_SIZE
+        + UnifiedConfig.DEVICE_NAME_SIZE
+        + UnifiedConfig.DEFINES_SIZE
+    )
+    if not any(block[:header_size]) or all(b == 0xFF for b in block[:header_size]):
+        return
+    if len(block) < header_size:
+        errors.append("Блок конфигурации обрезан")
+        return
+    pos = 0
+    for name, size in (
+        ("product_name", UnifiedConfig.PRODUCT_NAME_SIZE),
+        ("lua_name", UnifiedConfig.DEVICE_NAME_SIZE),
+    ):
+        try:
+            _c_string(block[pos:], size).decode()
+        except UnicodeDecodeError:
+            errors.append(f"Блок конфигурации: {name} не UTF-8")
+        pos += size
+    for name, raw in (
+        ("defines", _c_string(block[pos:], UnifiedConfig.DEFINES_SIZE)),
+        ("hardware", _c_string(block[header_size:], len(block) - header_size)),
+    ):
+        if not raw:
+            continue
+        try:
+            if not isinstance(json.loads(raw), dict):
+                raise ValueError
+        except ValueError:
+            errors.append(f"Блок конфигурации: {name} не JSON объект")
+
+
+def _check_esp(
+    view,
+    kind,
+    errors,
+):
+    chip = KIND_ESP8266 if kind == KIND_ESP8266 else KIND_ESP32
+    image = _load(view, chip, 0, errors)
+    if image is None:
+        return -1
+    _check_segments(image, errors)
+    if kind == KIND_ESP8266 and len(image.segments) == 2:
+        # См. UnifiedConfig.parseFirmwareEnd: приложение за загрузчиком
+        app = _load(view, chip, ESP8266_APP_OFFSET, errors)
+        if app is None:
+            return -1
+        _check_segments(app, errors)
+    if kind == KIND_ESP32_BOOTLOADER:
+        return -1
+    try:
+        end = UnifiedConfig.parseFirmwareEnd(view)
+    except (ValueError, struct.error) as err:
+        errors.append(str(err))
+        return -1
+    if end > len(view):
+        errors.append("Образ обрезан перед блоком конфигурации")
+        return -1
+    _check_unified(view, end, errors)
+    return end
+
+
+def _check_stm32(
+    view,
+    errors,
+):
+    pos = bytes(view).find(HARDWARE_MAGIC)
+    if pos == -1:
+        errors.append("В образе нет блока конфигурации (BEEFBABECAFEF00D)")
+        return -1
+    # Магическое число и версия (см. ELRS.get_hardware)
+    return pos + len(HARDWARE_MAGIC) + 2
+
+
+def _check_partitions(
+    view,
+    errors,
+):
+    if bytes(view[:2]) != PARTITION_MAGIC:
+        errors.append("Нет таблицы разделов")
+    return -1
+
+
+def inspect_image(
+    data,
+    kind,
+    md5=None,
+) -> ImageReport:
+    """Проверить образ без кэша, ошибки - в отчете"""
+    view = memoryview(data)
+    md5 = md5 or hashlib.md5(view).hexdigest()
+    errors = []
+    if not len(view):
+        errors.append("Пустой файл")
+        config_pos = -1
+    elif kind == KIND_STM32:
+        config_pos = _check_stm32(view, errors)
+    elif kind == KIND_PARTITIONS:
+        config_pos = _check_partitions(view, errors)
+    elif kind in KINDS:
+        config_pos = _check_esp(view, kind, errors)
+    else:
+        raise ValueError(f"Неизвестный тип образа {kind}")
+    return ImageReport(kind, md5, len(view), config_pos, tuple(errors))
+
+
+_reports: Dict[Tuple[str, str], ImageReport] = {}
+_reports_lock = threading.Lock()
+
+
+def inspect(
+    data,
+    kind,
+    md5=None,
+) -> ImageReport:
+    """Отчет о проверке, из кэша, если образ с этим MD5 уже проверялся"""
+    md5 = md5 or hashlib.md5(data).hexdigest()
+    with _reports_lock:
+        report = _reports.get((md5, kind))
+    if report is None:
+        report = inspect_image(data, kind, md5)
+        with _reports_lock:
+            _reports[(md5, kind)] = report
+    return report
+
+
+def check(
+    data,
+    kind,
+    md5=None,
+    name="Образ",
+) -> ImageReport:
+    """Как inspect
+
+    :raises ImageError:
+        Образ не прошел проверку
+    """
+    report = inspect(data, kind, md5)
+    if not report.ok:
+        raise ImageError(f"{name} поврежден: " + "; ".join(report.errors))
+    return report
+
+
+def check_manifest(
+    manifest,
+    mcu_type,
+):
+    """Проверить все части манифеста прошивки
+
+    :returns:
+        Отчет firmware.bin
+    :raises ImageError:
+        Часть не прошла проверку
+    """
+    result = None
+    for part in manifest.parts:
+        if part.name == firmware_manifest.FIRMWARE:
+            kind = MCU_KINDS[mcu_type]
+        else:
+            kind = PART_KINDS.get(part.name)
+            if kind is None:
+                continue
+        report = check(part.data, kind, part.md5, part.name)
+        if part.name == firmware_manifest.FIRMWARE:
+            result = report
+    return result
+
+
+def mirror_kinds(
+    targets,
+    version,
+    flavour,
+):
+    """{путь в зеркале: тип образа} для прошивок всех таргетов"""
+    from modules import mirror
+
+    kinds = {}
+    platforms = {"esp32": KIND_ESP32, "stm32": KIND_STM32}
+    for config in mirror.iter_targets(targets):
+        firmware_kind = platforms.get(config["platform"], KIND_ESP8266)
+        layout = (
+            firmware_manifest.ESP32_LAYOUT
+            if firmware_kind == KIND_ESP32
+            else firmware_manifest.APP_LAYOUT
+        )
+        for part, _, _ in layout:
+            kind = (
+                firmware_kind
+                if part == firmware_manifest.FIRMWARE
+                else PART_KINDS.get(part)
+            )
+            if kind is not None:
+                path = mirror.firmware_path(version, flavour, config["firmware"], part)
+                kinds[path] = kind
+    return kinds
+
+
+def _inspect_file(
+    path,
+    kind,
+    md5,
+):
+    # Выполняется в отдельном процессе
+    with open(path, "rb") as f:
+        return inspect_image(f.read(), kind, md5)
+
+
+def validate_mirror(
+    firmware_mirror,
+    kinds,
+    workers=VALIDATE_WORKERS,
+) -> Dict[str, ImageReport]:
+    """Проверить файлы зеркала {путь: тип} в нескольких процессах.
+
+    Файлы, которых нет в зеркале, пропускаются; уже проверенные (по MD5 из
+    индекса зеркала) берутся из кэша.
+
+    :returns:
+        {путь: отчет}
+    """
+    reports = {}
+    # Одинаковые файлы разных таргетов проверяются один раз: {(md5, тип): [путь]}
+    pending: Dict[Tuple[str, str], list] = {}
+    for path, kind in kinds.items():
+        entry = firmware_mirror.index.get(path)
+        if not entry:
+            continue
+        key = (entry["md5"], kind)
+        with _reports_lock:
+            report = _reports.get(key)
+        if report is not None:
+            reports[path] = report
+        else:
+            pending.setdefault(key, []).append(path)
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = {
+            pool.submit(
+                _inspect_file,
+                os.path.join(firmware_mirror.root, paths[0]),
+                kind,
+                md5,
+            ): (md5, kind)
+            for (md5, kind), paths in pending.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            md5, kind = key = futures[future]
+            try:
+                report = future.result()
+            except OSError as err:
+                report = ImageReport(kind, md5, 0, -1, (str(err),))
+            with _reports_lock:
+                _reports[key] = report
+            for path in pending[key]:
+                reports[path] = report
+    return reports
+
+
+def main(
+    argv=None,
+):
+    parser = argparse.ArgumentParser(description="Проверка образов прошивки")
+    commands = parser.add_subparsers(dest="command", required=True)
+    file_parser = commands.add_parser("file")
+    file_parser.add_argument("path")
+    file_parser.add_argument("--kind", choices=KINDS, required=True)
+    mirror_parser = commands.add_parser("mirror")
+    mirror_parser.add_argument("--root", default=None, help="Каталог зеркала")
+    mirror_parser.add_argument("--version", default=None)
+    mirror_parser.add_argument("--lbt", action="store_true", help="LBT вместо FCC")
+    mirror_parser.add_argument("--workers", type=int, default=VALIDATE_WORKERS)
+    mirror_parser.add_argument(
+        "--drop",
+        action="store_true",
+        help="Убрать поврежденные файлы из индекса, чтобы скачать их заново",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "file":
+        with open(args.path, "rb") as f:
+            report = inspect_image(f.read(), args.kind)
+        for error in report.errors:
+            print(f"[!] {error}")
+        print(f"{args.path}: {'OK' if report.ok else 'поврежден'}")
+        return 0 if report.ok else 1
+
+    from modules import mirror
+
+    firmware_mirror = mirror.Mirror(args.root)
+    kinds = mirror_kinds(
+        UnifiedConfig.loadTargets(),
+        args.version or mirror.DEFAULT_VERSION,
+        mirror.FLAVOURS[1] if args.lbt else mirror.FLAVOURS[0],
+    )
+    reports = validate_mirror(firmware_mirror, kinds, args.workers)
+    bad = sorted(path for path, report in reports.items() if not report.ok)
+    print(f"Проверено: {len(reports)}, повреждено: {len(bad)}")
+    for path in bad:
+        print(f"[!] {path}: {'; '.join(reports[path].errors)}")
+    if bad and args.drop:
+        firmware_mirror.forget(bad)
+        print("Поврежденные файлы будут скачаны заново")
+    return 1 if bad else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,613 @@
+"""Очередь задач прошивки, общая для окна и HTTP сервиса.
+
+Задачи-корутины (прошивка ELRS и FC) выполняются в событийном цикле сессий
+(modules.sessions) и отменяются на любом шаге, обычные функции - в пуле
+потоков. Все, что задача печатает, попадает в ее собственный журнал строк (и,
+как раньше, в общий вывод), поэтому состояние и логи каждой задачи можно
+читать, не мешая прошивке.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import dataclasses
+import functools
+import itertools
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from fc_flasher.progress import ProgressModel, ThrottledListener
+from modules.classes import ElrsUploadResult
+
+# Сколько раз продолжать прерванную прошивку после переподключения
+RESUME_ATTEMPTS = 3
+RECONNECT_TIMEOUT = 30
+
+MAX_JOBS = 8
+# Завершенные задачи в памяти: не больше MAX_FINISHED_JOBS и не старше
+# FINISHED_JOB_TTL секунд, остальные читаются из журнала
+MAX_FINISHED_JOBS = 100
+FINISHED_JOB_TTL = 3600
+
+# Состояния задачи
+STATE_QUEUED = "queued"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+STATE_CANCELLED = "cancelled"
+FINISHED_STATES = (STATE_DONE, STATE_FAILED, STATE_CANCELLED)
+
+# Задача, в которой выполняется текущий поток или корутина
+_current_job = contextvars.ContextVar("job", default=None)
+
+
+class JobError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class Job:
+    id: int
+    kind: str
+    port: str
+    params: dict
+    state: str = STATE_QUEUED
+    error: Optional[str] = None
+    created: float = dataclasses.field(default_factory=time.time)
+    started: float = 0.0
+    finished: float = 0.0
+    progress: Optional[dict] = None
+    log: List[str] = dataclasses.field(default_factory=list)
+
+    def complete_lines(
+        self,
+    ):
+        """Число завершенных строк журнала (последняя может дописываться)"""
+        if self.log and not self.log[-1].endswith("\n"):
+            return len(self.log) - 1
+        return len(self.log)
+
+    def status(
+        self,
+    ):
+        """Снимок состояния без журнала"""
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "port": self.port,
+            "state": self.state,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": self.progress,
+            "log_lines": self.complete_lines(),
+        }
+
+
+class _JobOutput:
+    """sys.stdout, раскладывающий вывод по задачам потоков и корутин.
+
+    Вывод без задачи идет только в исходный поток вывода."""
+
+    def __init__(
+        self,
+        engine,
+        stream,
+    ):
+        self.engine = engine
+        self.stream = stream
+
+    def write(
+        self,
+        message,
+    ):
+        job = _current_job.get()
+        if job is not None:
+            self.engine._append(job, message)
+        return self.stream.write(message)
+
+    def flush(
+        self,
+    ):
+        self.stream.flush()
+
+    def isatty(
+        self,
+    ):
+        return False
+
+
+def job_progress(
+    engine,
+    job,
+):
+    """Модель прогресса задачи: в состояние задачи попадает не чаще
+    UI_REFRESH_HZ раз в секунду"""
+    progress = ProgressModel()
+    progress.add_listener(
+        ThrottledListener(lambda device: engine.set_progress(job, device.as_dict()))
+    )
+    return progress
+
+
+async def run_fc(
+    engine,
+    job,
+):
+    from modules import fc_identity, sessions
+    from modules.FC import FC
+
+    com = job.port
+    firmware_file = job.params.get("firmware", "")
+    config_file = job.params.get("config", "")
+    # Залить конфиг, даже если по базе FC он уже залит
+    force_config = bool(job.params.get("force_config"))
+    upload_method = job.params.get("upload_method", "dfu")
+    cpus = job.params.get("cpus")
+    if isinstance(cpus, str):
+        cpus = [cpus]
+
+    fc = FC(com, firmware_file, config_file, cpus=cpus)
+    progress = job_progress(engine, job)
+
+    if not firmware_file and config_file:
+        print("Пытаемся залить конфиг")
+        await sessions.countdown(15)
+        await sessions.upload_config(
+            com,
+            config_file,
+            progress,
+            force=force_config,
+        )
+        return
+
+    if not firmware_file:
+        raise JobError("Неверные параметры.")
+
+    # После прошивки настройки FC в базе FC (fc_identity) больше не верны
+    fc_info = await sessions.probe_fc(com)
+
+    # Несколько FC в DFU не различить до перехода, поэтому DFU и ST-Link
+    # используются одной задачей за раз
+    async with sessions.hold(engine.dfu_lock):
+        if upload_method == "stlink":
+            print("Прошиваем через ST-Link")
+            await sessions.blocking(fc.flash_stlink)
+        else:
+            print("Пробуем перейти в DFU")
+            try:
+                await sessions.enter_dfu(com)
+            except Exception as ex:
+                raise JobError(f"FC не перешел в DFU: {ex}") from ex
+            print("Найдено DFU устройство")
+            for attempt in range(RESUME_ATTEMPTS + 1):
+                try:
+                    await sessions.blocking(
+                        fc.flash,
+                        engine.journal,
+                        progress,
+                    )
+                    break
+                except Exception as ex:
+                    print(f"[!] Прошивка прервана: {ex}")
+                    if attempt == RESUME_ATTEMPTS:
+                        raise
+                    print("Ожидаем переподключения DFU устройства")
+                    await sessions.enter_dfu(com)
+    if fc_info is not None:
+        fc_identity.get_database().firmware_flashed(fc_info.uid)
+    if config_file:
+        print("Пробуем залить конфиг")
+        await sessions.countdown(15)
+        await sessions.upload_config(
+            com,
+            config_file,
+            progress,
+            force=force_config,
+        )
+
+
+def _check_elrs_result(
+    status,
+):
+    if status == ElrsUploadResult.Success:
+        print("Успешно")
+    elif status == ElrsUploadResult.ErrorGeneral:
+        raise JobError("Произошла ошибка при прошивке")
+    elif status == ElrsUploadResult.ErrorMismatch:
+        raise JobError("Произошла ошибка при выборе таргета")
+
+
+async def flash_elrs(
+    elrs,
+):
+    """Прошить приемник, переподключаясь после общей ошибки"""
+    from modules import sessions
+
+    status = await sessions.flash_elrs(elrs)
+    for _ in range(RESUME_ATTEMPTS):
+        if status != ElrsUploadResult.ErrorGeneral:
+            break
+        if not await sessions.wait_for_port(elrs.port, RECONNECT_TIMEOUT):
+            break
+        status = await sessions.flash_elrs(elrs)
+    _check_elrs_result(status)
+
+
+async def run_elrs(
+    engine,
+    job,
+):
+    from modules import mirror, sessions, targets
+    from modules.ELRS import ELRS
+    from modules.prepare import get_preparer
+
+    upload_method = job.params.get("upload_method", "betaflight")
+    if upload_method == "stlink" and "stlink" not in (
+        targets.find(job.params["target"]).config
+    ):
+        raise JobError(f"Таргет {job.params['target']} не шьется через ST-Link")
+    factory = bool(job.params.get("factory"))
+    version = job.params.get("version") or mirror.DEFAULT_VERSION
+    flavour = job.params.get("flavour") or mirror.FLAVOURS[0]
+    # Сборка идет в процессе пула, задача только ждет и шьет. Порт еще не
+    # занят, поэтому при отмене ожидание бросается без ожидания сборки
+    prepared = await asyncio.to_thread(
+        get_preparer().get,
+        job.params["target"],
+        job.params["phrase"],
+        factory,
+        version,
+        flavour,
+    )
+    elrs = await sessions.blocking(
+        functools.partial(
+            ELRS,
+            target=job.params["target"],
+            phrase=job.params["phrase"],
+            port=job.port,
+            force=True,
+            erase=False,
+            journal=engine.journal,
+            progress=job_progress(engine, job),
+            factory=factory,
+            prepared=prepared,
+            version=version,
+            flavour=flavour,
+            upload_method=upload_method,
+        )
+    )
+    try:
+        if upload_method == "stlink":
+            # ST-Link один на все задачи, как у FC
+            async with sessions.hold(engine.dfu_lock):
+                await flash_elrs(elrs)
+        else:
+            await flash_elrs(elrs)
+    finally:
+        elrs.close()
+
+
+async def run_provision(
+    engine,
+    job,
+):
+    from modules import provisioning
+
+    await provisioning.run_unit(engine, job)
+
+
+JOB_KINDS: Dict[str, Callable] = {
+    "fc": run_fc,
+    "elrs": run_elrs,
+    "provision": run_provision,
+}
+
+JobListener = Callable[[Job], None]
+
+
+class JobEngine:
+    def __init__(
+        self,
+        journal=None,
+        max_jobs=MAX_JOBS,
+        kinds=None,
+    ) -> None:
+        self.journal = journal
+        self.kinds = dict(JOB_KINDS if kinds is None else kinds)
+        self.dfu_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._jobs: Dict[int, Job] = {}
+        self._futures: Dict[int, concurrent.futures.Future] = {}
+        self._ids = itertools.count(1)
+        self._listeners: List[JobListener] = []
+        self._pool = ThreadPoolExecutor(
+            max_jobs,
+            thread_name_prefix="job",
+        )
+        self._sessions = None
+        self._output = None
+        # Ключ задач этого запуска в журнале
+        self._run_id = uuid.uuid4().hex
+
+    def install_output(
+        self,
+    ):
+        """Перехватить sys.stdout/sys.stderr для журналов задач"""
+        if self._output is None:
+            self._output = _JobOutput(self, sys.stdout)
+            sys.stdout = self._output
+            sys.stderr = _JobOutput(self, sys.stderr)
+
+    def _get_sessions(
+        self,
+    ):
+        from modules.sessions import SessionEngine
+
+        with self._lock:
+            if self._sessions is None:
+                self._sessions = SessionEngine()
+            return self._sessions
+
+    def is_async(
+        self,
+        kind,
+    ):
+        return asyncio.iscoroutinefunction(self.kinds[kind])
+
+    def add_listener(
+        self,
+        listener,
+    ):
+        self._listeners.append(listener)
+
+    def submit(
+        self,
+        kind,
+        port,
+        params,
+    ):
+        if kind not in self.kinds:
+            raise JobError(f"Неизвестный тип задачи {kind}")
+        with self._lock:
+            busy = [
+                job.id
+                for job in self._jobs.values()
+                if job.port == port and job.state in (STATE_QUEUED, STATE_RUNNING)
+            ]
+            if busy:
+                raise JobError(f"{port} уже занят задачей {busy[0]}")
+            job = Job(next(self._ids), kind, port, dict(params))
+            self._jobs[job.id] = job
+        if self.is_async(kind):
+            future = self._get_sessions().submit(self._run_async(job))
+        else:
+            future = self._pool.submit(self._run, job)
+        with self._lock:
+            self._futures[job.id] = future
+        future.add_done_callback(functools.partial(self._done, job))
+        self._notify(job)
+        return job.id
+
+    def _done(
+        self,
+        job,
+        future,
+    ):
+        # Отмененная корутина еще может дожидаться записи в потоке, тогда
+        # задачу забывает _run_async
+        if job.state == STATE_QUEUED:
+            self._update(job, state=STATE_CANCELLED, finished=time.time())
+        if job.state in FINISHED_STATES:
+            self._forget(job)
+
+    def _forget(
+        self,
+        job,
+    ):
+        with self._changed:
+            self._futures.pop(job.id, None)
+            self._changed.notify_all()
+
+    def _run(
+        self,
+        job,
+    ):
+        token = _current_job.set(job)
+        self._update(job, state=STATE_RUNNING, started=time.time())
+        try:
+            self.kinds[job.kind](self, job)
+        except Exception as ex:
+            self._failed(job, ex)
+        else:
+            self._update(job, state=STATE_DONE, finished=time.time())
+        finally:
+            _current_job.reset(token)
+
+    async def _run_async(
+        self,
+        job,
+    ):
+        # У корутины свой контекст, сбрасывать задачу не нужно
+        _current_job.set(job)
+        self._update(job, state=STATE_RUNNING, started=time.time())
+        try:
+            await self.kinds[job.kind](self, job)
+        except asyncio.CancelledError:
+            print("[!] Задача отменена")
+            self._update(job, state=STATE_CANCELLED, finished=time.time())
+        except Exception as ex:
+            self._failed(job, ex)
+        else:
+            self._update(job, state=STATE_DONE, finished=time.time())
+        finally:
+            self._forget(job)
+
+    def _failed(
+        self,
+        job,
+        ex,
+    ):
+        print(f"[!] {ex}")
+        self._update(job, state=STATE_FAILED, error=str(ex), finished=time.time())
+
+    def cancel(
+        self,
+        job_id,
+    ):
+        """Отменить задачу: ждущую в очереди или корутину на любом шаге.
+        Корутина завершается после текущей операции в потоке (запись образа)
+
+        :raises JobError:
+            Задача не найдена, уже завершена или выполняется в потоке
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            future = self._futures.get(job_id)
+        if job is None:
+            raise JobError(f"Задача {job_id} не найдена")
+        if future is None or job.state in FINISHED_STATES:
+            raise JobError(f"Задача {job_id} уже завершена")
+        if not future.cancel():
+            raise JobError(f"Задача {job_id} выполняется и не может быть отменена")
+
+    def _update(
+        self,
+        job,
+        **fields,
+    ):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(job, name, value)
+            self._changed.notify_all()
+        self._notify(job)
+        if fields.get("state") in FINISHED_STATES:
+            self._finished(job)
+
+    def _finished(
+        self,
+        job,
+    ):
+        """Сохранить завершенную задачу в журнал и убрать из памяти старые"""
+        if self.journal is not None:
+            with self._lock:
+                status, log = job.status(), list(job.log)
+            self.journal.save_log(self._run_id, status, log)
+        expired = time.time() - FINISHED_JOB_TTL
+        with self._lock:
+            finished = sorted(
+                (item for item in self._jobs.values() if item.state in FINISHED_STATES),
+                key=lambda item: item.finished,
+            )
+            extra = len(finished) - MAX_FINISHED_JOBS
+            for i, old in enumerate(finished):
+                if i < extra or old.finished < expired:
+                    del self._jobs[old.id]
+
+    def _saved(
+        self,
+        job_id,
+    ):
+        if self.journal is None:
+            return None
+        return self.journal.load_log(self._run_id, job_id)
+
+    def _append(
+        self,
+        job,
+        message,
+    ):
+        with self._changed:
+            # Строки копятся по \n, print пишет текст и перевод строки отдельно
+            lines = message.split("\n")
+            if job.log and not job.log[-1].endswith("\n"):
+                job.log[-1] += lines.pop(0)
+                if lines:
+                    job.log[-1] += "\n"
+            job.log.extend(line + "\n" for line in lines[:-1])
+            if lines and lines[-1]:
+                job.log.append(lines[-1])
+            self._changed.notify_all()
+
+    def _notify(
+        self,
+        job,
+    ):
+        for listener in self._listeners:
+            listener(job)
+
+    def set_progress(
+        self,
+        job,
+        progress,
+    ):
+        self._update(job, progress=progress)
+
+    def get(
+        self,
+        job_id,
+    ):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.status()
+        saved = self._saved(job_id)
+        return None if saved is None else saved[0]
+
+    def list(
+        self,
+    ):
+        """Задачи в памяти: активные и недавно завершенные"""
+        with self._lock:
+            return [job.status() for job in self._jobs.values()]
+
+    def log(
+        self,
+        job_id,
+        since=0,
+    ):
+        """Строки журнала начиная с since"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.log[since : job.complete_lines()]
+        saved = self._saved(job_id)
+        return None if saved is None else saved[1][since:]
+
+    def wait(
+        self,
+        job_id,
+        since,
+        state,
+        timeout,
+    ):
+        """Дождаться новых строк журнала или смены состояния задачи
+
+        :returns:
+            True, если что-то изменилось за timeout
+        """
+
+        def changed():
+            job = self._jobs.get(job_id)
+            # Убранная из памяти задача уже завершена
+            return job is None or job.complete_lines() > since or job.state != state
+
+        with self._changed:
+            return self._changed.wait_for(changed, timeout)
+
+    def shutdown(
+        self,
+        wait=False,
+    ):
+        self._pool.shutdown(wait=wait)
+        if self._sessions is not None:
+            if wait:
+                with self._changed:
+                    self._changed.wait_for(lambda: not self._futures)
+            self._sessions.shutdown()
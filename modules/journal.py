@@ -0,0 +1,280 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# Job phases, in order
+PHASE_STARTED = "started"
+PHASE_DOWNLOAD = "download"
+PHASE_PASSTHROUGH = "passthrough"
+PHASE_DFU = "dfu"
+PHASE_WRITE = "write"
+PHASE_CONFIG = "config"
+PHASE_DONE = "done"
+PHASE_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    image TEXT NOT NULL,
+    image_hash TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    error TEXT,
+    started REAL NOT NULL,
+    updated REAL NOT NULL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_device ON jobs (device, image_hash, finished);
+CREATE INDEX IF NOT EXISTS jobs_started ON jobs (started);
+CREATE TABLE IF NOT EXISTS ranges (
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    address INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    crc32 INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ranges_job ON ranges (job_id);
+CREATE TABLE IF NOT EXISTS job_logs (
+    engine TEXT NOT NULL,
+    job_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    log TEXT NOT NULL,
+    PRIMARY KEY (engine, job_id)
+);
+"""
+
+
+def file_hash(
+    path,
+):
+    """SHA-256 файла прошивки, по которому задачи сопоставляются при возобновлении"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Journal:
+    """Журнал задач прошивки в SQLite.
+
+    Для каждого устройства хранит фазу задачи, записанные диапазоны адресов с
+    CRC32 и итог. Незавершенная задача с тем же устройством и образом
+    возобновляется с последнего записанного сектора.
+    """
+
+    def __init__(
+        self,
+        path=None,
+    ) -> None:
+        if path is None:
+            path = os.path.expanduser("~") + "/ultra_flasher.journal.db"
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def close(
+        self,
+    ):
+        with self._lock:
+            self._db.close()
+
+    def _execute(
+        self,
+        sql,
+        params=(),
+    ):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def find_unfinished(
+        self,
+        device,
+        image_hash,
+    ):
+        rows = self._execute(
+            "SELECT id FROM jobs WHERE device = ? AND image_hash = ? "
+            "AND finished IS NULL ORDER BY id DESC LIMIT 1",
+            (device, image_hash),
+        )
+        return rows[0][0] if rows else None
+
+    def start(
+        self,
+        device,
+        kind,
+        image,
+        image_hash,
+    ):
+        """Начать задачу или вернуть незавершенную для того же устройства и образа
+
+        :returns:
+            (job_id, resumed)
+        """
+        job_id = self.find_unfinished(device, image_hash)
+        if job_id is not None:
+            return job_id, True
+
+        now = time.time()
+        with self._lock:
+            # Older unfinished jobs for this device are superseded
+            self._db.execute(
+                "UPDATE jobs SET phase = ?, error = ?, finished = ? "
+                "WHERE device = ? AND finished IS NULL",
+                (PHASE_FAILED, "superseded", now, device),
+            )
+            cursor = self._db.execute(
+                "INSERT INTO jobs (device, kind, image, image_hash, phase, "
+                "started, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (device, kind, image, image_hash, PHASE_STARTED, now, now),
+            )
+            return cursor.lastrowid, False
+
+    def phase(
+        self,
+        job_id,
+    ):
+        rows = self._execute("SELECT phase FROM jobs WHERE id = ?", (job_id,))
+        return rows[0][0] if rows else None
+
+    def set_phase(
+        self,
+        job_id,
+        phase,
+    ):
+        self._execute(
+            "UPDATE jobs SET phase = ?, updated = ? WHERE id = ?",
+            (phase, time.time(), job_id),
+        )
+
+    def add_range(
+        self,
+        job_id,
+        address,
+        length,
+        crc32,
+    ):
+        self._execute(
+            "INSERT INTO ranges (job_id, address, length, crc32) VALUES (?, ?, ?, ?)",
+            (job_id, address, length, crc32),
+        )
+
+    def ranges(
+        self,
+        job_id,
+    ):
+        """Записанные диапазоны задачи как список (address, length)"""
+        return self._execute(
+            "SELECT address, length FROM ranges WHERE job_id = ? ORDER BY address",
+            (job_id,),
+        )
+
+    def finish(
+        self,
+        job_id,
+        error=None,
+    ):
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET phase = ?, error = ?, updated = ?, finished = ? "
+            "WHERE id = ?",
+            (PHASE_FAILED if error else PHASE_DONE, error, now, now, job_id),
+        )
+
+    def interrupt(
+        self,
+        job_id,
+        error,
+    ):
+        """Запомнить ошибку, оставив задачу открытой для возобновления"""
+        self._execute(
+            "UPDATE jobs SET error = ?, updated = ? WHERE id = ?",
+            (str(error), time.time(), job_id),
+        )
+
+    def save_log(
+        self,
+        engine,
+        status,
+        log,
+    ):
+        """Итог и журнал строк завершенной задачи очереди (modules.jobs);
+        engine различает запуски, у каждого свои номера задач"""
+        self._execute(
+            "INSERT OR REPLACE INTO job_logs (engine, job_id, status, log) "
+            "VALUES (?, ?, ?, ?)",
+            (engine, status["id"], json.dumps(status), "".join(log)),
+        )
+
+    def load_log(
+        self,
+        engine,
+        job_id,
+    ):
+        """:returns: (состояние, [строки журнала]) или None"""
+        rows = self._execute(
+            "SELECT status, log FROM job_logs WHERE engine = ? AND job_id = ?",
+            (engine, job_id),
+        )
+        if not rows:
+            return None
+        status, log = rows[0]
+        return json.loads(status), log.splitlines(keepends=True)
+
+    def flashed_since(
+        self,
+        timestamp,
+    ):
+        """Задачи, начатые после timestamp:
+        (device, kind, image, image_hash, phase, error, started, finished)"""
+        return self._execute(
+            "SELECT device, kind, image, image_hash, phase, error, started, finished "
+            "FROM jobs WHERE started >= ? ORDER BY started",
+            (timestamp,),
+        )
+
+    def flashed_today(
+        self,
+    ):
+        today = time.localtime()
+        midnight = time.mktime(
+            (today.tm_year, today.tm_mon, today.tm_mday, 0, 0, 0, 0, 0, -1)
+        )
+        return self.flashed_since(midnight)
+
+
+if __name__ == "__main__":
+    journal = Journal(sys.argv[1] if len(sys.argv) > 1 else None)
+    for (
+        device,
+        kind,
+        image,
+        image_hash,
+        phase,
+        error,
+        started,
+        finished,
+    ) in journal.flashed_today():
+        print(
+            "%s  %-16s %-8s %-8s %s (%s)%s"
+            % (
+                time.strftime("%H:%M:%S", time.localtime(started)),
+                device,
+                kind,
+                phase,
+                os.path.basename(image),
+                image_hash[:12],
+                f"  {error}" if error else "",
+            )
+        )
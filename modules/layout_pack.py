@@ -0,0 +1,178 @@
+"""Упаковка аппаратных раскладок resources/RX, resources/TX и targets.json в один
+индексированный файл.
+
+Формат (little-endian):
+    заголовок  "<4sHHI32s": MAGIC, VERSION, 0, число записей, отпечаток
+               исходных файлов (source_fingerprint)
+    индекс     для каждой записи "<IIH": смещение, длина, длина имени + имя (utf-8)
+    данные     JSON каждой записи, сериализованный так же, как его дописывает
+               UnifiedConfig, поэтому раскладку без overlay можно дописывать как есть
+
+Имя записи - путь относительно resources с "/" в качестве разделителя,
+например "RX/Generic 2400.json".
+
+Если исходные JSON новее пакета (отпечаток не совпадает), пакет не
+используется и раскладки читаются из файлов. В собранном Nuitka приложении
+времена файлов меняются при распаковке, поэтому там отпечаток не проверяется.
+
+Сборка: python -m modules.layout_pack
+"""
+
+import functools
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+from modules.get_path import load_file
+
+MAGIC = b"ULFP"
+VERSION = 2
+PACK_FILE = "resources/layouts.pack"
+LAYOUT_DIRS = ("RX", "TX")
+TARGETS_FILE = "targets.json"
+
+_HEADER = struct.Struct("<4sHHI32s")
+_ENTRY = struct.Struct("<IIH")
+
+
+def _source_names(
+    resources_dir,
+):
+    names = [TARGETS_FILE]
+    for layout_dir in LAYOUT_DIRS:
+        names.extend(
+            f"{layout_dir}/{name}"
+            for name in sorted(os.listdir(os.path.join(resources_dir, layout_dir)))
+            if name.endswith(".json")
+        )
+    return names
+
+
+def source_fingerprint(
+    resources_dir,
+):
+    """SHA-256 имен, размеров и времен изменения исходных JSON
+
+    :raises OSError:
+        Исходных файлов нет
+    """
+    sha = hashlib.sha256()
+    for name in _source_names(resources_dir):
+        st = os.stat(os.path.join(resources_dir, name))
+        sha.update(f"{name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return sha.digest()
+
+
+def build(
+    resources_dir,
+    out_path,
+):
+    names = _source_names(resources_dir)
+    fingerprint = source_fingerprint(resources_dir)
+
+    blobs = []
+    for name in names:
+        with open(os.path.join(resources_dir, name)) as f:
+            blobs.append(json.JSONEncoder().encode(json.load(f)).encode())
+
+    encoded_names = [name.encode() for name in names]
+    offset = _HEADER.size + sum(_ENTRY.size + len(name) for name in encoded_names)
+    index = bytearray()
+    for name, blob in zip(encoded_names, blobs):
+        index += _ENTRY.pack(offset, len(blob), len(name)) + name
+        offset += len(blob)
+
+    with open(out_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, len(names), fingerprint))
+        f.write(index)
+        for blob in blobs:
+            f.write(blob)
+    return len(names)
+
+
+class LayoutPack:
+    def __init__(
+        self,
+        path,
+    ) -> None:
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, count, self.fingerprint = _HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a layout pack")
+
+        self.index = {}
+        pos = _HEADER.size
+        for _ in range(count):
+            offset, length, name_len = _ENTRY.unpack_from(self.mm, pos)
+            pos += _ENTRY.size
+            name = self.mm[pos : pos + name_len].decode()
+            pos += name_len
+            self.index[name] = (offset, length)
+
+    def names(
+        self,
+    ):
+        return list(self.index)
+
+    def blob(
+        self,
+        name,
+    ):
+        """Сериализованный JSON записи или None, если записи нет"""
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        offset, length = entry
+        return self.mm[offset : offset + length]
+
+    def load(
+        self,
+        name,
+    ):
+        blob = self.blob(name)
+        return None if blob is None else json.loads(blob)
+
+    def key(
+        self,
+        path,
+    ):
+        """Имя записи для пути к файлу внутри resources"""
+        rel = os.path.relpath(path, load_file("resources"))
+        return rel.replace(os.sep, "/")
+
+
+@functools.lru_cache(maxsize=None)
+def get_pack():
+    """Пакет раскладок или None, если он не собран или устарел"""
+    path = load_file(PACK_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        pack = LayoutPack(path)
+    except (OSError, ValueError, struct.error) as err:
+        print(f"[!] Пакет раскладок не загружен: {err}")
+        return None
+    if "__compiled__" in globals():
+        return pack
+    try:
+        fingerprint = source_fingerprint(load_file("resources"))
+    except OSError:
+        # Исходных JSON нет, сверять не с чем
+        return pack
+    if fingerprint != pack.fingerprint:
+        print(
+            "[!] Пакет раскладок устарел, раскладки читаются из JSON "
+            "(пересобрать: python -m modules.layout_pack)"
+        )
+        return None
+    return pack
+
+
+if __name__ == "__main__":
+    out = sys.argv[1] if len(sys.argv) > 1 else load_file(PACK_FILE)
+    count = build(load_file("resources"), out)
+    print(f"{count} записей упаковано в {out}")
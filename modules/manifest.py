@@ -0,0 +1,185 @@
+"""Манифест прошивки из нескольких частей.
+
+Для ESP32 кроме firmware.bin в каталоге прошивки лежат bootloader.bin,
+partitions.bin и boot_app0.bin. Новый приемник без загрузчика прошивается только
+всеми частями сразу, а при повторной прошивке части, MD5 которых уже совпадает
+на устройстве, пропускаются (esptool --skip-unchanged).
+
+Новый приемник удобнее шить одним образом factory.bin: части склеиваются в
+памяти, промежутки заполняются 0xFF и при сжатии почти ничего не занимают,
+а esptool пишет все одной передачей вместо четырех.
+"""
+
+import hashlib
+import os
+import tempfile
+from typing import List, NamedTuple, Optional
+
+from external.esptool.esptool import cmds as esptool_cmds
+from external.esptool.esptool.util import pad_to
+
+FIRMWARE = "firmware.bin"
+# Все части одним образом (см. FirmwareManifest.merged)
+FACTORY = "factory.bin"
+
+# (часть, смещение, обязательна)
+ESP32_LAYOUT = (
+    ("bootloader.bin", 0x1000, False),
+    ("partitions.bin", 0x8000, False),
+    ("boot_app0.bin", 0xE000, False),
+    (FIRMWARE, 0x10000, True),
+)
+# ESP8266 и STM32: только приложение
+APP_LAYOUT = ((FIRMWARE, 0x0, True),)
+
+
+class FirmwarePart(NamedTuple):
+    name: str
+    offset: int
+    md5: str
+    size: int
+    compressed_size: int
+    data: bytes
+
+
+def esptool_image(
+    data,
+    md5,
+):
+    """Образ, как его видит write_flash (дополнен до 4 байт), и ключ кэша сжатия
+
+    :returns:
+        (образ, MD5 образа)
+    """
+    padded = pad_to(data, 4)
+    return padded, md5 if padded is data else hashlib.md5(padded).hexdigest()
+
+
+def make_part(
+    name,
+    offset,
+    data,
+):
+    data = bytes(data)
+    md5 = hashlib.md5(data).hexdigest()
+    # Сжатие попадает в кэш esptool (ключ - MD5 дополненного образа, как в
+    # write_flash), и при прошивке -z первый блок уходит сразу
+    compressed = esptool_cmds.get_compressed_image(*esptool_image(data, md5))
+    return FirmwarePart(
+        name,
+        offset,
+        md5,
+        len(data),
+        len(compressed.data),
+        data,
+    )
+
+
+class FirmwareManifest:
+    def __init__(
+        self,
+        parts,
+    ) -> None:
+        self.parts: List[FirmwarePart] = sorted(parts, key=lambda part: part.offset)
+        for prev, part in zip(self.parts, self.parts[1:]):
+            if prev.offset + prev.size > part.offset:
+                raise ValueError(
+                    f"Часть {prev.name} перекрывает {part.name} с 0x{part.offset:x}"
+                )
+
+    def part(
+        self,
+        name,
+    ) -> Optional[FirmwarePart]:
+        for part in self.parts:
+            if part.name == name:
+                return part
+        return None
+
+    def replace(
+        self,
+        name,
+        data,
+    ):
+        """Заменить данные части, например пропатченным firmware.bin"""
+        self.parts = [
+            make_part(part.name, part.offset, data) if part.name == name else part
+            for part in self.parts
+        ]
+
+    def merged(
+        self,
+        name=FACTORY,
+    ):
+        """Манифест из одной части: все части с первого смещения, между ними 0xFF"""
+        start = self.parts[0].offset
+        end = max(part.offset + part.size for part in self.parts)
+        image = bytearray(b"\xFF") * (end - start)
+        for part in self.parts:
+            pos = part.offset - start
+            image[pos : pos + part.size] = part.data
+        return FirmwareManifest([make_part(name, start, image)])
+
+    def write_files(
+        self,
+        directory=None,
+    ):
+        """Записать части во временные файлы для esptool; без directory -
+        в новый временный каталог, который удаляет вызывающий
+
+        :returns:
+            [(offset, path)]
+        """
+        directory = directory or tempfile.mkdtemp(prefix="elrs_manifest_")
+        files = []
+        for part in self.parts:
+            path = os.path.join(directory, part.name)
+            with open(path, "wb") as f:
+                f.write(part.data)
+            files.append((part.offset, path))
+        return files
+
+    def esptool_args(
+        self,
+        directory=None,
+    ):
+        args = []
+        for offset, path in self.write_files(directory):
+            args.extend([hex(offset), path])
+        return args
+
+    def __str__(
+        self,
+    ):
+        return "\n".join(
+            "  0x%06x %-16s %8d байт (%d сжато) md5 %s"
+            % (
+                part.offset,
+                part.name,
+                part.size,
+                part.compressed_size,
+                part.md5,
+            )
+            for part in self.parts
+        )
+
+
+def load(
+    fetch,
+    layout,
+):
+    """Собрать манифест из частей, полученных через fetch(имя части, обязательна).
+
+    fetch возвращает None для отсутствующей части, необязательные части
+    при этом пропускаются.
+    """
+    parts = []
+    for name, offset, required in layout:
+        data = fetch(name, required)
+        if data is not None:
+            parts.append(make_part(name, offset, data))
+        elif required:
+            raise Exception(f"Не найдена часть прошивки {name}")
+        else:
+            print(f"{name} отсутствует, пропускаем")
+    return FirmwareManifest(parts)
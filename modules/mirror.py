@@ -0,0 +1,339 @@
+"""Локальное зеркало прошивок ELRS для работы без сети.
+
+Файлы хранятся так же, как на сервере: {версия}/{FCC|LBT}/{firmware}/{часть} и
+bootloader/{загрузчик}. Для каждого файла в index.json записаны MD5 и размер
+(или null, если необязательной части нет на сервере), поэтому при чтении из
+зеркала целостность проверяется без обращения к сети.
+
+Заполнить зеркало всеми прошивками из targets.json:
+    python -m modules.mirror prefetch [--version 3.2.1] [--lbt]
+Раздать зеркало по HTTP (подменяет сервер при тестах, см. FIRMWARE_URL_ENV):
+    python -m modules.mirror serve [--port 8000]
+Работать без сети (промах зеркала сразу ошибка, см. OFFLINE_ENV):
+    ULTRA_FLASHER_OFFLINE=1
+"""
+
+import argparse
+import concurrent.futures
+import functools
+import hashlib
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+
+import requests
+
+from modules import UnifiedConfig
+from modules import manifest as firmware_manifest
+
+BASE_URL = "https://okcu.ru/elrs-web-flasher/firmware"
+# Адрес сервера прошивок, например http://127.0.0.1:8000 для локальной подмены
+FIRMWARE_URL_ENV = "ULTRA_FLASHER_FIRMWARE_URL"
+# Любое значение, кроме пустого и 0: только зеркало, без обращения к серверу
+OFFLINE_ENV = "ULTRA_FLASHER_OFFLINE"
+DEFAULT_VERSION = "3.2.1"
+FLAVOURS = ("FCC", "LBT")
+INDEX_FILE = "index.json"
+
+# Секунды на соединение и на чтение, чтобы прошивка не висела на сети
+DOWNLOAD_TIMEOUT = (5, 30)
+PREFETCH_WORKERS = 8
+
+
+class MirrorError(Exception):
+    pass
+
+
+def firmware_path(
+    version,
+    flavour,
+    firmware,
+    part,
+):
+    return f"{version}/{flavour}/{firmware}/{part}"
+
+
+def bootloader_path(
+    bootloader,
+):
+    return f"bootloader/{bootloader}"
+
+
+def iter_targets(
+    targets,
+):
+    """Конфигурации всех таргетов из targets.json"""
+    for vendor in targets.values():
+        for group in vendor.values():
+            if not isinstance(group, dict):
+                continue
+            for config in group.values():
+                if isinstance(config, dict) and "firmware" in config:
+                    yield config
+
+
+def required_files(
+    targets,
+    version,
+    flavour,
+):
+    """Все различные файлы, нужные таргетам
+
+    :returns:
+        {путь: обязателен}
+    """
+    files = {}
+    for config in iter_targets(targets):
+        layout = (
+            firmware_manifest.ESP32_LAYOUT
+            if config["platform"] == "esp32"
+            else firmware_manifest.APP_LAYOUT
+        )
+        for part, _, required in layout:
+            path = firmware_path(version, flavour, config["firmware"], part)
+            files[path] = files.get(path, False) or required
+        if "stlink" in config and config["stlink"].get("bootloader"):
+            files[bootloader_path(config["stlink"]["bootloader"])] = True
+    return files
+
+
+class Mirror:
+    def __init__(
+        self,
+        root=None,
+        base_url=None,
+        offline=False,
+    ) -> None:
+        if root is None:
+            root = os.path.expanduser("~") + "/ultra_flasher_mirror"
+        self.root = root
+        self.base_url = (
+            base_url or os.environ.get(FIRMWARE_URL_ENV) or BASE_URL
+        ).rstrip("/")
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(root, exist_ok=True)
+        try:
+            with open(os.path.join(root, INDEX_FILE)) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def _session(
+        self,
+    ):
+        # requests.Session не потокобезопасна: по одной на поток
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _save_index(
+        self,
+    ):
+        with self._lock:
+            data = json.dumps(self.index, indent=1, sort_keys=True)
+        self._write_atomic(INDEX_FILE, data.encode())
+
+    def _write_atomic(
+        self,
+        path,
+        data,
+    ):
+        full = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(full))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, full)
+
+    def _read_local(
+        self,
+        path,
+    ):
+        """Файл из зеркала; None, если его нет или он поврежден"""
+        entry = self.index.get(path)
+        if not entry:
+            return None
+        try:
+            with open(os.path.join(self.root, path), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) != entry["size"] or hashlib.md5(data).hexdigest() != entry["md5"]:
+            print(f"[!] {path} в зеркале поврежден")
+            return None
+        return data
+
+    def _download(
+        self,
+        path,
+    ):
+        """Скачать файл в зеркало; None, если его нет на сервере"""
+        response = self._session().get(
+            f"{self.base_url}/{path}",
+            timeout=DOWNLOAD_TIMEOUT,
+        )
+        if response.status_code == 404:
+            with self._lock:
+                self.index[path] = None
+            return None
+        if response.status_code != 200:
+            raise MirrorError(f"{path}: HTTP {response.status_code}")
+        data = response.content
+        expected = response.headers.get("Content-Length")
+        if expected is not None and "Content-Encoding" not in response.headers:
+            if int(expected) != len(data):
+                raise MirrorError(
+                    f"{path}: получено {len(data)} байт из {expected}"
+                )
+        self._write_atomic(path, data)
+        with self._lock:
+            self.index[path] = {
+                "md5": hashlib.md5(data).hexdigest(),
+                "size": len(data),
+            }
+        return data
+
+    def _needs(
+        self,
+        path,
+        required,
+    ):
+        if path not in self.index:
+            return True
+        if self.index[path] is None:
+            # Обязательный файл мог появиться на сервере
+            return required
+        return self._read_local(path) is None
+
+    def fetch(
+        self,
+        path,
+        required=False,
+    ):
+        """Файл из зеркала, при промахе - с сервера (если не offline).
+        Обязательный файл, записанный в индексе как отсутствующий, скачивается
+        заново, как в prefetch
+
+        :returns:
+            Данные или None, если файла нет на сервере
+        """
+        data = self._read_local(path)
+        if data is not None:
+            return data
+        if path in self.index and self.index[path] is None and not required:
+            return None
+        if self.offline:
+            raise MirrorError(
+                f"{path} не загружен в зеркало заранее, а сеть отключена "
+                f"({OFFLINE_ENV}); загрузите: python -m modules.mirror prefetch"
+            )
+        try:
+            data = self._download(path)
+        except requests.RequestException as err:
+            raise MirrorError(f"{path}: {err}") from err
+        self._save_index()
+        return data
+
+    def forget(
+        self,
+        paths,
+    ):
+        """Убрать файлы из индекса: при следующем обращении они скачаются заново"""
+        with self._lock:
+            for path in paths:
+                self.index.pop(path, None)
+        self._save_index()
+
+    def prefetch(
+        self,
+        files,
+        workers=PREFETCH_WORKERS,
+    ):
+        """Скачать параллельно все файлы {путь: обязателен}, которых нет в зеркале
+
+        :returns:
+            {путь: ошибка} для обязательных файлов, которые не удалось скачать
+        """
+        missing = [
+            path for path, required in files.items() if self._needs(path, required)
+        ]
+        errors = {}
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = {pool.submit(self._download, path): path for path in missing}
+            for done, future in enumerate(
+                concurrent.futures.as_completed(futures),
+                1,
+            ):
+                path = futures[future]
+                try:
+                    data = future.result()
+                except (requests.RequestException, MirrorError) as err:
+                    if files[path]:
+                        errors[path] = str(err)
+                    continue
+                if data is None and files[path]:
+                    errors[path] = "нет на сервере"
+                print(f"[{done}/{len(missing)}] {path}")
+        self._save_index()
+        return errors
+
+
+@functools.lru_cache(maxsize=None)
+def get_mirror():
+    return Mirror(offline=os.environ.get(OFFLINE_ENV, "") not in ("", "0"))
+
+
+def serve(
+    root,
+    port,
+):
+    """Раздать зеркало по HTTP вместо сервера прошивок"""
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler,
+        directory=root,
+    )
+    with http.server.ThreadingHTTPServer(("127.0.0.1", port), handler) as server:
+        print(f"Зеркало {root} доступно на http://127.0.0.1:{port}")
+        print(f"Для подмены сервера: {FIRMWARE_URL_ENV}=http://127.0.0.1:{port}")
+        server.serve_forever()
+
+
+def main(
+    argv=None,
+):
+    parser = argparse.ArgumentParser(description="Зеркало прошивок ELRS")
+    parser.add_argument("--root", default=None, help="Каталог зеркала")
+    commands = parser.add_subparsers(dest="command", required=True)
+    prefetch = commands.add_parser("prefetch")
+    prefetch.add_argument("--version", default=DEFAULT_VERSION)
+    prefetch.add_argument("--lbt", action="store_true", help="LBT вместо FCC")
+    prefetch.add_argument("--workers", type=int, default=PREFETCH_WORKERS)
+    serve_parser = commands.add_parser("serve")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    mirror = Mirror(args.root)
+    if args.command == "serve":
+        serve(mirror.root, args.port)
+        return 0
+
+    files = required_files(
+        UnifiedConfig.loadTargets(),
+        args.version,
+        FLAVOURS[1] if args.lbt else FLAVOURS[0],
+    )
+    print(f"Файлов в targets.json: {len(files)}, зеркало: {mirror.root}")
+    errors = mirror.prefetch(files, args.workers)
+    for path, error in sorted(errors.items()):
+        print(f"[!] {path}: {error}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+"""Подготовка прошивок ELRS в пуле процессов.
+
+Скачивание, проверка образа, сборка Unified конфигурации, сжатие и MD5 - работа
+для процессора, и в потоке прошивки она делит GIL с окном и с потоками других
+устройств. Preparer выполняет ее в ограниченном пуле процессов: процесс пишет
+каждую часть образа и ее сжатый поток в файлы, а поток прошивки отображает
+части в память (mmap) и кладет сжатые потоки в кэш esptool. Потоку прошивки
+остается только отправлять байты в порт.
+
+Файлы сборки удаляются, когда она вытесняется из кэша; mmap частей закрывает
+задача (ELRS.close).
+
+Одинаковые задания (таргет, фраза, factory, версия, регион) готовятся один
+раз; при смешанной партии таргеты собираются параллельно, по процессу на ядро.
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple, Optional, Tuple
+
+from external.esptool.esptool import cmds as esptool_cmds
+from modules import manifest as firmware_manifest
+from modules import mirror
+
+PREPARE_WORKERS = os.cpu_count() or 2
+# Заданий в пуле на процесс; остальные ждут в потоках задач, а не в памяти пула
+QUEUED_PER_WORKER = 2
+# Сколько подготовленных прошивок помнить для повторных заданий
+PREPARED_CACHE_SIZE = 32
+
+
+class PrepareError(Exception):
+    """Ошибка подготовки, log - вывод процесса подготовки до ошибки"""
+
+    def __init__(
+        self,
+        message,
+        log="",
+    ) -> None:
+        super().__init__(message, log)
+        self.message = message
+        self.log = log
+
+    def __str__(
+        self,
+    ):
+        return self.message
+
+
+class PreparedPart(NamedTuple):
+    name: str
+    offset: int
+    md5: str
+    size: int
+    path: str
+    # Сжатый поток и ключ кэша esptool (MD5 образа, дополненного до 4 байт)
+    compressed_path: str
+    compressed_key: str
+
+
+def _map(
+    path,
+):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _load_manifest(
+    parts,
+):
+    loaded = []
+    for part in parts:
+        # Сжатый поток живет в кэше esptool дольше задачи, поэтому читается
+        # целиком, а не отображается
+        with open(part.compressed_path, "rb") as f:
+            compressed = f.read()
+        esptool_cmds.put_compressed_image(part.compressed_key, compressed)
+        loaded.append(
+            firmware_manifest.FirmwarePart(
+                part.name,
+                part.offset,
+                part.md5,
+                part.size,
+                len(compressed),
+                _map(part.path),
+            )
+        )
+    return firmware_manifest.FirmwareManifest(loaded)
+
+
+class Prepared(NamedTuple):
+    target: str
+    parts: Tuple[PreparedPart, ...]
+    # Части factory образа, если он заказан (ELRS.upload_manifest)
+    merged: Tuple[PreparedPart, ...]
+    hardware_pos: int
+    firmware_path: str
+    log: str
+    # Каталог всех файлов сборки
+    directory: str
+
+    def load(
+        self,
+    ):
+        """Манифесты с данными в mmap, сжатые потоки - в кэше esptool
+
+        :returns:
+            (манифест, factory манифест или None)
+        """
+        merged = _load_manifest(self.merged) if self.merged else None
+        return _load_manifest(self.parts), merged
+
+
+def _save_parts(
+    manifest,
+    directory,
+):
+    parts = []
+    for part in manifest.parts:
+        path = os.path.join(directory, part.name)
+        with open(path, "wb") as f:
+            f.write(part.data)
+        padded, key = firmware_manifest.esptool_image(part.data, part.md5)
+        # make_part уже сжал часть, здесь поток берется из кэша
+        compressed = esptool_cmds.get_compressed_image(padded, key)
+        with open(path + ".z", "wb") as f:
+            f.write(compressed.data)
+        parts.append(
+            PreparedPart(
+                part.name,
+                part.offset,
+                part.md5,
+                part.size,
+                path,
+                path + ".z",
+                key,
+            )
+        )
+    return tuple(parts)
+
+
+def prepare(
+    target,
+    phrase,
+    factory=False,
+    version=mirror.DEFAULT_VERSION,
+    flavour=mirror.FLAVOURS[0],
+) -> Prepared:
+    """Собрать прошивку; выполняется в процессе пула
+
+    :raises PrepareError:
+        Не удалось скачать, проверить или собрать образ
+    """
+    from modules.ELRS import ELRS
+
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            elrs = ELRS(
+                target=target,
+                phrase=phrase,
+                port=None,
+                force=True,
+                erase=False,
+                factory=factory,
+                version=version,
+                flavour=flavour,
+            )
+            # Файл firmware.bin самого ELRS не нужен, части пишутся в directory
+            elrs.close()
+            directory = tempfile.mkdtemp(prefix="elrs_prepared_")
+            try:
+                parts = _save_parts(elrs.manifest, directory)
+                merged = ()
+                if factory:
+                    merged_dir = os.path.join(directory, "factory")
+                    os.mkdir(merged_dir)
+                    merged = _save_parts(elrs.upload_manifest(), merged_dir)
+            except Exception:
+                shutil.rmtree(directory, ignore_errors=True)
+                raise
+    except Exception as err:
+        raise PrepareError(str(err), log.getvalue()) from None
+    return Prepared(
+        target,
+        parts,
+        merged,
+        elrs.pos,
+        os.path.join(directory, firmware_manifest.FIRMWARE),
+        log.getvalue(),
+        directory,
+    )
+
+
+class Preparer:
+    def __init__(
+        self,
+        workers=PREPARE_WORKERS,
+    ) -> None:
+        self.workers = workers
+        self._pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._slots = threading.BoundedSemaphore(workers * QUEUED_PER_WORKER)
+        self._lock = threading.Lock()
+        self._futures = collections.OrderedDict()
+        # Каталоги вытесненных сборок, которые еще отображены задачами
+        # (Windows не удаляет такие файлы); удаляются при следующем вытеснении
+        self._stale = []
+
+    def _get_pool(
+        self,
+    ):
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+            return self._pool
+
+    def _done(
+        self,
+        future,
+        work,
+    ):
+        self._slots.release()
+        error = work.exception()
+        if isinstance(error, BrokenProcessPool):
+            # Процесс пула упал: следующее задание создаст новый пул
+            with self._lock:
+                self._pool = None
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(work.result())
+
+    def submit(
+        self,
+        target,
+        phrase,
+        factory=False,
+        version=mirror.DEFAULT_VERSION,
+        flavour=mirror.FLAVOURS[0],
+    ) -> concurrent.futures.Future:
+        """Поставить сборку в пул; блокирует, пока пул заполнен"""
+        key = (target, phrase, bool(factory), version, flavour)
+        with self._lock:
+            future = self._futures.get(key)
+            failed = (
+                future is not None and future.done() and future.exception() is not None
+            )
+            if future is not None and not failed:
+                self._futures.move_to_end(key)
+                return future
+            future = self._futures[key] = concurrent.futures.Future()
+            evicted = []
+            while len(self._futures) > PREPARED_CACHE_SIZE:
+                evicted.append(self._futures.popitem(last=False)[1])
+        for old in evicted:
+            old.add_done_callback(self._remove)
+
+        self._slots.acquire()
+        try:
+            work = self._get_pool().submit(prepare, *key)
+        except Exception as err:
+            self._slots.release()
+            future.set_exception(err)
+            raise
+        work.add_done_callback(functools.partial(self._done, future))
+        return future
+
+    def _remove(
+        self,
+        future,
+    ):
+        """Удалить файлы вытесненной сборки и оставшиеся от прошлых вытеснений"""
+        with self._lock:
+            directories, self._stale = self._stale, []
+        if not future.cancelled() and future.exception() is None:
+            directories.append(future.result().directory)
+        stale = []
+        for directory in directories:
+            shutil.rmtree(directory, ignore_errors=True)
+            if os.path.exists(directory):
+                stale.append(directory)
+        with self._lock:
+            self._stale.extend(stale)
+
+    def get(
+        self,
+        target,
+        phrase,
+        factory=False,
+        version=mirror.DEFAULT_VERSION,
+        flavour=mirror.FLAVOURS[0],
+    ) -> Prepared:
+        """Собранная прошивка; вывод процесса подготовки печатается здесь,
+        чтобы попасть в журнал задачи
+
+        :raises PrepareError:
+        """
+        try:
+            prepared = self.submit(target, phrase, factory, version, flavour).result()
+        except PrepareError as err:
+            print(err.log, end="")
+            raise
+        print(prepared.log, end="")
+        return prepared
+
+    def shutdown(
+        self,
+    ):
+        with self._lock:
+            pool, self._pool = self._pool, None
+            futures = list(self._futures.values())
+            self._futures.clear()
+        if pool is not None:
+            pool.shutdown()
+        for future in futures:
+            future.add_done_callback(self._remove)
+
+
+@functools.lru_cache(maxsize=None)
+def get_preparer():
+    return Preparer()
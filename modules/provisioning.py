@@ -0,0 +1,341 @@
+"""Массовая прошивка приемников, у каждого из которых своя фраза или UID.
+
+Образ скачивается и собирается один раз, а UID каждого приемника вписывается
+в копию собранного образа: в блок defines (JSON) для ESP или в поле UID для
+STM32. Подготовка одного устройства - копия образа и запись нескольких байт,
+без повторной сборки конфигурации.
+
+CSV с заголовком: serial,port,phrase или serial,port,uid, где uid - шесть
+байт через запятую (как в binding-фразе) или 12 hex цифр.
+
+    python -m modules.provisioning flash units.csv --target <таргет>
+    python -m modules.provisioning stamp units.csv --target <таргет> --out DIR
+
+С --factory ESP32 приемники шьются (и сохраняются) одним образом со всеми
+частями, как новые устройства без загрузчика.
+"""
+
+import argparse
+import copy
+import csv
+import json
+import os
+import sys
+import time
+from random import randint
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from modules import UnifiedConfig, binary_configurator, jobs
+from modules import manifest as firmware_manifest
+from modules import mirror
+from modules.classes import MCUType
+
+# Смещение блока defines от конца прошивки (см. UnifiedConfig.buildConfiguration)
+DEFINES_OFFSET = UnifiedConfig.PRODUCT_NAME_SIZE + UnifiedConfig.DEVICE_NAME_SIZE
+UID_SIZE = 6
+
+
+class Unit(NamedTuple):
+    serial: str
+    port: Optional[str]
+    uid: bytes
+
+
+def parse_uid(
+    value,
+):
+    """UID из шести байт через запятую или 12 hex цифр"""
+    value = value.strip()
+    try:
+        if "," in value:
+            uid = bytes(int(item) for item in value.split(","))
+        else:
+            uid = bytes.fromhex(value.replace(":", ""))
+    except ValueError:
+        raise ValueError(f"Неверный UID {value}")
+    if len(uid) != UID_SIZE:
+        raise ValueError(f"UID {value} должен быть из {UID_SIZE} байт")
+    return uid
+
+
+def bulk_uids(
+    phrases: Iterable[str],
+) -> Dict[str, bytes]:
+    """UID для всех различных фраз"""
+    return {
+        phrase: binary_configurator.generateUID(phrase) for phrase in set(phrases)
+    }
+
+
+def load_units(
+    rows: Iterable[dict],
+) -> List[Unit]:
+    """Приемники из строк CSV (csv.DictReader)
+
+    :raises ValueError:
+        Строка без фразы и UID, неверный UID или порт указан дважды
+    """
+    rows = list(rows)
+    uids = bulk_uids(row["phrase"] for row in rows if row.get("phrase"))
+    units = []
+    ports = {}
+    for line, row in enumerate(rows, 2):
+        serial = (row.get("serial") or "").strip() or f"line{line}"
+        port = (row.get("port") or "").strip() or None
+        try:
+            if row.get("uid"):
+                uid = parse_uid(row["uid"])
+            elif row.get("phrase"):
+                uid = uids[row["phrase"]]
+            else:
+                raise ValueError("нет ни phrase, ни uid")
+        except ValueError as err:
+            raise ValueError(f"Строка {line}: {err}") from err
+        if port is not None:
+            if port in ports:
+                raise ValueError(
+                    f"Строка {line}: порт {port} уже занят {ports[port]}"
+                )
+            ports[port] = serial
+        units.append(Unit(serial, port, uid))
+    return units
+
+
+def read_units(
+    path,
+):
+    with open(path, newline="", encoding="utf-8") as f:
+        return load_units(csv.DictReader(f))
+
+
+class ImageTemplate:
+    """Собранный образ, в копии которого вписывается UID"""
+
+    def __init__(
+        self,
+        image,
+        mcu_type,
+        hardware_pos,
+    ) -> None:
+        self.image = bytes(image)
+        self.mcu_type = mcu_type
+        if mcu_type is MCUType.STM32:
+            # Байт домена, флаг UID, UID (см. binary_configurator.patch_legacy)
+            if hardware_pos < 0:
+                raise ValueError("В образе нет блока конфигурации")
+            self.uid_pos = hardware_pos + 1
+            self.defines_pos = None
+            self.flags = None
+        else:
+            self.uid_pos = None
+            self.defines_pos = UnifiedConfig.parseFirmwareEnd(image) + DEFINES_OFFSET
+            raw = self.image[
+                self.defines_pos : self.defines_pos + UnifiedConfig.DEFINES_SIZE
+            ]
+            self.flags = json.loads(raw.split(b"\0", 1)[0])
+
+    def stamp(
+        self,
+        uid,
+    ):
+        """Копия образа с UID приемника"""
+        image = bytearray(self.image)
+        if self.defines_pos is None:
+            image[self.uid_pos] = 1
+            image[self.uid_pos + 1 : self.uid_pos + 1 + UID_SIZE] = uid
+            return image
+
+        flags = dict(self.flags)
+        flags["uid"] = list(uid)
+        # Как при обычной сборке: у каждой прошивки свой дискриминатор
+        flags["flash-discriminator"] = randint(
+            1,
+            2**32 - 1,
+        )
+        defines = json.JSONEncoder().encode(flags).encode()
+        if len(defines) > UnifiedConfig.DEFINES_SIZE:
+            raise ValueError("Параметры не помещаются в блок defines")
+        image[self.defines_pos : self.defines_pos + UnifiedConfig.DEFINES_SIZE] = (
+            defines.ljust(UnifiedConfig.DEFINES_SIZE, b"\0")
+        )
+        return image
+
+
+class Batch:
+    """Партия приемников одного таргета"""
+
+    def __init__(
+        self,
+        target,
+        units,
+        journal=None,
+        factory=False,
+        version=mirror.DEFAULT_VERSION,
+        flavour=mirror.FLAVOURS[0],
+    ) -> None:
+        from modules.ELRS import ELRS
+
+        self.units = units
+        # Образ собирается один раз с пустой фразой, UID вписывается позже
+        self.elrs = ELRS(
+            target=target,
+            phrase="",
+            port=None,
+            force=True,
+            erase=False,
+            journal=journal,
+            factory=factory,
+            version=version,
+            flavour=flavour,
+        )
+        self.template = ImageTemplate(
+            self.elrs.image,
+            self.elrs.options.mcuType,
+            self.elrs.pos,
+        )
+
+    def unit_image(
+        self,
+        unit,
+    ):
+        """firmware.bin приемника, для factory - все части одним образом"""
+        image = self.template.stamp(unit.uid)
+        if not self.elrs.factory:
+            return image
+        manifest = copy.copy(self.elrs.manifest)
+        manifest.replace(firmware_manifest.FIRMWARE, image)
+        return manifest.merged().parts[0].data
+
+    def write_images(
+        self,
+        directory,
+    ):
+        """Сохранить образ каждого приемника как {serial}.bin"""
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for unit in self.units:
+            path = os.path.join(directory, f"{unit.serial}.bin")
+            with open(path, "wb") as f:
+                f.write(self.unit_image(unit))
+            paths.append(path)
+        return paths
+
+    def submit(
+        self,
+        engine,
+    ):
+        """Поставить прошивку всех приемников с портом в очередь задач
+
+        :returns:
+            [id задачи]
+        """
+        job_ids = []
+        for unit in self.units:
+            if unit.port is None:
+                print(f"[!] {unit.serial}: порт не указан, пропускаем")
+                continue
+            job_ids.append(
+                engine.submit(
+                    "provision",
+                    unit.port,
+                    {"batch": self, "unit": unit},
+                )
+            )
+        return job_ids
+
+
+async def run_unit(
+    engine,
+    job,
+):
+    """Задача очереди: прошить один приемник партии"""
+    from modules import sessions
+
+    batch = job.params["batch"]
+    unit = job.params["unit"]
+    print(f"Приемник {unit.serial}, UID {','.join(str(x) for x in unit.uid)}")
+    elrs = await sessions.blocking(
+        batch.elrs.with_image,
+        job.port,
+        batch.template.stamp(unit.uid),
+    )
+    elrs.progress = jobs.job_progress(engine, job)
+    try:
+        await jobs.flash_elrs(elrs)
+    finally:
+        elrs.close()
+
+
+def main(
+    argv=None,
+):
+    parser = argparse.ArgumentParser(description="Массовая прошивка приемников")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("flash", "stamp"):
+        command = commands.add_parser(name)
+        command.add_argument("units", help="CSV: serial,port,phrase|uid")
+        command.add_argument("--target", required=True)
+        command.add_argument(
+            "--factory",
+            action="store_true",
+            help="ESP32: все части одним образом",
+        )
+        command.add_argument("--version", default=mirror.DEFAULT_VERSION)
+        command.add_argument("--lbt", action="store_true", help="LBT вместо FCC")
+    commands.choices["stamp"].add_argument("--out", required=True)
+    args = parser.parse_args(argv)
+
+    flavour = mirror.FLAVOURS[1] if args.lbt else mirror.FLAVOURS[0]
+    started = time.perf_counter()
+    units = read_units(args.units)
+    print(
+        f"Приемников: {len(units)}, UID за "
+        f"{(time.perf_counter() - started) * 1000:.1f} мс"
+    )
+    if args.command == "stamp":
+        batch = Batch(
+            args.target,
+            units,
+            factory=args.factory,
+            version=args.version,
+            flavour=flavour,
+        )
+        started = time.perf_counter()
+        paths = batch.write_images(args.out)
+        batch.elrs.close()
+        print(
+            f"Образов: {len(paths)} в {args.out}, "
+            f"{(time.perf_counter() - started) / max(len(paths), 1) * 1000:.2f} "
+            "мс на приемник"
+        )
+        return 0
+
+    from modules.journal import Journal
+
+    journal = Journal()
+    engine = jobs.JobEngine(journal)
+    engine.install_output()
+    batch = Batch(
+        args.target,
+        units,
+        journal,
+        args.factory,
+        args.version,
+        flavour,
+    )
+    job_ids = batch.submit(engine)
+    engine.shutdown(wait=True)
+    batch.elrs.close()
+    failed = [
+        status["port"]
+        for status in map(engine.get, job_ids)
+        if status["state"] == jobs.STATE_FAILED
+    ]
+    print(f"Прошито: {len(job_ids) - len(failed)} из {len(job_ids)}")
+    for port in failed:
+        print(f"[!] {port}: ошибка")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,9 +5,14 @@ import sys
 import serial
 
 
-def serial_ports():
+def serial_ports(
+    exclude=(),
+):
     """Список доступных последовательных портов
 
+    :param exclude:
+        Порты, которые нельзя открывать для проверки (например, идет прошивка:
+        закрытие порта сбрасывает DTR). Они в список не попадают.
     :raises Exception:
         На неподдерживаемых или неизвестных платформах
     :returns:
@@ -52,6 +57,8 @@ def serial_ports():
             raise Exception("Неподдерживаемая платформа")
 
     for port in ports:
+        if port in exclude:
+            continue
         try:
             s = serial.Serial(port)
             s.close()
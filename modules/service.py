@@ -0,0 +1,404 @@
+"""Локальный HTTP сервис прошивки на вендоренном bottle.
+
+Несколько рабочих мест отправляют задачи на одну машину с хабом устройств.
+Сервис работает на той же очереди задач (modules.jobs), что и окно, каждый
+запрос обслуживается в своем потоке и читает только снимки состояния, поэтому
+опрос статуса не задерживает потоки прошивки.
+
+    GET  /api/devices                 последовательные порты и DFU устройства
+    GET  /api/jobs                    активные и недавно завершенные задачи
+    POST /api/jobs                    {"kind": "elrs", "port", "target", "phrase",
+                                       "factory": true - одним образом для ESP32,
+                                       "version": "3.2.1", "flavour": "FCC" или "LBT",
+                                       "upload_method": "betaflight" или "stlink"}
+                                      {"kind": "fc", "port", "firmware", "config",
+                                       "upload_method": "dfu" или "stlink",
+                                       "force_config": true - не пропускать конфиг,
+                                       "cpus": ["STM32F405"] - МК для ST-Link}
+    GET  /api/jobs/<id>               состояние задачи
+    DELETE /api/jobs/<id>             отменить задачу
+    GET  /api/jobs/<id>/log?since=N   строки журнала начиная с N
+    GET  /api/jobs/<id>/events        поток журнала и прогресса (text/event-stream)
+
+WebSocket требует gevent-websocket, которого нет в зависимостях, поэтому
+поток событий отдается как Server-Sent Events поверх обычного HTTP.
+
+Запуск без окна:  python -m modules.service serve [--port 8765]
+Нагрузочный тест: python -m modules.service loadtest [--clients 50 --polls 200]
+"""
+
+import argparse
+import json
+import socketserver
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from external import bottle
+from modules import jobs, serial_finder
+
+DEFAULT_PORT = 8765
+# Порт сервиса, который окно поднимает вместе с собой, если переменная задана
+SERVICE_PORT_ENV = "ULTRA_FLASHER_SERVICE_PORT"
+
+# Поиск устройств открывает порты и USB, поэтому результат кэшируется
+DEVICES_TTL = 2
+# Пустое событие, чтобы прокси и клиенты не закрывали простаивающий поток
+KEEPALIVE = 15
+
+REQUIRED_PARAMS = {
+    "elrs": ("target", "phrase"),
+}
+FC_METHODS = ("dfu", "stlink")
+ELRS_METHODS = ("betaflight", "stlink")
+# mirror.FLAVOURS без импорта сборки прошивок в сервис
+FLAVOURS = ("FCC", "LBT")
+# Задачи партии ссылаются на собранный в памяти образ и ставятся только локально
+LOCAL_KINDS = ("provision",)
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # По умолчанию 5: при десятках клиентов соединения ждут повтора SYN
+    request_queue_size = 128
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(
+        self,
+        format,
+        *args,
+    ):
+        pass
+
+
+class _DeviceCache:
+    def __init__(
+        self,
+        engine,
+    ) -> None:
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._devices = None
+        self._updated = 0.0
+
+    def _busy_ports(
+        self,
+    ):
+        return {
+            job["port"]: job["id"]
+            for job in self.engine.list()
+            if job["state"] in (jobs.STATE_QUEUED, jobs.STATE_RUNNING)
+        }
+
+    def _probe(
+        self,
+        busy,
+    ):
+        serial = [
+            {"port": port, "busy": None}
+            for port in serial_finder.serial_ports(exclude=busy)
+        ]
+        serial.extend({"port": port, "busy": job_id} for port, job_id in busy.items())
+
+        dfu = []
+        try:
+            from fc_flasher.address import get_address
+            from fc_flasher.main import _get_dfu_devices
+
+            dfu = [str(get_address(dev)) for dev in _get_dfu_devices()]
+        except Exception as ex:
+            print(f"[!] DFU устройства недоступны: {ex}")
+        return {"serial": serial, "dfu": dfu}
+
+    def get(
+        self,
+    ):
+        # Одновременные запросы ждут один общий опрос, а не открывают порты
+        # каждый сам
+        with self._lock:
+            if self._devices is None or time.time() - self._updated > DEVICES_TTL:
+                self._devices = self._probe(self._busy_ports())
+                self._updated = time.time()
+            return self._devices
+
+
+def _error(
+    status,
+    message,
+):
+    return bottle.HTTPResponse(
+        json.dumps({"error": message}),
+        status,
+        {"Content-Type": "application/json"},
+    )
+
+
+def make_app(
+    engine,
+):
+    app = bottle.Bottle()
+    devices = _DeviceCache(engine)
+
+    def job_or_404(
+        job_id,
+    ):
+        status = engine.get(job_id)
+        if status is None:
+            raise _error(404, f"Задача {job_id} не найдена")
+        return status
+
+    @app.get("/api/devices")
+    def list_devices():
+        return devices.get()
+
+    @app.get("/api/jobs")
+    def list_jobs():
+        return {"jobs": engine.list()}
+
+    @app.post("/api/jobs")
+    def submit_job():
+        params = bottle.request.json
+        if not isinstance(params, dict):
+            raise _error(400, "Ожидается JSON объект")
+        kind = params.get("kind")
+        port = params.get("port")
+        if kind not in engine.kinds or kind in LOCAL_KINDS or not port:
+            raise _error(400, "Нужны kind (elrs или fc) и port")
+        missing = [
+            name for name in REQUIRED_PARAMS.get(kind, ()) if not params.get(name)
+        ]
+        if kind == "fc" and not (params.get("firmware") or params.get("config")):
+            missing.append("firmware или config")
+        if kind == "elrs" and params.get("flavour", "FCC") not in FLAVOURS:
+            raise _error(400, "flavour: " + " или ".join(FLAVOURS))
+        if kind == "elrs" and (
+            params.get("upload_method", "betaflight") not in ELRS_METHODS
+        ):
+            raise _error(400, "upload_method: " + " или ".join(ELRS_METHODS))
+        if kind == "fc" and params.get("upload_method", "dfu") not in FC_METHODS:
+            raise _error(400, "upload_method: " + " или ".join(FC_METHODS))
+        if missing:
+            raise _error(400, "Не заданы: " + ", ".join(missing))
+        try:
+            job_id = engine.submit(kind, port, params)
+        except jobs.JobError as ex:
+            raise _error(409, str(ex))
+        bottle.response.status = 202
+        return {"id": job_id}
+
+    @app.get("/api/jobs/<job_id:int>")
+    def job_status(job_id):
+        return job_or_404(job_id)
+
+    @app.delete("/api/jobs/<job_id:int>")
+    def cancel_job(job_id):
+        job_or_404(job_id)
+        try:
+            engine.cancel(job_id)
+        except jobs.JobError as ex:
+            raise _error(409, str(ex))
+        bottle.response.status = 202
+        return {"id": job_id}
+
+    @app.get("/api/jobs/<job_id:int>/log")
+    def job_log(job_id):
+        job_or_404(job_id)
+        try:
+            since = int(bottle.request.query.get("since", 0))
+        except ValueError:
+            since = -1
+        if since < 0:
+            raise _error(400, "since должен быть неотрицательным целым")
+        lines = engine.log(job_id, since)
+        return {"since": since, "next": since + len(lines), "lines": lines}
+
+    @app.get("/api/jobs/<job_id:int>/events")
+    def job_events(job_id):
+        job_or_404(job_id)
+        bottle.response.content_type = "text/event-stream"
+        bottle.response.set_header("Cache-Control", "no-cache")
+
+        def stream():
+            since = 0
+            state = None
+            progress = None
+            while True:
+                status = engine.get(job_id)
+                if status is None:
+                    return
+                lines = engine.log(job_id, since)
+                since += len(lines)
+                for line in lines:
+                    yield "event: log\ndata: %s\n\n" % json.dumps(line.rstrip("\n"))
+                if status["state"] != state or status["progress"] != progress:
+                    state = status["state"]
+                    progress = status["progress"]
+                    yield "event: status\ndata: %s\n\n" % json.dumps(status)
+                if state in jobs.FINISHED_STATES and not lines:
+                    return
+                if not engine.wait(job_id, since, state, KEEPALIVE):
+                    yield ": keepalive\n\n"
+
+        return stream()
+
+    return app
+
+
+def start(
+    engine,
+    host="127.0.0.1",
+    port=DEFAULT_PORT,
+):
+    """Запустить сервис в фоновом потоке
+
+    :returns:
+        WSGI сервер (server_port - фактический порт, shutdown() - остановка)
+    """
+    server = make_server(
+        host,
+        port,
+        make_app(engine),
+        _ThreadingWSGIServer,
+        _QuietHandler,
+    )
+    threading.Thread(
+        target=server.serve_forever,
+        name="service",
+        daemon=True,
+    ).start()
+    print(f"Сервис прошивки: http://{host}:{server.server_port}/api/jobs")
+    return server
+
+
+def _selftest_job(
+    engine,
+    job,
+):
+    """Задача нагрузочного теста: пишет журнал и прогресс, как прошивка"""
+    total = job.params.get("steps", 50)
+    for step in range(total):
+        print(f"Шаг {step + 1}/{total}")
+        engine.set_progress(job, {"done": step + 1, "total": total})
+        time.sleep(0.02)
+
+
+def _request(
+    url,
+    data=None,
+):
+    body = None if data is None else json.dumps(data).encode()
+    request = urllib.request.Request(
+        url,
+        body,
+        {"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def loadtest(
+    clients=50,
+    polls=200,
+    job_count=4,
+):
+    """Много одновременных опросов статуса, пока задачи пишут журнал
+
+    :returns:
+        Число ошибок
+    """
+    engine = jobs.JobEngine(kinds={"selftest": _selftest_job})
+    engine.install_output()
+    server = start(engine, port=0)
+    base = f"http://127.0.0.1:{server.server_port}/api"
+
+    job_ids = [
+        _request(f"{base}/jobs", {"kind": "selftest", "port": f"test{n}"})["id"]
+        for n in range(job_count)
+    ]
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(
+        n,
+    ):
+        for i in range(polls):
+            job_id = job_ids[(n + i) % len(job_ids)]
+            start_time = time.perf_counter()
+            try:
+                _request(f"{base}/jobs/{job_id}")
+            except (OSError, urllib.error.URLError, ValueError) as ex:
+                with lock:
+                    errors.append(str(ex))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start_time)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    finished = [engine.get(job_id)["state"] for job_id in job_ids]
+    server.shutdown()
+    engine.shutdown()
+
+    latencies.sort()
+    if latencies:
+        print(
+            "Запросов: %d за %.1f с (%.0f/с), задержка p50 %.1f мс, "
+            "p95 %.1f мс, max %.1f мс"
+            % (
+                len(latencies),
+                elapsed,
+                len(latencies) / elapsed,
+                statistics.median(latencies) * 1000,
+                latencies[int(len(latencies) * 0.95)] * 1000,
+                latencies[-1] * 1000,
+            )
+        )
+    print(f"Ошибок: {len(errors)}, задачи: {', '.join(finished)}")
+    for error in errors[:5]:
+        print(f"  {error}")
+    return len(errors)
+
+
+def main(
+    argv=None,
+):
+    parser = argparse.ArgumentParser(description="HTTP сервис прошивки")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    test = commands.add_parser("loadtest")
+    test.add_argument("--clients", type=int, default=50)
+    test.add_argument("--polls", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    if args.command == "loadtest":
+        return 1 if loadtest(args.clients, args.polls) else 0
+
+    from modules.journal import Journal
+
+    engine = jobs.JobEngine(Journal())
+    engine.install_output()
+    server = start(engine, args.host, args.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1021 @@
+"""Сессии с устройствами на asyncio.
+
+Passthrough, перевод приемника в загрузчик, перевод FC в DFU, заливка конфига
+через CLI и команды MSP - корутины поверх неблокирующего последовательного
+порта. Один событийный цикл (SessionEngine) ведет десятки портов: ожидание
+ответа устройства не занимает поток, а задачу можно отменить на любом шаге.
+Каждый шаг ограничен своим таймаутом (step), поэтому зависший приемник дает
+ошибку шага, а не бесконечное ожидание.
+
+Запись образа (esptool, DFU, ST-Link) остается блокирующей и идет в потоке
+(blocking). Отмена дожидается конца такой операции, чтобы порт не освободился
+посреди записи.
+
+Повторная прошивка не проходит CLI заново: если загрузчик приемника уже
+отвечает на SLIP sync, passthrough пропускается целиком, а проверенный номер
+UART приемника хранится в базе FC по UID (modules.fc_identity). Конфиг,
+который уже залит на FC, не заливается повторно.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import operator
+import struct
+import threading
+from typing import Dict, Optional, Set
+
+import serial
+
+from external.esptool.esptool.loader import ESPLoader
+from modules import BFinitPassthrough, fc_identity, serial_finder
+from modules import journal as job_journal
+from modules.classes import ElrsUploadResult, MCUType
+from modules.FC import (
+    CLI_COMMAND_DELAY,
+    CONFIG_SETTLE,
+    DFU_ATTEMPTS,
+    DFU_POLL,
+    read_config_commands,
+)
+
+# Опрос порта там, где цикл не умеет ждать дескриптор (Windows)
+POLL_INTERVAL = 0.01
+# Потоков для блокирующих операций (запись образа, поиск USB устройств)
+SESSION_THREADS = 32
+
+# Таймауты шагов, с
+PASSTHROUGH_TIMEOUT = 15
+RESET_TIMEOUT = 5
+DFU_COMMAND_TIMEOUT = 5
+CLI_TIMEOUT = 3
+COMMAND_TIMEOUT = 2
+MSP_TIMEOUT = 1
+# FC в passthrough не отвечает на MSP, долго ждать нечего
+UID_TIMEOUT = 0.5
+SYNC_TIMEOUT = 0.3
+SYNC_RETRY = 0.1
+
+ELRS_COUNTDOWN = 10
+CONFIG_OPEN_ATTEMPTS = 10
+CONFIG_OPEN_DELAY = 2
+
+MSP_API_VERSION = 1
+MSP_FC_VARIANT = 2
+MSP_FC_VERSION = 3
+MSP_BOARD_INFO = 4
+MSP_UID = 160
+# Betaflight отвечает на неверную команду CLI строкой "###ERROR...###"
+CLI_ERROR = "###ERROR"
+
+# Команда sync загрузчика ESP в кадре SLIP (как ESPLoader.sync); в данных
+# нет байтов 0xC0 и 0xDB, экранировать нечего
+_SYNC_DATA = b"\x07\x07\x12\x20" + 32 * b"\x55"
+SLIP_SYNC = (
+    b"\xc0"
+    + struct.pack("<BBHI", 0x00, ESPLoader.ESP_SYNC, len(_SYNC_DATA), 0)
+    + _SYNC_DATA
+    + b"\xc0"
+)
+# Начало ответа на sync: направление 0x01 и код команды
+SLIP_SYNC_REPLY = bytes([0xC0, 0x01, ESPLoader.ESP_SYNC])
+
+
+class StepTimeout(Exception):
+    pass
+
+
+class MspError(Exception):
+    pass
+
+
+async def step(
+    name,
+    awaitable,
+    timeout,
+):
+    """Выполнить шаг сессии не дольше timeout секунд
+
+    :raises StepTimeout:
+        Устройство не ответило за timeout
+    """
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise StepTimeout(f"{name}: нет ответа за {timeout} с") from None
+
+
+async def blocking(
+    func,
+    *args,
+):
+    """Вызвать блокирующую func в потоке сессий (журнал задачи сохраняется).
+
+    При отмене дожидается завершения func и только потом передает отмену."""
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(
+        None,
+        functools.partial(contextvars.copy_context().run, func, *args),
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        print("Отмена: ждем завершения текущей операции")
+        await asyncio.wait([future])
+        raise
+
+
+@contextlib.asynccontextmanager
+async def hold(
+    lock,
+):
+    """Захватить threading.Lock, не блокируя цикл; отмена ожидания безопасна"""
+    while not lock.acquire(blocking=False):
+        await asyncio.sleep(POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+async def countdown(
+    seconds,
+):
+    for i in reversed(range(seconds)):
+        print(f"{i}...")
+        await asyncio.sleep(1)
+
+
+async def wait_for_port(
+    com,
+    timeout,
+):
+    print(f"Ожидаем переподключения {com}")
+    for _ in range(timeout):
+        if com in await blocking(serial_finder.serial_ports):
+            return True
+        await asyncio.sleep(1)
+    print(f"[!] {com} не найден")
+    return False
+
+
+class AsyncSerial:
+    """Последовательный порт с неблокирующим чтением.
+
+    Прочитанное копится в buf, как в SerialHelper."""
+
+    def __init__(
+        self,
+        port,
+        baudrate=115200,
+    ) -> None:
+        self.serial = serial.Serial(
+            port=port,
+            baudrate=baudrate,
+            bytesize=8,
+            parity="N",
+            stopbits=1,
+            timeout=0,
+            xonxoff=0,
+            rtscts=0,
+        )
+        self.buf = bytearray()
+        # На Windows у порта нет дескриптора, там данные ждутся опросом
+        fileno = getattr(self.serial, "fileno", None)
+        self._fd = fileno() if fileno is not None else None
+
+    async def __aenter__(
+        self,
+    ):
+        return self
+
+    async def __aexit__(
+        self,
+        *exc,
+    ):
+        self.close()
+
+    def close(
+        self,
+    ):
+        self.serial.close()
+
+    def clear(
+        self,
+    ):
+        self.serial.reset_input_buffer()
+        self.buf = bytearray()
+
+    async def _readable(
+        self,
+    ):
+        if self._fd is not None:
+            loop = asyncio.get_running_loop()
+            ready = loop.create_future()
+            try:
+                loop.add_reader(
+                    self._fd,
+                    lambda: ready.done() or ready.set_result(None),
+                )
+            except NotImplementedError:
+                # ProactorEventLoop не следит за дескрипторами
+                self._fd = None
+            else:
+                try:
+                    await ready
+                finally:
+                    loop.remove_reader(self._fd)
+                return
+        await asyncio.sleep(POLL_INTERVAL)
+
+    async def read(
+        self,
+    ):
+        """Дождаться данных и вернуть все, что пришло"""
+        while True:
+            data = self.serial.read(max(1, self.serial.in_waiting))
+            if data:
+                return data
+            await self._readable()
+
+    def read_nowait(
+        self,
+    ):
+        """Все, что уже пришло, без ожидания"""
+        data = bytes(self.buf) + self.serial.read(self.serial.in_waiting)
+        self.buf = bytearray()
+        return data
+
+    async def read_line(
+        self,
+        delimiters,
+        timeout,
+    ):
+        """Текст до разделителя включительно; пустая строка, если разделителя
+        не было за timeout (как SerialHelper.read_line)"""
+        delimiters = [
+            delimiter.encode() if isinstance(delimiter, str) else delimiter
+            for delimiter in delimiters
+        ]
+
+        async def fill():
+            while not any(delimiter in self.buf for delimiter in delimiters):
+                self.buf += await self.read()
+
+        try:
+            await asyncio.wait_for(fill(), timeout)
+        except asyncio.TimeoutError:
+            self.buf = bytearray()
+            return ""
+        for delimiter in delimiters:
+            i = self.buf.find(delimiter)
+            if i >= 0:
+                offset = i + len(delimiter)
+                line = bytes(self.buf[:offset])
+                del self.buf[:offset]
+                return line.decode("utf-8", errors="ignore")
+
+    async def write(
+        self,
+        data,
+        half_duplex=False,
+    ):
+        if isinstance(data, str):
+            data = data.encode()
+        self.serial.write(data)
+        while self.serial.out_waiting:
+            await asyncio.sleep(POLL_INTERVAL)
+        if half_duplex:
+            # Отправленное возвращается в прием, его нужно пропустить
+            while len(self.buf) < len(data):
+                self.buf += await self.read()
+            del self.buf[: len(data)]
+
+    async def write_str(
+        self,
+        data,
+        half_duplex=False,
+    ):
+        await self.write(data + "\r\n", half_duplex)
+
+
+async def open_port(
+    port,
+    baudrate=115200,
+    attempts=1,
+    delay=CONFIG_OPEN_DELAY,
+):
+    """Открыть порт, повторяя attempts раз через delay секунд
+
+    :raises serial.SerialException:
+        Порт не открылся ни с одной попытки
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            s = AsyncSerial(port, baudrate)
+        except serial.SerialException as e:
+            if attempts > 1:
+                print(
+                    "[!] Ошибка при последовательной инициализации "
+                    f"на попытке {attempt}: {e}"
+                )
+            if attempt == attempts:
+                raise
+            await asyncio.sleep(delay)
+        else:
+            if attempts > 1:
+                print(f"[+] Успешная инициализация на попытке {attempt}")
+            return s
+
+
+async def _cli_get(
+    s,
+    config,
+    expected,
+):
+    s.clear()
+    await s.write_str("get %s" % config)
+    line = (await s.read_line(["# "], 1.0)).strip()
+    return BFinitPassthrough.config_matches(line, expected)
+
+
+async def passthrough_init(
+    port,
+    baud,
+    half_duplex=False,
+    serialrx=None,
+):
+    """BFinitPassthrough.bf_passthrough_init на корутинах
+
+    :param serialrx:
+        Уже проверенный номер UART приемника: настройки не проверяются заново
+    :returns:
+        Номер UART приемника
+    :raises BFinitPassthrough.PassthroughEnabled:
+    :raises BFinitPassthrough.PassthroughFailed:
+    """
+    print("======== PASSTHROUGH INIT ========")
+    print("  Trying to initialize %s @ %s" % (port, baud))
+    async with await open_port(port) as s:
+        s.clear()
+        await s.write_str("#", half_duplex)
+        start = (await s.read_line(["CCC", "# "], 2.0)).strip()
+        BFinitPassthrough.check_start(start)
+        index = serialrx
+        if index is None:
+            index = await _find_serialrx(s, half_duplex)
+
+        cmd = "serialpassthrough %s %s" % (index, baud)
+        print("Enabling serial passthrough...")
+        print("  CMD: '%s'" % cmd)
+        await s.write_str(cmd)
+        await asyncio.sleep(0.2)
+    print("======== PASSTHROUGH DONE ========")
+    return index
+
+
+async def _find_serialrx(
+    s,
+    half_duplex,
+):
+    """Проверить настройки Serial RX в CLI и найти UART приемника"""
+    serial_check = []
+    for config, expected, hint in BFinitPassthrough.serialrx_checks(half_duplex):
+        if not await _cli_get(s, config, expected):
+            serial_check.append(hint)
+    if await _cli_get(s, "rx_spi_protocol", ["EXPRESSLRS"]) and serial_check:
+        serial_check = [BFinitPassthrough.SPI_RX_ERROR]
+    if serial_check:
+        raise BFinitPassthrough.serial_check_error(serial_check)
+
+    print("\nAttempting to detect FC UART configuration...")
+    s.clear()
+    await s.write_str("serial")
+    index = None
+    while index is None:
+        line = (await s.read_line(["\n"], CLI_TIMEOUT)).strip()
+        if not line or "#" in line:
+            break
+        if line.startswith("serial"):
+            index = BFinitPassthrough.serialrx_index(line)
+            if index is not None:
+                print("    ** Serial RX config detected: '%s'" % line)
+    if index is None:
+        raise BFinitPassthrough.PassthroughFailed(
+            "!!! RX Serial not found !!!!\n  Check configuration and try again..."
+        )
+    return index
+
+
+async def reset_to_bootloader(
+    port,
+    baud,
+    target,
+    action,
+    accept=None,
+    half_duplex=False,
+    chip_type="ESP82",
+) -> int:
+    """BFinitPassthrough.reset_to_bootloader на корутинах"""
+    print("======== RESET TO BOOTLOADER ========")
+    async with await open_port(port, baud) as s:
+        s.clear()
+        init_seq = BFinitPassthrough.bootloader_init_seq(half_duplex, chip_type)
+        if not half_duplex:
+            # Обучение автобода ROM загрузчика до последовательности сброса ELRS
+            await s.write(BFinitPassthrough.ROM_TRAINING)
+            await asyncio.sleep(0.2)
+        await s.write(init_seq)
+        rx_target = (await s.read_line(["\n", "CCC"], 3.0)).strip().upper()
+        result = BFinitPassthrough.check_rx_target(rx_target, target, action, accept)
+        if result != ElrsUploadResult.Success:
+            return result
+        await asyncio.sleep(0.8)
+    return ElrsUploadResult.Success
+
+
+async def sync_probe(
+    port,
+    baud,
+    timeout=SYNC_TIMEOUT,
+):
+    """Отвечает ли загрузчик ESP (ROM или stub) на SLIP sync: passthrough уже
+    включен и приемник ждет прошивку"""
+
+    async def reply():
+        while SLIP_SYNC_REPLY not in s.buf:
+            s.buf += await s.read()
+
+    async def sync():
+        # Загрузчик может пропустить первый sync, пока подстраивается
+        while True:
+            await s.write(SLIP_SYNC)
+            try:
+                return await asyncio.wait_for(reply(), SYNC_RETRY)
+            except asyncio.TimeoutError:
+                pass
+
+    async with await open_port(port, baud) as s:
+        s.clear()
+        try:
+            await step("SLIP sync", sync(), timeout)
+        except StepTimeout:
+            return False
+    return True
+
+
+async def probe_fc(
+    port,
+    timeout=UID_TIMEOUT,
+    db=None,
+):
+    """identify на порту; None, если порт не открылся или FC не отвечает
+    по MSP (например, уже в passthrough или в DFU)"""
+    try:
+        s = await open_port(port)
+    except serial.SerialException:
+        return None
+    async with s:
+        s.clear()
+        try:
+            fc = await identify(s, timeout, db)
+        except (StepTimeout, MspError):
+            return None
+    print(
+        f"FC {fc.uid}: {fc.variant or '?'} {fc.version or '?'}, "
+        f"{fc.target or fc.board or '?'}"
+    )
+    return fc
+
+
+class PassthroughCache:
+    """Порты, на которых passthrough уже включен.
+
+    Номер UART приемника с проверенными настройками serialrx хранится в базе
+    FC (fc_identity) по UID, здесь - UID FC на порту с включенным passthrough."""
+
+    def __init__(
+        self,
+        db=None,
+    ) -> None:
+        self.db = db
+        self._lock = threading.Lock()
+        self._active: Dict[str, Optional[str]] = {}
+        # Порты, где прошивка не удалась после включения passthrough
+        self._failed: Set[str] = set()
+
+    def _get_db(
+        self,
+    ):
+        return fc_identity.get_database() if self.db is None else self.db
+
+    def enabled(
+        self,
+        port,
+        fc,
+        serialrx,
+    ):
+        if fc is not None and serialrx is not None and fc.serialrx != serialrx:
+            self._get_db().set_serialrx(fc.uid, serialrx)
+        with self._lock:
+            self._active[port] = None if fc is None else fc.uid
+            self._failed.discard(port)
+
+    def is_active(
+        self,
+        port,
+    ):
+        with self._lock:
+            return port in self._active
+
+    def retrying(
+        self,
+        port,
+    ):
+        """Passthrough на порту уже включался: приемник может ждать в загрузчике"""
+        with self._lock:
+            return port in self._active or port in self._failed
+
+    def flash_failed(
+        self,
+        port,
+    ):
+        """Прошивка не удалась: passthrough проверяется заново, но при повторе
+        сначала проверяется загрузчик приемника"""
+        with self._lock:
+            if self._active.pop(port, False) is not False:
+                self._failed.add(port)
+
+    def deactivate(
+        self,
+        port,
+    ):
+        """FC ответил по MSP: passthrough на порту выключен"""
+        with self._lock:
+            self._active.pop(port, None)
+            self._failed.discard(port)
+
+    def forget(
+        self,
+        fc,
+    ):
+        """Проверить настройки FC в CLI заново"""
+        self._get_db().set_serialrx(fc.uid, None)
+
+
+@functools.lru_cache(maxsize=None)
+def get_passthrough_cache():
+    return PassthroughCache()
+
+
+async def _passthrough(
+    port,
+    baud,
+    half_duplex,
+    fc,
+    cache,
+):
+    serialrx = None if fc is None else fc.serialrx
+    if serialrx is not None:
+        print(f"FC {fc.uid} уже проверен, приемник на UART {serialrx}")
+    try:
+        index = await step(
+            "Passthrough",
+            passthrough_init(port, baud, half_duplex, serialrx),
+            PASSTHROUGH_TIMEOUT,
+        )
+    except (BFinitPassthrough.PassthroughFailed, StepTimeout):
+        if serialrx is None:
+            raise
+        # Настройки FC могли поменяться, проверяем их заново
+        cache.forget(fc)
+        return await _passthrough(
+            port,
+            baud,
+            half_duplex,
+            fc._replace(serialrx=None),
+            cache,
+        )
+    cache.enabled(port, fc, index)
+
+
+async def enter_bootloader(
+    port,
+    baud,
+    reset,
+    half_duplex=False,
+    slip_probe=False,
+    cache=None,
+) -> int:
+    """Passthrough через FC и сброс приемника в загрузчик.
+
+    При повторе (passthrough на порту уже включался) шаги пропускаются:
+    загрузчик уже отвечает на SLIP sync - сразу запись; FC молчит по MSP на
+    порту, где passthrough уже включен, - сразу сброс приемника. Если UART
+    приемника на этом FC уже в базе FC, настройки в CLI не проверяются.
+
+    :param reset:
+        Параметры reset_to_bootloader (ELRS.bootloader_reset)
+    :param slip_probe:
+        Приемник на ESP, его загрузчик можно проверить SLIP sync
+    :raises StepTimeout:
+    :raises BFinitPassthrough.PassthroughFailed:
+    """
+    if cache is None:
+        cache = get_passthrough_cache()
+    # SLIP sync уходит в CLI FC, если passthrough не включен, поэтому только
+    # при повторе
+    if slip_probe and cache.retrying(port) and await sync_probe(port, baud):
+        print("Загрузчик приемника уже отвечает, пропускаем passthrough")
+        return ElrsUploadResult.Success
+
+    fc = await probe_fc(port, db=cache.db)
+    if fc is None and cache.is_active(port):
+        print("FC не отвечает по MSP, passthrough уже включен")
+    else:
+        if fc is not None:
+            # FC отвечает сам, значит passthrough выключен
+            cache.deactivate(port)
+        try:
+            await _passthrough(port, baud, half_duplex, fc, cache)
+        except BFinitPassthrough.PassthroughEnabled as err:
+            print(str(err))
+            cache.enabled(port, fc, None)
+    return await step(
+        "Переход в загрузчик",
+        reset_to_bootloader(port, baud, half_duplex=half_duplex, **reset),
+        RESET_TIMEOUT,
+    )
+
+
+async def elrs_bootloader(
+    elrs,
+) -> Optional[int]:
+    """enter_bootloader для ELRS; None - приемник шьется без passthrough"""
+    reset = elrs.bootloader_reset()
+    if reset is None:
+        return None
+    await blocking(elrs.set_phase, job_journal.PHASE_PASSTHROUGH)
+    try:
+        return await enter_bootloader(
+            elrs.port,
+            elrs.baud,
+            reset,
+            slip_probe=elrs.options.mcuType != MCUType.STM32,
+        )
+    except BFinitPassthrough.PassthroughFailed as err:
+        # Как раньше в ELRS.upload_stm32_bf; для ESP ошибка настройки FC
+        # завершает задачу
+        if elrs.options.mcuType != MCUType.STM32:
+            raise
+        print(str(err))
+        return ElrsUploadResult.ErrorGeneral
+
+
+async def flash_elrs(
+    elrs,
+) -> int:
+    """ELRS.flash: ожидание и passthrough в цикле, запись образа в потоке"""
+    try:
+        if await blocking(elrs.start):
+            print("Продолжаем прерванную прошивку")
+        else:
+            await countdown(ELRS_COUNTDOWN)
+        status = await elrs_bootloader(elrs)
+        if status in (None, ElrsUploadResult.Success):
+            status = await blocking(elrs.upload, False)
+    except asyncio.CancelledError:
+        # Запись в журнал не в цикле сессий: он общий для всех портов.
+        # blocking дожидается ее и при повторной отмене
+        await blocking(elrs.finish, ElrsUploadResult.ErrorGeneral)
+        raise
+    return await blocking(elrs.finish, status)
+
+
+async def enter_dfu(
+    port,
+    baud=115200,
+):
+    """FC.dfu на корутинах
+
+    :raises Exception:
+        DFU устройство не появилось
+    """
+    from fc_flasher.main import _get_dfu_devices
+
+    if await blocking(_get_dfu_devices):
+        return True
+
+    async def send():
+        s = await open_port(port, baud)
+        try:
+            await s.write("#\n")
+            await asyncio.sleep(DFU_POLL)
+            await s.write("dfu\n")
+            # FC уходит в DFU и порт пропадает
+            with contextlib.suppress(Exception):
+                await s.write("bl\n")
+        finally:
+            with contextlib.suppress(Exception):
+                s.close()
+
+    await step("Команда DFU", send(), DFU_COMMAND_TIMEOUT)
+    for _ in range(DFU_ATTEMPTS):
+        await asyncio.sleep(DFU_POLL)
+        if await blocking(_get_dfu_devices):
+            return True
+    raise Exception("Не удалось перейти в dfu")
+
+
+async def upload_config(
+    port,
+    config_file,
+    progress=None,
+    baud=115200,
+    db=None,
+    force=False,
+):
+    """FC.upload_config на корутинах; каждая команда - шаг с таймаутом.
+
+    Если по базе FC этот конфиг уже залит на FC с той же прошивкой, заливка
+    пропускается (кроме force). Залитым конфиг отмечается, только если FC
+    ответил в CLI и не отклонил ни одной команды.
+
+    :returns:
+        True, если конфиг заливался
+    :raises serial.SerialException:
+        Порт не открылся
+    :raises StepTimeout:
+        FC перестал принимать команды
+    """
+    if db is None:
+        db = fc_identity.get_database()
+    commands = read_config_commands(config_file)
+    digest = fc_identity.config_hash(commands)
+    try:
+        s = await open_port(port, baud, CONFIG_OPEN_ATTEMPTS, CONFIG_OPEN_DELAY)
+    except serial.SerialException:
+        print("[!] Ошибка: не удалось установить серийное соединение")
+        raise
+
+    failed = False
+    async with s:
+        try:
+            fc = await identify(s, db=db)
+        except (StepTimeout, MspError):
+            fc = None
+        if not force and fc is not None and fc.config_applied(digest):
+            print(f"Конфиг уже залит на FC {fc.uid}, пропускаем")
+            if progress is not None:
+                progress.finish(port)
+            return False
+        await step("CLI", s.write("#\n"), COMMAND_TIMEOUT)
+        await asyncio.sleep(1)
+        output = bytearray(s.read_nowait())
+        # Прогресс в байтах команд, как у прошивки
+        total = sum(len(command) + 1 for command in commands)
+        done = 0
+        for i, command in enumerate(commands):
+            if progress is None:
+                print(f"Загружено команд {i+1}/{len(commands)}")
+            try:
+                await step(command, s.write(f"{command}\n"), COMMAND_TIMEOUT)
+                await asyncio.sleep(CLI_COMMAND_DELAY)
+                output += s.read_nowait()
+            except serial.SerialException:
+                print(f"[!] Ошибка при записи команды {command}")
+                failed = True
+            done += len(command) + 1
+            if progress is not None:
+                progress.set_done(port, done, total)
+
+    text = output.decode("utf-8", errors="ignore")
+    errors = [line.strip() for line in text.splitlines() if CLI_ERROR in line]
+    for line in errors:
+        print(f"[!] FC: {line}")
+    if not text.strip():
+        print("[!] FC не ответил в CLI")
+    elif fc is not None and not failed and not errors:
+        db.config_applied(fc.uid, digest, fc.version)
+    if progress is not None:
+        progress.finish(port)
+    print(f"Конфиг загружен, команд: {len(commands)}")
+    await asyncio.sleep(CONFIG_SETTLE)
+    return True
+
+
+def _msp_checksum(
+    data,
+):
+    return functools.reduce(operator.xor, data, 0)
+
+
+def msp_frame(
+    command,
+    payload=b"",
+):
+    """Запрос MSP v1: $M< размер команда данные crc"""
+    body = bytes([len(payload), command]) + payload
+    return b"$M<" + body + bytes([_msp_checksum(body)])
+
+
+async def _msp_read(
+    s,
+):
+    """Следующий кадр MSP из порта
+
+    :returns:
+        (команда, данные или None, если FC ответил ошибкой)
+    """
+    while True:
+        start = s.buf.find(b"$M")
+        if start < 0:
+            # Может прийти только начало заголовка
+            del s.buf[: max(0, len(s.buf) - 1)]
+        else:
+            del s.buf[:start]
+            if len(s.buf) >= 6 and len(s.buf) >= 6 + s.buf[3]:
+                frame = bytes(s.buf[: 6 + s.buf[3]])
+                del s.buf[: len(frame)]
+                body = frame[3:-1]
+                if _msp_checksum(body) != frame[-1]:
+                    raise MspError(f"MSP {body[1]}: неверная контрольная сумма")
+                return body[1], None if frame[2:3] == b"!" else body[2:]
+        s.buf += await s.read()
+
+
+async def msp_requests(
+    s,
+    commands,
+    timeout=MSP_TIMEOUT,
+):
+    """Отправить несколько команд MSP разом и собрать ответы
+
+    :returns:
+        {команда: данные или None, если команда не поддерживается}
+    :raises MspError:
+        Испорченный кадр
+    :raises StepTimeout:
+        FC ответил не на все команды
+    """
+    await s.write(b"".join(msp_frame(command) for command in commands))
+
+    async def collect():
+        replies = {}
+        while len(replies) < len(commands):
+            command, payload = await _msp_read(s)
+            if command in commands:
+                replies[command] = payload
+        return replies
+
+    return await step(f"MSP {list(commands)}", collect(), timeout)
+
+
+async def msp_request(
+    s,
+    command,
+    payload=b"",
+    timeout=MSP_TIMEOUT,
+):
+    """Отправить команду MSP и дождаться ответа на нее
+
+    :returns:
+        Данные ответа
+    :raises MspError:
+        FC ответил ошибкой или испорченным кадром
+    :raises StepTimeout:
+    """
+    await s.write(msp_frame(command, payload))
+
+    async def response():
+        while True:
+            reply, data = await _msp_read(s)
+            if reply == command:
+                if data is None:
+                    raise MspError(f"MSP {command}: команда не поддерживается")
+                return data
+
+    return await step(f"MSP {command}", response(), timeout)
+
+
+async def fc_variant(
+    s,
+):
+    """Прошивка FC по MSP: BTFL, INAV, ..."""
+    return (await msp_request(s, MSP_FC_VARIANT)).decode("ascii", errors="replace")
+
+
+def _parse_uid(
+    payload,
+):
+    # Три слова little endian, как UID показывает конфигуратор
+    return "".join("%08X" % word for word in struct.unpack("<3I", payload[:12]))
+
+
+def _parse_board(
+    payload,
+):
+    """(плата, таргет) из MSP_BOARD_INFO; имени таргета нет в старых прошивках"""
+    if not payload:
+        return None, None
+    board = payload[:4].decode("ascii", errors="replace")
+    target = None
+    if len(payload) > 8:
+        size = payload[8]
+        target = payload[9 : 9 + size].decode("ascii", errors="replace") or None
+    return board, target
+
+
+async def fc_uid(
+    s,
+    timeout=MSP_TIMEOUT,
+):
+    """UID микроконтроллера FC по MSP"""
+    return _parse_uid(await msp_request(s, MSP_UID, timeout=timeout))
+
+
+async def identify(
+    s,
+    timeout=UID_TIMEOUT,
+    db=None,
+):
+    """UID, прошивка, версия и плата FC одним обменом MSP; ответ сохраняется
+    в базе FC вместе с уже известными настройками
+
+    :returns:
+        fc_identity.FcIdentity
+    :raises MspError:
+        FC не сообщает UID или прислал испорченный кадр
+    :raises StepTimeout:
+        FC не отвечает по MSP (например, уже в passthrough)
+    """
+    replies = await msp_requests(
+        s,
+        (MSP_UID, MSP_FC_VARIANT, MSP_FC_VERSION, MSP_BOARD_INFO),
+        timeout,
+    )
+    if replies[MSP_UID] is None:
+        raise MspError("FC не сообщает UID")
+    variant = replies[MSP_FC_VARIANT]
+    version = replies[MSP_FC_VERSION]
+    board, target = _parse_board(replies[MSP_BOARD_INFO])
+    if db is None:
+        db = fc_identity.get_database()
+    return db.seen(
+        _parse_uid(replies[MSP_UID]),
+        variant.decode("ascii", errors="replace") if variant else None,
+        ".".join(str(part) for part in version[:3]) if version else None,
+        board,
+        target,
+    )
+
+
+class SessionEngine:
+    """Событийный цикл сессий в фоновом потоке"""
+
+    def __init__(
+        self,
+        threads=SESSION_THREADS,
+    ) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(
+                threads,
+                thread_name_prefix="session",
+            )
+        )
+        self._thread = threading.Thread(
+            target=self._run,
+            name="sessions",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(
+        self,
+    ):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(
+        self,
+        coro,
+    ) -> concurrent.futures.Future:
+        """Запустить корутину в цикле; cancel() у результата отменяет ее"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(
+        self,
+        coro,
+        timeout=None,
+    ):
+        """Выполнить корутину и дождаться результата в вызывающем потоке"""
+        return self.submit(coro).result(timeout)
+
+    def shutdown(
+        self,
+    ):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
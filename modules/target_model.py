@@ -0,0 +1,113 @@
+import itertools
+
+from PySide6 import QtCore, QtWidgets
+
+from modules import targets
+from modules.classes import DeviceType
+
+# Сколько строк добавлять при прокрутке списка
+FETCH_BATCH = 50
+
+
+class TargetListModel(QtCore.QAbstractListModel):
+    """Результаты поиска таргетов, строки создаются по мере прокрутки"""
+
+    def __init__(
+        self,
+        parent=None,
+        **filters,
+    ) -> None:
+        super().__init__(parent)
+        filters.setdefault("device_type", DeviceType.RX)
+        self.index = targets.get_index()
+        self.mask = self.index.table.mask(**filters)
+        self._rows = []
+        self._pending = iter(())
+        self._next = None
+        self.set_query("")
+
+    def set_query(
+        self,
+        query,
+    ):
+        self.beginResetModel()
+        self._rows = []
+        self._pending = iter(self.index.search(query, self.mask))
+        self._next = next(self._pending, None)
+        self.endResetModel()
+
+    def rowCount(
+        self,
+        parent=QtCore.QModelIndex(),
+    ):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def canFetchMore(
+        self,
+        parent=QtCore.QModelIndex(),
+    ):
+        return not parent.isValid() and self._next is not None
+
+    def fetchMore(
+        self,
+        parent=QtCore.QModelIndex(),
+    ):
+        if not self.canFetchMore(parent):
+            return
+        batch = [self._next]
+        batch.extend(itertools.islice(self._pending, FETCH_BATCH - 1))
+        self._next = next(self._pending, None)
+        self.beginInsertRows(
+            QtCore.QModelIndex(),
+            len(self._rows),
+            len(self._rows) + len(batch) - 1,
+        )
+        self._rows.extend(batch)
+        self.endInsertRows()
+
+    def data(
+        self,
+        index,
+        role=QtCore.Qt.ItemDataRole.DisplayRole,
+    ):
+        if not index.isValid() or index.row() >= len(self._rows):
+            return None
+        target = self._rows[index.row()]
+        if role in (
+            QtCore.Qt.ItemDataRole.DisplayRole,
+            QtCore.Qt.ItemDataRole.EditRole,
+        ):
+            return target.path
+        if role == QtCore.Qt.ItemDataRole.ToolTipRole:
+            return target.config.get("product_name")
+        return None
+
+
+def setup_target_combo(
+    combo,
+):
+    """Сделать выбор таргета поиском: ввод фильтрует выпадающий список"""
+    placeholder = combo.placeholderText()
+    combo.setModel(TargetListModel(combo))
+    combo.setEditable(True)
+    combo.setInsertPolicy(QtWidgets.QComboBox.InsertPolicy.NoInsert)
+    combo.setCurrentIndex(-1)
+    combo.lineEdit().setPlaceholderText(placeholder)
+
+    # Список completer уже отфильтрован индексом, сам он не фильтрует
+    search_model = TargetListModel(combo)
+    completer = QtWidgets.QCompleter(search_model, combo)
+    completer.setCompletionMode(
+        QtWidgets.QCompleter.CompletionMode.UnfilteredPopupCompletion
+    )
+    combo.setCompleter(completer)
+
+    def on_edit(
+        text,
+    ):
+        search_model.set_query(text)
+        if text:
+            completer.complete()
+
+    combo.lineEdit().textEdited.connect(on_edit)
+    return completer
@@ -1,16 +1,343 @@
-import json
-
-from modules.get_path import load_file
-
-
-def get_targets():
-    json_data = json.loads(open(load_file("resources//targets.json")).read())
-    targets_list = []
-    for v in json_data:
-        for t in json_data[v]:
-            if t != "name":
-                for m in json_data[v][t]:
-                    current_target = f"{v}.{t}.{m}"
-                    if "tx" not in current_target:
-                        targets_list.append(current_target)
-    return targets_list
+"""Таблица таргетов из targets.json.
+
+Таблица строится один раз при первом обращении. Каждый таргет - компактная
+запись с уже разобранными типом устройства, частотой, платформой и способами
+прошивки, а строки повторяющихся значений интернированы. Для каждого значения
+столбца хранится битовая маска строк, поэтому фильтр по нескольким столбцам -
+это AND нескольких целых чисел, а не проход по вложенным словарям.
+
+Поиск в окне идет по индексу (TargetIndex): префиксное дерево слов из
+названий таргета и триграммы этих слов для поиска с опечатками.
+"""
+
+import functools
+import re
+import sys
+from typing import Dict, FrozenSet, Iterator, List, Optional
+
+from modules.classes import DeviceType, FirmwareOptions, MCUType, RadioType
+from modules.UnifiedConfig import loadTargets
+
+MCU_TYPES = {
+    "stm32": MCUType.STM32,
+    "esp32": MCUType.ESP32,
+    "esp8285": MCUType.ESP8266,
+}
+
+# Столбцы, по которым строятся битовые маски
+COLUMNS = ("vendor", "device_type", "frequency", "platform", "upload_method")
+
+# Поля config, по словам которых ищет TargetIndex
+SEARCH_FIELDS = ("product_name", "lua_name", "firmware", "prior_target_name")
+# Доля триграмм слова запроса, которая должна найтись в слове таргета
+FUZZY_THRESHOLD = 0.6
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+class Target:
+    __slots__ = (
+        "path",
+        "vendor",
+        "group",
+        "name",
+        "device_type",
+        "radio",
+        "frequency",
+        "platform",
+        "mcu_type",
+        "upload_methods",
+        "config",
+    )
+
+    def __init__(
+        self,
+        vendor,
+        group,
+        name,
+        config,
+    ) -> None:
+        self.vendor = sys.intern(vendor)
+        self.group = sys.intern(group)
+        self.name = name
+        self.path = f"{vendor}.{group}.{name}"
+        self.config = config
+        # Группы вида rx_2400, tx_900
+        device, _, frequency = group.partition("_")
+        self.device_type = DeviceType.TX if device == "tx" else DeviceType.RX
+        self.frequency = sys.intern(frequency)
+        self.radio = RadioType.SX127X if frequency == "900" else RadioType.SX1280
+        self.platform = sys.intern(config["platform"])
+        self.mcu_type = MCU_TYPES.get(self.platform, MCUType.ESP8266)
+        self.upload_methods: FrozenSet[str] = frozenset(
+            sys.intern(method) for method in config.get("upload_methods", ())
+        )
+
+    @property
+    def options(
+        self,
+    ):
+        config = self.config
+        stlink = config.get("stlink", {})
+        return FirmwareOptions(
+            self.mcu_type is not MCUType.STM32,
+            "buzzer" in config.get("features", ()),
+            self.mcu_type,
+            self.device_type,
+            self.radio,
+            config.get("lua_name", ""),
+            stlink.get("bootloader", ""),
+            stlink.get("offset", 0),
+            config["firmware"],
+        )
+
+    def __repr__(
+        self,
+    ):
+        return f"Target({self.path})"
+
+
+class TargetTable:
+    def __init__(
+        self,
+        targets_json,
+    ) -> None:
+        self.rows: List[Target] = []
+        self.vendor_names: Dict[str, str] = {}
+        for vendor, groups in targets_json.items():
+            self.vendor_names[vendor] = groups.get("name", vendor)
+            for group, configs in groups.items():
+                if not isinstance(configs, dict):
+                    continue
+                for name, config in configs.items():
+                    if isinstance(config, dict) and "firmware" in config:
+                        self.rows.append(Target(vendor, group, name, config))
+        self.by_path: Dict[str, Target] = {row.path: row for row in self.rows}
+        self.paths = [row.path for row in self.rows]
+        self.all = (1 << len(self.rows)) - 1
+
+        self._masks: Dict[str, Dict[object, int]] = {column: {} for column in COLUMNS}
+        for i, row in enumerate(self.rows):
+            bit = 1 << i
+            for column, values in (
+                ("vendor", (row.vendor,)),
+                ("device_type", (row.device_type,)),
+                ("frequency", (row.frequency,)),
+                ("platform", (row.platform,)),
+                ("upload_method", row.upload_methods),
+            ):
+                masks = self._masks[column]
+                for value in values:
+                    masks[value] = masks.get(value, 0) | bit
+
+    def __len__(
+        self,
+    ):
+        return len(self.rows)
+
+    def get(
+        self,
+        path,
+    ) -> Optional[Target]:
+        return self.by_path.get(path)
+
+    def values(
+        self,
+        column,
+    ):
+        """Значения столбца, например все платформы для фильтра в окне"""
+        return sorted(self._masks[column], key=str)
+
+    def mask(
+        self,
+        **filters,
+    ):
+        """Битовая маска строк, подходящих под все фильтры.
+
+        Значение фильтра - одно значение столбца или набор (любое из них):
+        mask(device_type=DeviceType.RX, frequency="2400",
+             upload_method=("betaflight", "stlink"))
+        """
+        result = self.all
+        for column, wanted in filters.items():
+            if wanted is None:
+                continue
+            masks = self._masks[column]
+            if isinstance(wanted, (list, tuple, set, frozenset)):
+                column_mask = 0
+                for value in wanted:
+                    column_mask |= masks.get(value, 0)
+            else:
+                column_mask = masks.get(wanted, 0)
+            result &= column_mask
+        return result
+
+    def iter_indices(
+        self,
+        mask,
+    ) -> Iterator[int]:
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def iter_mask(
+        self,
+        mask,
+    ) -> Iterator[Target]:
+        rows = self.rows
+        for i in self.iter_indices(mask):
+            yield rows[i]
+
+    def filter(
+        self,
+        **filters,
+    ) -> List[Target]:
+        return list(self.iter_mask(self.mask(**filters)))
+
+
+def words(
+    text,
+):
+    return _WORD.findall(text.lower())
+
+
+def trigrams(
+    word,
+):
+    padded = f" {word} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class TargetIndex:
+    """Поиск таргетов по словам пути, производителя и SEARCH_FIELDS.
+
+    Каждое слово запроса ищется как префикс слова таргета; слово без
+    совпадений ищется по триграммам (опечатки, пропущенные буквы). Таргет
+    подходит, если подходят все слова запроса.
+    """
+
+    def __init__(
+        self,
+        table,
+    ) -> None:
+        self.table = table
+        # Узел дерева: {символ: узел, "": маска строк со словами с этим префиксом}
+        self._trie: dict = {}
+        self._trigrams: Dict[str, int] = {}
+        for i, row in enumerate(table.rows):
+            bit = 1 << i
+            texts = [row.path, table.vendor_names.get(row.vendor, "")]
+            texts.extend(str(row.config.get(field, "")) for field in SEARCH_FIELDS)
+            for word in set(words(" ".join(texts))):
+                node = self._trie
+                for char in word:
+                    node = node.setdefault(char, {})
+                    node[""] = node.get("", 0) | bit
+                for gram in trigrams(word):
+                    self._trigrams[gram] = self._trigrams.get(gram, 0) | bit
+
+    def prefix_mask(
+        self,
+        word,
+    ):
+        node = self._trie
+        for char in word:
+            node = node.get(char)
+            if node is None:
+                return 0
+        return node.get("", 0)
+
+    def fuzzy_scores(
+        self,
+        word,
+    ):
+        """{строка: число общих триграмм} для строк выше FUZZY_THRESHOLD"""
+        # Слово запроса может быть недописано, поэтому без пробела в конце
+        grams = trigrams(word)
+        grams.discard(word[-2:] + " ")
+        # Счетчик совпавших триграмм для всех строк сразу: planes[k] - маска
+        # строк, у которых установлен бит k счетчика
+        planes: List[int] = []
+        for gram in grams:
+            carry = self._trigrams.get(gram, 0)
+            for k, plane in enumerate(planes):
+                planes[k] = plane ^ carry
+                carry &= plane
+            if carry:
+                planes.append(carry)
+
+        needed = max(1, int(len(grams) * FUZZY_THRESHOLD + 0.5))
+        if needed >> len(planes):
+            return {}
+        # Сравнение счетчика с needed от старшего бита к младшему
+        above = 0
+        equal = self.table.all
+        for k in reversed(range(len(planes))):
+            if needed >> k & 1:
+                equal &= planes[k]
+            else:
+                above |= equal & planes[k]
+                equal &= ~planes[k]
+        return {
+            i: sum((planes[k] >> i & 1) << k for k in range(len(planes)))
+            for i in self.table.iter_indices(above | equal)
+        }
+
+    def search(
+        self,
+        query,
+        mask=None,
+    ) -> Iterator[Target]:
+        """Таргеты, подходящие под запрос, внутри маски фильтров mask.
+
+        Точные совпадения по префиксам - в порядке таблицы и лениво, чтобы
+        короткий запрос не разбирал всю таблицу; при поиске с опечатками - по
+        убыванию числа общих триграмм.
+        """
+        result = self.table.all if mask is None else mask
+        scores: Dict[int, int] = {}
+        for word in words(query):
+            word_mask = self.prefix_mask(word)
+            if not word_mask:
+                word_scores = self.fuzzy_scores(word)
+                for i, count in word_scores.items():
+                    scores[i] = scores.get(i, 0) + count
+                for i in word_scores:
+                    word_mask |= 1 << i
+            result &= word_mask
+        if not scores:
+            return self.table.iter_mask(result)
+        indices = sorted(
+            self.table.iter_indices(result),
+            key=lambda i: -scores.get(i, 0),
+        )
+        return (self.table.rows[i] for i in indices)
+
+
+@functools.lru_cache(maxsize=None)
+def get_table():
+    return TargetTable(loadTargets())
+
+
+@functools.lru_cache(maxsize=None)
+def get_index():
+    return TargetIndex(get_table())
+
+
+def find(
+    path,
+) -> Target:
+    target = get_table().get(path)
+    if target is None:
+        raise Exception(f"Таргет {path} не найден")
+    return target
+
+
+def get_targets(
+    **filters,
+):
+    """Пути таргетов для выбора в окне, по умолчанию все приемники"""
+    filters.setdefault("device_type", DeviceType.RX)
+    table = get_table()
+    return [row.path for row in table.iter_mask(table.mask(**filters))]